@@ -1,9 +1,10 @@
 import os
+import hashlib
 import polars as pl
 import logging
 import sys
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, date, timedelta, timezone
 
 
 def init_logger(file_name: str) -> None:
@@ -40,7 +41,95 @@ def get_alpha_key() -> str:
     return os.environ['ALPHA_VANTAGE_API'], os.environ['ALPHA_VANTAGE_API2']
 
 
-def parse_data(data: list[dict], str_cols: list[str]) -> pl.DataFrame:
+# a throttled request is retried after this many seconds, the API limits the calls per minute
+THROTTLE_BACKOFF_SECONDS = 60
+# statuses of the responses that do not say anything about the ticker, the request is retried later
+TRANSIENT_STATUSES = ['throttled', 'error']
+# the wording of the rate limit messages, the API also answers an invalid or missing key and premium only
+# functions with an Information message
+THROTTLE_MESSAGES = ['rate limit', 'call frequency', 'per minute', 'per day', 'per second', 'sparingly']
+
+
+def classify_response(data: any, keys: tuple = ('quarterlyReports', 'annualReports')) -> str:
+    """
+    Classify a response of the API. The API answers a throttled request with a 200 and a Note or
+    Information message about the rate limit instead of the data, the other messages reject the call
+    Parameters
+    _________________
+    data: dict
+        the parsed json response
+    keys: tuple
+        the keys holding the data of the requested function
+    :return:
+        ok, throttled, invalid when the API rejected the symbol or the call, empty when there is no data
+    """
+    if not isinstance(data, dict):
+        return 'empty'
+    message = data.get('Note') or data.get('Information')
+    if message is not None:
+        if any(x in str(message).lower() for x in THROTTLE_MESSAGES):
+            return 'throttled'
+        return 'invalid'
+    if 'Error Message' in data:
+        return 'invalid'
+    if not any(data.get(x) for x in keys):
+        return 'empty'
+    return 'ok'
+
+
+def throttle_backoff(data: dict, now: datetime | None = None) -> float:
+    """
+    Get the seconds to wait before a throttled request is retried, until the next day (UTC) when the
+    daily limit of the key was reached otherwise a minute
+    """
+    message = str(data.get('Note') or data.get('Information') or '').lower()
+    if 'per day' in message or 'daily' in message:
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+        return (tomorrow - now).total_seconds()
+    return THROTTLE_BACKOFF_SECONDS
+
+
+# data quality checks of parse_data and update_records, values above this are not reported figures in US dollars
+MAX_ABS_VALUE = 1e13
+# the rough units of the reporting currencies per US dollar, the range of the values reported in currencies with
+# a small unit is scaled by it. Other currencies are checked with MAX_ABS_VALUE
+CURRENCY_SCALE = {'JPY': 1e3, 'KRW': 1e4, 'IDR': 1e5, 'VND': 1e5, 'IRR': 1e5, 'COP': 1e4, 'CLP': 1e3, 'HUF': 1e3,
+                  'NGN': 1e4, 'ARS': 1e4, 'KZT': 1e3, 'PKR': 1e3, 'LKR': 1e3, 'INR': 1e2, 'RUB': 1e2, 'PHP': 1e2,
+                  'THB': 1e2, 'TWD': 1e2, 'ISK': 1e3, 'CNY': 1e1, 'HKD': 1e1}
+# fields that are never negative
+NON_NEGATIVE_FIELDS = ['totalRevenue', 'totalAssets', 'totalCurrentAssets', 'commonStockSharesOutstanding',
+                       'cashAndCashEquivalentsAtCarryingValue']
+# the increase of the share of null fields of the latest quarter over the previous quarters that is flagged
+NULL_RATE_JUMP = 0.3
+# the relative change of a restated value that is flagged
+RESTATEMENT_THRESHOLD = 0.5
+# the distance of the log10 ratio of a restated value to 3 or 6 flagged as a change of the unit
+UNIT_CHANGE_TOLERANCE = 0.05
+# the raw values of the API meaning no value
+MISSING_VALUES = ['None', '', '-']
+QUALITY_SCHEMA = {'check': pl.String, 'field': pl.String, 'fiscalDateEnding': pl.String, 'value': pl.Float64}
+
+
+def _issues(df: pl.LazyFrame, checks: dict[str: tuple[pl.Expr, pl.Expr]], id_col: str) -> pl.LazyFrame:
+    """
+    Turn row level checks into one row per flagged record and check. The checks are keyed by check and
+    field, separated by a |, with the flag and the value reported for the flagged records
+    """
+    if len(checks) == 0:
+        return pl.LazyFrame(schema=QUALITY_SCHEMA)
+    return (df.select(pl.col(id_col).cast(pl.String).alias('fiscalDateEnding'),
+                      *[pl.when(flag).then(pl.struct(pl.lit(True).alias('flagged'),
+                                                     value.cast(pl.Float64).alias('value'))).alias(key)
+                        for key, (flag, value) in checks.items()])
+            .unpivot(index='fiscalDateEnding', variable_name='key', value_name='issue')
+            .filter(pl.col('issue').is_not_null())
+            .select(pl.col('key').str.split_exact('|', 1).struct.rename_fields(['check', 'field']).struct.unnest(),
+                    'fiscalDateEnding', pl.col('issue').struct.field('value'))
+            .with_columns(pl.when(pl.col('field') != '').then(pl.col('field')).alias('field')))
+
+
+def parse_data(data: list[dict], str_cols: list[str], checks: bool = False) -> pl.DataFrame | tuple:
     """
     Parse the data from the API
     Parameters
@@ -49,18 +138,226 @@ def parse_data(data: list[dict], str_cols: list[str]) -> pl.DataFrame:
         the data to parse
     str_cols: list
         the list of string columns to keep as string
+    checks: bool
+        also run the data quality checks in the same pass, the values that could not be parsed, the values out
+        of range, a latest quarter with all the fields zero or missing and a jump of the share of missing fields
+        in the latest quarter
     :return:
-        pl.DataFrame
+        pl.DataFrame, with the data frame of the flagged values, see QUALITY_SCHEMA, when checks is True
     """
     # convert to polars
     df = pl.DataFrame(data=data)
+    numeric_cols = [column for column in df.columns if column not in str_cols]
     # convert numerical columns to float and string columns to str
+    parsed = df.lazy().with_columns(
+        pl.col(column).cast(pl.Float64, strict=False).alias(f"__parsed_{column}") for column in numeric_cols
+    )
+    result = parsed.select(pl.col(f"__parsed_{x}").alias(x) if x in numeric_cols else pl.col(x) for x in df.columns)
+    if not checks:
+        return result.collect()
+    id_col = 'fiscalDateEnding'
+    values = {x: pl.col(f"__parsed_{x}") for x in numeric_cols}
+    max_abs_value = pl.lit(MAX_ABS_VALUE)
+    if 'reportedCurrency' in df.columns:
+        max_abs_value = max_abs_value * pl.col('reportedCurrency').replace_strict(CURRENCY_SCALE, default=1.0,
+                                                                                  return_dtype=pl.Float64)
+    row_checks = {}
+    for column, value in values.items():
+        raw = pl.col(column).cast(pl.String)
+        row_checks[f"unparsed|{column}"] = (raw.is_not_null() & ~raw.is_in(MISSING_VALUES) & value.is_null(),
+                                            pl.lit(None))
+        row_checks[f"out_of_range|{column}"] = (value.abs() > max_abs_value, value)
+        if column in NON_NEGATIVE_FIELDS:
+            row_checks[f"negative|{column}"] = (value < 0, value)
+    latest = pl.col(id_col) == pl.col(id_col).max()
+    if len(values) > 0:
+        zeroed = pl.all_horizontal([x.is_null() | (x == 0) for x in values.values()])
+        row_checks["zeroed_quarter|"] = (latest & zeroed, pl.lit(len(values)))
+    issues = [_issues(parsed, row_checks, id_col=id_col)]
+    if len(values) > 0 and df.height > 1:
+        null_rate = pl.mean_horizontal([x.is_null() for x in values.values()])
+        jump = null_rate.filter(latest).first() - null_rate.filter(~latest).mean()
+        issues.append(parsed.select(pl.lit('null_rate_jump').alias('check'), pl.lit(None, dtype=pl.String).alias('field'),
+                                    pl.col(id_col).max().cast(pl.String).alias('fiscalDateEnding'),
+                                    jump.cast(pl.Float64).alias('value'))
+                      .filter(pl.col('value') > NULL_RATE_JUMP))
+    # the parse and the checks share the scan and the casts of the data
+    df, df_issues = pl.collect_all([result, pl.concat(issues)])
+    return df, df_issues
+
+
+def parse_prices(data: dict, ticker: str) -> pl.DataFrame:
+    """
+    Parse the daily time series from the API
+    Parameters
+    _________________
+    data: dict
+        the "Time Series (Daily)" object of the response, keyed by date
+    ticker: str
+        the symbol of the series
+    :return:
+        pl.DataFrame with one row per date sorted by date
+    """
+    df = pl.DataFrame({
+        'Symbol': [ticker] * len(data),
+        'date': list(data.keys()),
+        'open': [x.get('1. open') for x in data.values()],
+        'high': [x.get('2. high') for x in data.values()],
+        'low': [x.get('3. low') for x in data.values()],
+        'close': [x.get('4. close') for x in data.values()],
+        'volume': [x.get('5. volume') for x in data.values()],
+    }, schema={'Symbol': pl.String, 'date': pl.String, 'open': pl.String, 'high': pl.String,
+               'low': pl.String, 'close': pl.String, 'volume': pl.String})
+    df = df.with_columns(
+        pl.col('date').str.to_date(),
+        *[pl.col(x).cast(pl.Float64, strict=False) for x in ['open', 'high', 'low', 'close']],
+        pl.col('volume').cast(pl.Int64, strict=False)
+    )
+    return df.sort('date')
+
+
+
+def parse_dividends(data: list[dict], ticker: str) -> pl.DataFrame:
+    """
+    Parse the dividend events from the API
+    Parameters
+    _________________
+    data: list[dict]
+        the "data" list of the response, one event per ex dividend date
+    ticker: str
+        the symbol of the events
+    :return:
+        pl.DataFrame with the ex dividend date as date and the cash amount per share, sorted by date
+    """
+    date_cols = ['declaration_date', 'record_date', 'payment_date']
+    df = pl.DataFrame({
+        'Symbol': [ticker] * len(data),
+        'date': [x.get('ex_dividend_date') for x in data],
+        'amount': [x.get('amount') for x in data],
+        **{col: [x.get(col) for x in data] for col in date_cols}
+    }, schema={'Symbol': pl.String, 'date': pl.String, 'amount': pl.String, **{x: pl.String for x in date_cols}})
+    # dates that are not known yet are reported as None
+    df = df.with_columns(
+        *[pl.col(x).str.to_date(strict=False) for x in ['date'] + date_cols],
+        pl.col('amount').cast(pl.Float64, strict=False)
+    )
+    return df.filter(pl.col('date').is_not_null()).sort('date')
+
+
+def parse_splits(data: list[dict], ticker: str) -> pl.DataFrame:
+    """
+    Parse the split events from the API
+    Parameters
+    _________________
+    data: list[dict]
+        the "data" list of the response, one event per effective date
+    ticker: str
+        the symbol of the events
+    :return:
+        pl.DataFrame with the effective date as date and the split factor, 4.0 for a 4 for 1 split, sorted by date
+    """
+    df = pl.DataFrame({
+        'Symbol': [ticker] * len(data),
+        'date': [x.get('effective_date') for x in data],
+        'split_factor': [x.get('split_factor') for x in data],
+    }, schema={'Symbol': pl.String, 'date': pl.String, 'split_factor': pl.String})
     df = df.with_columns(
-        pl.col(column).cast(pl.Float64, strict=False) for column in df.columns if column not in str_cols
+        pl.col('date').str.to_date(strict=False),
+        pl.col('split_factor').cast(pl.Float64, strict=False)
     )
-    return df
+    return df.filter(pl.col('date').is_not_null() & (pl.col('split_factor') > 0)).sort('date')
 
 
+def get_adjustment_factors(prices: pl.DataFrame,
+                           dividends: pl.DataFrame | None = None,
+                           splits: pl.DataFrame | None = None) -> pl.DataFrame:
+    """
+    Compute the cumulative backward adjustment factors of all the tickers in one pass. A split of factor s
+    divides the prices before its date by s, a dividend of amount a multiplies them by 1 - a / close with the
+    close of the last bar before the ex dividend date. The factors of a date are the product of the factors
+    of all the events after it
+    Parameters
+    _________________
+    prices: pl.DataFrame
+        the unadjusted daily bars of the tickers with the Symbol, date and close columns
+    dividends: pl.DataFrame
+        the dividend events with the Symbol, date and amount columns, see parse_dividends
+    splits: pl.DataFrame
+        the split events with the Symbol, date and split_factor columns, see parse_splits
+    :return:
+        pl.DataFrame with one row per ticker and event date, the price_factor and the split_ratio applying to
+        the dates before it, see apply_adjustments
+    """
+    events = [pl.DataFrame(schema={'Symbol': pl.String, 'date': pl.Date, 'price_factor': pl.Float64,
+                                   'split_ratio': pl.Float64})]
+    if splits is not None and splits.height > 0:
+        events.append(splits.select('Symbol', 'date',
+                                    (1.0 / pl.col('split_factor')).alias('price_factor'),
+                                    pl.col('split_factor').alias('split_ratio')))
+    if dividends is not None and dividends.height > 0:
+        # the close of the last bar before the ex dividend date
+        closes = prices.select('Symbol', 'date', pl.col('close').alias('prev_close')).sort('date')
+        df_div = dividends.select('Symbol', 'date', 'amount').sort('date').join_asof(
+            closes, on='date', by='Symbol', strategy='backward', allow_exact_matches=False, check_sortedness=False)
+        events.append(df_div.select('Symbol', 'date',
+                                    (1.0 - pl.col('amount') / pl.col('prev_close')).fill_null(1.0)
+                                    .clip(lower_bound=0.0).alias('price_factor'),
+                                    pl.lit(1.0).alias('split_ratio')))
+    # events of the same day are combined, the factors are accumulated from the latest event backwards
+    return (pl.concat(events)
+            .group_by('Symbol', 'date').agg(pl.col('price_factor').product(), pl.col('split_ratio').product())
+            .sort('Symbol', pl.col('date'), descending=[False, True])
+            .with_columns(pl.col('price_factor').cum_prod().over('Symbol'),
+                          pl.col('split_ratio').cum_prod().over('Symbol'))
+            .sort('date'))
+
+
+def apply_adjustments(df: pl.DataFrame,
+                      factors: pl.DataFrame,
+                      date_col: str = 'date',
+                      price_cols: list[str] | None = None,
+                      per_share_cols: list[str] | None = None,
+                      share_cols: list[str] | None = None) -> pl.DataFrame:
+    """
+    Adjust the price and per share series of all the tickers at once, every row gets the factors of the first
+    event after its date
+    Parameters
+    _________________
+    df: pl.DataFrame
+        the series of the tickers with a Symbol column, prices or statements
+    factors: pl.DataFrame
+        the cumulative factors, see get_adjustment_factors
+    date_col: str
+        the date of the rows, fiscalDateEnding for the statements
+    price_cols: list[str]
+        the columns adjusted for splits and dividends, the open, high, low and close of the bars if None
+    per_share_cols: list[str]
+        the columns adjusted for splits only, divided by the split ratio
+    share_cols: list[str]
+        the share counts and volumes, multiplied by the split ratio
+    :return:
+        pl.DataFrame with the adjusted columns in the order of the input
+    """
+    if price_cols is None:
+        price_cols = [x for x in ['open', 'high', 'low', 'close'] if x in df.columns]
+    per_share_cols = per_share_cols or []
+    share_cols = share_cols or []
+    key = pl.col(date_col).str.to_date(strict=False) if df.schema[date_col] == pl.String else pl.col(date_col).cast(pl.Date)
+    adjusted = (df.with_columns(key.alias('__adjust_date'), pl.int_range(pl.len()).alias('__row'))
+                .sort('__adjust_date')
+                .join_asof(factors.select('Symbol', pl.col('date').alias('__adjust_date'), 'price_factor',
+                                          'split_ratio'),
+                           on='__adjust_date', by='Symbol', strategy='forward', allow_exact_matches=False,
+                           check_sortedness=False)
+                .with_columns(pl.col('price_factor', 'split_ratio').fill_null(1.0)))
+    adjusted = adjusted.with_columns(
+        *[pl.col(x) * pl.col('price_factor') for x in price_cols],
+        *[pl.col(x) / pl.col('split_ratio') for x in per_share_cols],
+        *[(pl.col(x) * pl.col('split_ratio')).round(0).cast(df.schema[x]) if df.schema[x].is_integer()
+          else pl.col(x) * pl.col('split_ratio') for x in share_cols]
+    )
+    return adjusted.sort('__row').select(df.columns)
+
 def check_new_field(df_target: pl.DataFrame,
                     df_source: pl.DataFrame,
                     id_col: str = 'fiscalDateEnding') -> pl.DataFrame:
@@ -73,12 +370,11 @@ def check_new_field(df_target: pl.DataFrame,
         The updated target data frame
     """
     # get the new columns and merge to the target data frame
-    new_column = list(set(df_source.columns) - set(df_target.columns))
-    new_column.append(id_col)
+    new_column = [x for x in df_source.columns if x not in df_target.columns]
     if len(new_column) == 0:
         return df_target
     else:
-        return df_target.join(df_source.select(new_column), on=id_col, how='left')
+        return df_target.join(df_source.select([id_col] + new_column), on=id_col, how='left')
 
 
 def check_removed_field(df_target: pl.DataFrame,
@@ -99,29 +395,57 @@ def check_removed_field(df_target: pl.DataFrame,
         return df_source.with_columns(pl.lit(None).alias(x) for x in removed_column)
 
 
+def get_restatement_checks(source: pl.DataFrame, suffix: str = '_df2') -> dict[str: tuple[pl.Expr, pl.Expr]]:
+    """
+    Get the checks of the restated records, the source values joined to the stored values with the suffix.
+    Changes of the unit, flips of the sign, large restatements and quarters zeroed out by the restatement
+    are flagged with the ratio of the restated value to the stored value
+    """
+    fields = [x for x, dtype in source.schema.items() if dtype.is_numeric()]
+    checks = {}
+    for x in fields:
+        new, old = pl.col(x), pl.col(f"{x}{suffix}")
+        ratio = pl.when(old != 0).then(new / old)
+        magnitude = ratio.abs().log10().abs()
+        checks[f"unit_change|{x}"] = (((magnitude - 3).abs() < UNIT_CHANGE_TOLERANCE)
+                                      | ((magnitude - 6).abs() < UNIT_CHANGE_TOLERANCE), ratio)
+        checks[f"sign_flip|{x}"] = (ratio < 0, ratio)
+        checks[f"restatement|{x}"] = ((ratio - 1).abs() > RESTATEMENT_THRESHOLD, ratio)
+    if len(fields) > 0:
+        was_reported = pl.any_horizontal([pl.col(f"{x}{suffix}").fill_null(0) != 0 for x in fields])
+        zeroed = pl.all_horizontal([pl.col(x).is_null() | (pl.col(x) == 0) for x in fields])
+        checks["zeroed_quarter|"] = (was_reported & zeroed, pl.lit(0.0))
+    return checks
+
+
 def update_records(
         target: pl.DataFrame,
         source: pl.DataFrame,
         on: str = 'fiscalDateEnding',
-        update_time: datetime = datetime.now()
-) -> pl.DataFrame:
+        update_time: datetime = datetime.now(),
+        checks: bool = False
+) -> pl.DataFrame | tuple:
     """
     The following function looks to update the records of a slowly changing dimension type 2 data frame. Using a source dataframe
 
     Parameters:
     target (pl.DataFrame): The target data frame that will be updated
     source (pl.DataFrame): The source data frame that will be used to update the target data frame
+    checks (bool): also check the restated records on the joined records, see get_restatement_checks
 
 
     Returns:
-    pl.DataFrame: The updated target data frame
+    pl.DataFrame: The updated target data frame, with the data frame of the flagged values when checks is True
     """
     # get the source columns
 
     # find the records that differ between the two data frames
-    diff = source.join(target, on=on, suffix='_df2').filter(pl.any_horizontal(
+    joined = source.join(target, on=on, suffix='_df2').filter(pl.any_horizontal(
         pl.col(x).ne_missing(pl.col(f"{x}_df2"))
-        for x in source.columns if x != on)).select(source.columns)
+        for x in source.columns if x != on))
+    diff = joined.select(source.columns)
+    if checks:
+        issues = _issues(joined.lazy(), get_restatement_checks(source), id_col=on).collect()
     # add the update time and is_current flag to the df_diff
     diff = diff.with_columns(
         pl.lit(True).alias("is_current"),
@@ -138,6 +462,8 @@ def update_records(
     logging.info(f"Shape of target: {df_updated.shape}")
     logging.info(f"Shape of diff: {diff.shape}")
     df_updated = pl.concat([df_updated, diff.select(df_updated.columns)]).sort(on)
+    if checks:
+        return df_updated, issues
     return df_updated
 
 
@@ -179,21 +505,162 @@ def insert_new_records(target: pl.DataFrame,
 def run_end_to_end(target: pl.DataFrame,
                    source:pl.DataFrame,
                    id_col: str = 'fiscalDateEnding',
-                   update_time: datetime = datetime.now()) -> pl.DataFrame:
+                   update_time: datetime = datetime.now(),
+                   checks: bool = False) -> pl.DataFrame | tuple:
     """
-    Run the full end-to-end process
+    Run the full end-to-end process, with the flagged restatements when checks is True, see update_records
     """
     # check for new fields
     target = check_new_field(df_target=target, df_source=source, id_col=id_col)
     # check for removed fields
     source = check_removed_field(df_target=target, df_source=source)
     # update the records
-    target = update_records(target=target, source=source, on=id_col, update_time=update_time)
+    issues = None
+    if checks:
+        target, issues = update_records(target=target, source=source, on=id_col, update_time=update_time, checks=True)
+    else:
+        target = update_records(target=target, source=source, on=id_col, update_time=update_time)
     # insert new records
     target = insert_new_records(target=target, source=source, id_col=id_col, update_time=update_time)
+    if checks:
+        return target, issues
     return target
 
 
+def get_changed_ids(df: pl.DataFrame,
+                    update_time: datetime,
+                    id_col: str = 'fiscalDateEnding') -> list:
+    """
+    Get the ids of the current records that were inserted or updated at the given update time
+    Parameters:
+    df (pl.DataFrame): The slowly changing dimension type 2 data frame
+    update_time (datetime): The update time of the run that made the changes
+
+    Returns:
+    list: the ids that were changed in the run
+    """
+    return list(df.filter(pl.col("is_current") == True,
+                          pl.col("update_time") == update_time).select(id_col).to_series())
+
+
+def get_change_log(previous: pl.DataFrame | None,
+                   merged: pl.DataFrame,
+                   update_time: datetime,
+                   id_col: str = 'fiscalDateEnding') -> pl.DataFrame:
+    """
+    Get the records inserted or updated by a merge, with the fields that changed for the updated records
+    Parameters:
+    previous (pl.DataFrame): The current records of the target before the merge, None if it was initialized
+    merged (pl.DataFrame): The slowly changing dimension type 2 data frame after the merge
+    update_time (datetime): The update time of the merge
+
+    Returns:
+    pl.DataFrame: one row per changed id with the change type, insert or update, and the changed columns
+    """
+    changed = merged.filter(pl.col("is_current") == True,
+                            pl.col("update_time") == update_time).drop(["is_current", "update_time"])
+    if previous is None:
+        previous = changed.head(0)
+    fields = [x for x in changed.columns if x != id_col and x in previous.columns]
+    df = changed.select([id_col] + fields).join(
+        previous.select([id_col] + fields).with_columns(pl.lit(True).alias("_previous")),
+        on=id_col, how='left', suffix='_previous')
+    if len(fields) == 0:
+        changed_columns = pl.lit([], dtype=pl.List(pl.String))
+    else:
+        changed_columns = pl.concat_list(
+            pl.when(pl.col(x).ne_missing(pl.col(f"{x}_previous"))).then(pl.lit(x)) for x in fields
+        ).list.drop_nulls()
+    return df.select(
+        pl.col(id_col),
+        pl.when(pl.col("_previous")).then(pl.lit('update')).otherwise(pl.lit('insert')).alias('change_type'),
+        pl.when(pl.col("_previous")).then(changed_columns)
+        .otherwise(pl.lit([], dtype=pl.List(pl.String))).alias('changed_columns'),
+    ).sort(id_col)
+
+
+def compute_ttm(df: pl.DataFrame,
+                id_col: str = 'fiscalDateEnding',
+                window: int = 4) -> pl.DataFrame:
+    """
+    Compute the trailing twelve month sum and the year over year change for every numeric field
+    of a quarterly flow statement (income, cash). The TTM value is only filled in when the window
+    covers consecutive quarters, the year over year change is only filled in when the quarter a
+    year before is available.
+
+    Parameters
+    _________________
+    df: pl.DataFrame
+        the current quarterly records of the statement, one row per id
+    id_col: str
+        the fiscal period column
+    window: int
+        the number of quarters in the trailing window
+    :return:
+        pl.DataFrame with the id column and a {field}_ttm and {field}_yoy column per numeric field
+    """
+    df = df.sort(id_col)
+    value_cols = [x for x, dtype in df.schema.items() if dtype.is_numeric()]
+    period = pl.col(id_col).str.to_date(strict=False)
+    # consecutive quarters span ~273 days, the same quarter a year ago ~365 days
+    ttm_span = (period - period.shift(window - 1)).dt.total_days()
+    yoy_span = (period - period.shift(window)).dt.total_days()
+    ttm_valid = ttm_span.is_between(250, 300)
+    yoy_valid = yoy_span.is_between(350, 380)
+    return df.select(
+        pl.col(id_col),
+        *[pl.when(ttm_valid).then(pl.col(x).rolling_sum(window_size=window)).alias(f"{x}_ttm")
+          for x in value_cols],
+        *[pl.when(yoy_valid & (pl.col(x).shift(window) != 0))
+          .then(pl.col(x) / pl.col(x).shift(window) - 1).alias(f"{x}_yoy")
+          for x in value_cols]
+    )
+
+
+def update_ttm(ttm_target: pl.DataFrame | None,
+               statement: pl.DataFrame,
+               changed_ids: list,
+               id_col: str = 'fiscalDateEnding',
+               window: int = 4) -> pl.DataFrame:
+    """
+    Update the persisted TTM table of a statement, only recomputing the rolling windows that
+    contain one of the changed quarters
+
+    Parameters
+    _________________
+    ttm_target: pl.DataFrame
+        the persisted TTM table, None if it has not been initialized
+    statement: pl.DataFrame
+        the slowly changing dimension type 2 statement after the merge
+    changed_ids: list
+        the ids of the quarters that were inserted or updated
+    id_col: str
+        the fiscal period column
+    window: int
+        the number of quarters in the trailing window
+    :return:
+        pl.DataFrame the updated TTM table
+    """
+    current = statement.filter(pl.col("is_current") == True).drop(["is_current", "update_time"]).sort(id_col)
+    full_recompute = ttm_target is None or set(compute_ttm(current.head(0), id_col=id_col,
+                                                           window=window).columns) != set(ttm_target.columns)
+    if full_recompute:
+        return compute_ttm(current, id_col=id_col, window=window)
+    if len(changed_ids) == 0:
+        return ttm_target
+    ids = list(current.select(id_col).to_series())
+    changed_ids = set(changed_ids)
+    positions = [i for i, x in enumerate(ids) if x in changed_ids]
+    # a quarter is part of the next window - 1 TTM sums and the year over year change a window later
+    affected = sorted({x for p in positions for x in range(p, min(p + window + 1, len(ids)))})
+    start = max(affected[0] - window, 0)
+    affected_ids = [ids[i] for i in affected]
+    recomputed = (compute_ttm(current.slice(start, affected[-1] - start + 1), id_col=id_col, window=window)
+                  .filter(pl.col(id_col).is_in(affected_ids)))
+    ttm_target = ttm_target.filter(~pl.col(id_col).is_in(affected_ids))
+    return pl.concat([ttm_target, recomputed.select(ttm_target.columns)]).sort(id_col)
+
+
 def list_local_files(file_path: str) -> list[str]:
     """
     List all the files in a local directory and return a list of files
@@ -201,6 +668,100 @@ def list_local_files(file_path: str) -> list[str]:
     return [f"{file_path}/{x}" for x in os.listdir(file_path) if x.endswith(".csv") or x.endswith(".parq")]
 
 
+def fingerprint_files(file_paths: list[str]) -> str:
+    """
+    Fingerprint a set of local files using the file names and content, the order
+    of the list does not change the fingerprint
+    """
+    sha = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        sha.update(os.path.basename(file_path).encode())
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def find_changed_records(target: pl.DataFrame,
+                         source: pl.DataFrame,
+                         id_col: str) -> pl.DataFrame:
+    """
+    Find the records in the source data frame that are new or differ from the target data frame
+    by joining on the id and a hash of the row instead of sorting and comparing the full frames
+    Parameters:
+    target (pl.DataFrame): The current records of the target data frame
+    source (pl.DataFrame): The source data frame
+
+    Returns:
+    pl.DataFrame: the source records that are new or changed, the full source when the target
+    is missing any of the source fields
+    """
+    if any(x not in target.columns for x in source.columns):
+        return source
+    # hash the source using the target types so the same values give the same hash
+    row_hash = pl.struct([pl.col(x).cast(target.schema[x]) for x in source.columns]).hash().alias("_row_hash")
+    target_hashes = target.select(pl.col(id_col).cast(source.schema[id_col]), row_hash)
+    return (source.with_columns(row_hash)
+            .join(target_hashes, on=[id_col, "_row_hash"], how="anti")
+            .drop("_row_hash"))
+
+
+def select_due_tickers(queue: pl.DataFrame,
+                       last_periods: pl.DataFrame,
+                       calendar: pl.DataFrame,
+                       today: date,
+                       report_lag_days: int = 1,
+                       overdue_days: int = 135,
+                       recheck_days: int = 30) -> list[str]:
+    """
+    Select the tickers of the queue whose statements are expected to have changed since they were stored.
+    A ticker is due when
+        - reported: the earnings calendar has a report for a fiscal period after the last stored one
+          that is at least report_lag_days old and was reported since the last download. A ticker whose
+          statements lag the calendar is downloaded again once it was not downloaded in the last recheck_days
+        - new: no statements are stored yet
+        - overdue: the last stored period is older than overdue_days and the ticker was not
+          downloaded in the last recheck_days, catching tickers missing from the calendar
+    Parameters
+    _________________
+    queue: pl.DataFrame
+        the ticker queue with the Symbol and Download_time columns
+    last_periods: pl.DataFrame
+        the Symbol and the last stored fiscalDateEnding, last_period, of each ticker
+    calendar: pl.DataFrame
+        the earnings calendar with the Symbol, reportDate and fiscalDateEnding columns
+    today: date
+        the date of the run
+    :return:
+        the due tickers, reported first then new then overdue, each ordered by Download_time
+    """
+    reported = (calendar
+                .with_columns(pl.col('reportDate').str.to_date(strict=False),
+                              pl.col('fiscalDateEnding').str.to_date(strict=False))
+                .filter(pl.col('reportDate') <= pl.lit(today) - pl.duration(days=report_lag_days))
+                .group_by('Symbol')
+                .agg(pl.col('fiscalDateEnding').max().alias('last_reported'),
+                     pl.col('reportDate').max().alias('last_report_date')))
+    df = (queue.select('Symbol', 'Download_time')
+          .join(last_periods.with_columns(pl.col('last_period').str.to_date(strict=False)), on='Symbol', how='left')
+          .join(reported, on='Symbol', how='left'))
+    days_since_period = (pl.lit(today) - pl.col('last_period')).dt.total_days()
+    days_since_download = (pl.lit(today) - pl.col('Download_time').dt.date()).dt.total_days()
+    reported_since_download = (pl.col('Download_time').is_null()
+                               | (pl.col('last_report_date') >= pl.col('Download_time').dt.date())
+                               | (days_since_download > recheck_days))
+    df = df.with_columns(
+        priority=pl.when((pl.col('last_reported') > pl.col('last_period')) & reported_since_download).then(pl.lit(0))
+        .when(pl.col('last_period').is_null()).then(pl.lit(1))
+        .when((days_since_period > overdue_days)
+              & (pl.col('Download_time').is_null() | (days_since_download > recheck_days))).then(pl.lit(2))
+        .otherwise(pl.lit(None))
+    )
+    return list(df.filter(pl.col('priority').is_not_null())
+                .sort(['priority', 'Download_time'], nulls_last=False)
+                .select('Symbol').to_series())
+
+
 def get_bucket_name() -> str:
     """
     Get the bucket name
@@ -215,7 +776,8 @@ def get_profile_name() -> str:
     return os.environ["S3_PROFILE"]
 
 
-
-
-
-
+def get_local_store_dir() -> str | None:
+    """
+    Get the directory of the local store, None when the data is stored in s3
+    """
+    return os.environ.get("LOCAL_STORE_DIR")
@@ -1,10 +1,46 @@
-import requests
+import io
+import time
+import uuid
 import polars as pl
 import logging
-from datetime import datetime
-from alpha_utils import (get_alpha_key, parse_data, run_end_to_end,
-                         get_bucket_name, get_profile_name)
-from s3io import S3IO
+from datetime import datetime, date
+from alpha_utils import (get_alpha_key, parse_data, run_end_to_end, get_changed_ids,
+                         compute_ttm, update_ttm, parse_prices, parse_dividends, parse_splits, get_change_log,
+                         classify_response, throttle_backoff, TRANSIENT_STATUSES)
+from s3io import S3IO, ConditionalWriteError
+from localio import get_store
+from clients import get_http_session, RateLimiter, ApiKeyPool
+from manifest import MANIFEST_PATH, get_last_period
+from schema_registry import SchemaRegistry
+from categories import CategoryDictionary
+from rollups import SectorRollup, ROLLUP_STATEMENT
+
+# flow statements that are persisted with trailing twelve month aggregates
+TTM_STATEMENTS = ['income', 'cash']
+# parquet write profile of the statement tables, see s3io.WRITE_PROFILES
+STATEMENT_WRITE_PROFILE = 'scan-optimized'
+# the compact daily series holds the latest 100 trading days, stored histories older than this many
+# calendar days need the full series to close the gap
+COMPACT_WINDOW_DAYS = 130
+# the statements retrieved for every ticker
+STATEMENTS = ['income', 'balance', 'cash']
+# a throttled request is retried this many times, on another key when a key pool is used
+THROTTLE_RETRIES = 3
+# the longest a request waits for a throttled key, the ticker is retried by a later run otherwise
+THROTTLE_MAX_WAIT_SECONDS = 300
+# prefix of the change log, one partition of the records inserted or updated by every run
+CHANGES_PATH = "changes"
+# prefix of the data quality report, one partition of the values flagged by every run
+QUALITY_PATH = "quality"
+# prefix of the retrieved statements that were not stored because they failed a check
+QUARANTINE_PATH = "quarantine"
+# the checks of parse_data and update_records that quarantine the statement of a ticker, the others are reported
+QUARANTINE_CHECKS = ['unit_change', 'zeroed_quarter', 'out_of_range']
+# the fields whose flagged values quarantine the statement, the values of the other line items are reported
+QUARANTINE_FIELDS = ['totalRevenue', 'grossProfit', 'operatingIncome', 'netIncome', 'totalAssets',
+                     'totalLiabilities', 'totalShareholderEquity', 'operatingCashflow', 'capitalExpenditures']
+# the corporate actions stored in {action}/{ticker}/{action}.parq with the function and parser of the API
+CORPORATE_ACTIONS = {'dividends': ('DIVIDENDS', parse_dividends), 'splits': ('SPLITS', parse_splits)}
 
 
 class AlphaIO:
@@ -13,30 +49,149 @@ class AlphaIO:
 
     - pull fundamental data
     - pull profiles for ETFs
-    - pull corporate actions for dividends
+    - pull corporate actions, dividends and splits
     """
-    def __init__(self, tickers: any):
+    def __init__(self, tickers: any,
+                 checkpoint_path: str | None = None,
+                 completed: dict[str: bool] | None = None,
+                 s3: S3IO | None = None,
+                 run_id: str | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 key_pool: ApiKeyPool | None = None,
+                 quarantine_checks: list[str] | None = QUARANTINE_CHECKS,
+                 quarantine_fields: list[str] | None = QUARANTINE_FIELDS):
         """
         Initialize the AlphaIO class
+
+        tickers: list[str]
+            the tickers to retrieve the data for
+        checkpoint_path: str
+            s3 path of the checkpoint recording the progress of the batch, the checkpoint is
+            written after every ticker so a failed run can be resumed
+        completed: dict[str: bool]
+            the tickers completed by a previous run of the same batch, these are not requested again
+        s3: S3IO
+            the s3 object to share with the caller, a new one with the manifest catalog is created if None
+        run_id: str
+            the id of the run partitioning the change log, passed when a batch is resumed so its changes
+            stay in one partition
+        rate_limiter: RateLimiter
+            optional limiter pacing the requests to the API
+        key_pool: ApiKeyPool
+            optional pool of the api keys, throttled requests are retried on the key available the soonest
+            instead of waiting for the throttled key
+        quarantine_checks: list[str]
+            the data quality checks that keep a retrieved statement out of the stored statements, it is written
+            to the quarantine instead. None to only report the flagged values
+        quarantine_fields: list[str]
+            the fields the quarantine checks apply to, the checks of the whole quarter always apply. None for
+            all the fields
         """
         self.BASE_URL = 'https://www.alphavantage.co/query?function='
         self.request_count = 0
         self.tickers = tickers
-        # get bucket name
-        bucket = get_bucket_name()
-        profile = get_profile_name()
-        self.s3 = S3IO(bucket=bucket, profile=profile)
-        self.ticker_tracking_dict = {}
+        if s3 is None:
+            # the s3 bucket or the local directory store
+            s3 = get_store(manifest_path=MANIFEST_PATH)
+        self.s3 = s3
+        self.schemas = SchemaRegistry(s3=self.s3)
+        self.categories = CategoryDictionary(s3=self.s3)
+        self.rollups = SectorRollup(s3=self.s3, categories=self.categories)
+        self.checkpoint_path = checkpoint_path
+        self.ticker_tracking_dict = dict(completed) if completed else {}
+        self.run_id = run_id if run_id is not None else f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.changes = []
+        self.changes_written = True
+        self.rate_limiter = rate_limiter
+        self.key_pool = key_pool
+        # the status of the last response of every statement of the tickers, see classify_response
+        self.response_status = {}
+        self.quarantine_checks = quarantine_checks
+        self.quarantine_fields = quarantine_fields
+        # the statements released from the quarantine, their checks are reported without quarantining them
+        self.released = set()
+        self.quality = []
+        self.quality_written = True
 
-    def _alpha_request(self, ticker: str, statement: str, api_key:str) -> dict:
+    def _alpha_request(self, ticker: str, statement: str, api_key:str, **params) -> dict:
         """
-        Make a request to the AlphaVantage API
+        Make a request to the AlphaVantage API, extra keyword arguments are passed as query parameters
         """
         request_url = f'{self.BASE_URL}{statement}&symbol={ticker}&apikey={api_key}'
-        r = requests.get(request_url)
+        for key, value in params.items():
+            request_url += f'&{key}={value}'
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        r = get_http_session().get(request_url)
         data = r.json()
         return data
 
+    def _fetch(self, ticker: str, function: str, api_key: str,
+               keys: tuple = ('quarterlyReports', 'annualReports'), **params) -> tuple[str, dict | None]:
+        """
+        Make a request and classify the response, throttled requests are retried after the backoff of the
+        throttled key or on another key of the pool. Returns the status and the response
+
+        ticker: str
+            the ticker of the request
+        function: str
+            the function of the API
+        api_key: str
+            the api key of the request, the preferred key when a key pool is used
+        keys: tuple
+            the keys of the response holding the data, see classify_response
+        """
+        data = None
+        for _ in range(THROTTLE_RETRIES + 1):
+            if self.key_pool is not None:
+                api_key = self.key_pool.acquire(preferred=api_key, max_wait=THROTTLE_MAX_WAIT_SECONDS)
+                if api_key is None:
+                    logging.warning(f"All api keys are throttled, {function} for {ticker} is left for a later run")
+                    return 'throttled', data
+            try:
+                data = self._alpha_request(ticker=ticker, statement=function, api_key=api_key, **params)
+                self.request_count += 1
+            except Exception as e:
+                logging.warning(f"Request {function} for {ticker} failed\n{e}")
+                return 'error', None
+            status = classify_response(data, keys=keys)
+            if status == 'invalid':
+                logging.warning(f"Request {function} for {ticker} was rejected: {data}")
+            if status != 'throttled':
+                return status, data
+            backoff = throttle_backoff(data)
+            logging.warning(f"Request {function} for {ticker} was throttled: {data}")
+            if self.key_pool is not None:
+                self.key_pool.throttled(api_key, backoff)
+            elif backoff <= THROTTLE_MAX_WAIT_SECONDS:
+                time.sleep(backoff)
+            else:
+                break
+        return 'throttled', data
+
+    def get_earnings_calendar(self, api_key: str, horizon: str = '3month') -> pl.DataFrame | None:
+        """
+        Get the bulk earnings calendar of the expected reports for all the tickers
+
+        api_key: str
+            the api key used for the request
+        horizon: str
+            3month, 6month or 12month
+        """
+        request_url = f'{self.BASE_URL}EARNINGS_CALENDAR&horizon={horizon}&apikey={api_key}'
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            r = get_http_session().get(request_url)
+            self.request_count += 1
+            df = pl.read_csv(io.BytesIO(r.content), infer_schema=False)
+            df = df.select(pl.col('symbol').alias('Symbol'), 'reportDate', 'fiscalDateEnding')
+            logging.info(f"earnings calendar retrieved with {df.height} reports")
+            return df
+        except Exception as e:
+            logging.warning(f"Could not load the earnings calendar from Alpha Vantage\n{e}")
+            return None
+
     def get_statement(self, ticker: str,
                       api_key: str,
                       statement: str | list) -> dict[str: pl.DataFrame]:
@@ -59,33 +214,32 @@ class AlphaIO:
             'cash': 'CASH_FLOW'
         }
         financials = {}
-        if isinstance(statement, list):
-
-            for financial_statement in statement:
-                try:
-                    data = self._alpha_request(ticker=ticker, statement=statement_dict[financial_statement], api_key=api_key)
-                    logging.info(f"data retrieved for {ticker}")
-                    # parse the data
-                    try:
-                        df = parse_data(data=data['quarterlyReports'], str_cols=['fiscalDateEnding', 'reportedCurrency'])
-                    except Exception as e:
-                        logging.warning(f"{ticker} has no quarterly reports, persisting annual report data")
-                        df = parse_data(data=data['annualReports'],
-                                        str_cols=['fiscalDateEnding', 'reportedCurrency'])
-                    financials[financial_statement] = df
-                    self.request_count += 1
-                except Exception as e:
-                    logging.warning(f"Could not load data from Alpha Vantage for {ticker}\n{e}")
-                    financials[financial_statement] = None
-        else:
+        statuses = self.response_status.setdefault(ticker, {})
+        for financial_statement in (statement if isinstance(statement, list) else [statement]):
+            financials[financial_statement] = None
+            status, data = self._fetch(ticker=ticker, function=statement_dict[financial_statement], api_key=api_key)
+            statuses[financial_statement] = status
+            if status != 'ok':
+                logging.warning(f"Could not load {financial_statement} data from Alpha Vantage for {ticker}: {status}")
+                continue
+            logging.info(f"data retrieved for {ticker}")
             try:
-                data = self._alpha_request(ticker=ticker, statement=statement, api_key=api_key)
-                df = parse_data(data=data[0]['quarterlyReports'], str_cols=['fiscalDateEnding', 'reportedCurrency'])
-                financials[statement] = df
-                self.request_count += 1
+                # parse the data
+                if data.get('quarterlyReports'):
+                    df, issues = parse_data(data=data['quarterlyReports'],
+                                            str_cols=['fiscalDateEnding', 'reportedCurrency'], checks=True)
+                else:
+                    logging.warning(f"{ticker} has no quarterly reports, persisting annual report data")
+                    df, issues = parse_data(data=data['annualReports'],
+                                            str_cols=['fiscalDateEnding', 'reportedCurrency'], checks=True)
+                if self.record_quality(ticker=ticker, statement=financial_statement, stage='parse', issues=issues):
+                    self.quarantine(ticker=ticker, statement=financial_statement, df=df)
+                    statuses[financial_statement] = 'quarantined'
+                    continue
+                financials[financial_statement] = self.schemas.conform(statement=financial_statement, df=df)
             except Exception as e:
-                logging.warning(f"Could not load data from Alpha Vantage for {ticker}\n{e}")
-                financials[statement] = None
+                logging.warning(f"Could not parse {financial_statement} data from Alpha Vantage for {ticker}\n{e}")
+                statuses[financial_statement] = 'invalid'
         return financials
 
     def get_target_data(self, ticker: str) -> dict[str: pl.DataFrame]:
@@ -95,10 +249,24 @@ class AlphaIO:
         get the target data for the ticker
         """
         financials = {}
-        statements = ["cash", "income", "balance"]
+        statements = STATEMENTS
         for statement in statements:
+            file_path = f"{statement}/{ticker}/{statement}.parq"
+            # the manifest answers the existence check without a failed request, a table written through a store
+            # without the manifest is not listed in it, so a miss is confirmed with the object store
+            missing = not self.s3.s3_exists(file_path=file_path)
+            head = self.s3._head_object(file_path=file_path) if missing and self.s3.manifest is not None else None
+            if missing and head is None:
+                logging.info(f"Missing data for statement {statement} for ticker {ticker}, initializing ...")
+                financials[statement] = None
+                continue
             try:
-                df_statement = self.s3.s3_read_parquet(file_path=f"{statement}/{ticker}/{statement}.parq")
+                df_statement = self.s3.s3_read_parquet(file_path=file_path)
+                if head is not None:
+                    logging.warning(f"{file_path} is missing from the manifest, adding it")
+                    self.s3.manifest.record(key=file_path, size=head['size'], etag=head['etag'],
+                                            row_count=df_statement.height,
+                                            last_fiscal_period=get_last_period(df_statement))
                 financials[statement] = df_statement
             except Exception as e:
                 logging.warning(f"Missing data for statement {statement} for ticker {ticker}, initializing ...\n{e}")
@@ -106,6 +274,61 @@ class AlphaIO:
 
         return financials
 
+    def get_ttm_data(self, ticker: str, statement: str) -> pl.DataFrame | None:
+        """
+        get the persisted trailing twelve month table for the ticker statement
+
+        ticker: str
+            the name of the ticker, the symbol
+        statement: str
+            the flow statement, income or cash
+        """
+        if not self.s3.s3_exists(file_path=f"{statement}/{ticker}/{statement}_ttm.parq"):
+            logging.info(f"Missing ttm data for statement {statement} for ticker {ticker}, initializing ...")
+            return None
+        try:
+            return self.s3.s3_read_parquet(file_path=f"{statement}/{ticker}/{statement}_ttm.parq")
+        except Exception as e:
+            logging.warning(f"Missing ttm data for statement {statement} for ticker {ticker}, initializing ...\n{e}")
+            return None
+
+    def write_ttm_data(self,
+                       ticker: str,
+                       statement: str,
+                       target: pl.DataFrame,
+                       update_time: datetime | None = None) -> None:
+        """
+        update the trailing twelve month table next to the statement and write to s3. When the
+        update time is passed only the rolling windows of the quarters changed at that time are recomputed
+
+        ticker: str
+            ticker symbol
+
+        statement: str
+            the flow statement, income or cash
+
+        target: pl.DataFrame
+            the merged statement data frame that was written to s3
+
+        update_time: datetime
+            the update time of the merge, None when the statement was initialized
+        """
+        if update_time is None:
+            current = target.filter(pl.col("is_current") == True).drop(["is_current", "update_time"])
+            df_ttm = compute_ttm(current)
+        else:
+            changed_ids = get_changed_ids(target, update_time=update_time)
+            ttm_target = self.get_ttm_data(ticker=ticker, statement=statement)
+            # fields new to the statement are recomputed for all quarters even if no quarter changed
+            df_ttm = update_ttm(ttm_target=ttm_target,
+                                statement=target,
+                                changed_ids=changed_ids)
+            if df_ttm is ttm_target:
+                logging.info(f"No quarters changed, skipping ttm update for {ticker}: {statement}")
+                return
+        self.s3.s3_write_parquet(df=df_ttm, file_path=f"{statement}/{ticker}/{statement}_ttm.parq",
+                                 write_profile=STATEMENT_WRITE_PROFILE)
+
     def write_data(self,
                    ticker: str,
                    target_financials: dict[str: pl.DataFrame],
@@ -123,14 +346,16 @@ class AlphaIO:
         source_financials: dict[str: pl.DataFrame]
             dictionary of source data frames
         """
+        results = []
         for statement in target_financials.keys():
             # check if the source financial is None
             if source_financials[statement] is None:
-                logging.warning(f"source data missing, skipping {ticker}: {statement}")
-                self.ticker_tracking_dict[ticker] = False
+                results.append(self._missing_result(ticker=ticker, statement=statement))
                 continue
+            # an initialized statement is only written when no other writer created it in the meantime
+            initialize = target_financials[statement] is None
             # check if the target financial is null
-            if target_financials[statement] is None:
+            if initialize:
                 logging.warning(f"Missing target, initializing the {statement} statements for {ticker}")
                 update_time = datetime.now()
                 target_financials[statement] = source_financials[statement]
@@ -139,55 +364,502 @@ class AlphaIO:
                         pl.lit(True).alias("is_current"),
                         pl.lit(update_time).alias("update_time")
                     )
-                self.ticker_tracking_dict[ticker] = True
+                # nothing to update incrementally, the ttm table is computed from scratch
+                ttm_update_time = None
+                self.record_changes(ticker=ticker, statement=statement, previous=None,
+                                    merged=target_financials[statement], update_time=update_time)
             else:
                 # run the end to end
+                update_time = datetime.now()
                 target_tmp = target_financials[statement].filter(pl.col("is_current") == True)
-                target_financials[statement] = run_end_to_end(target=target_tmp,
-                                                              source=source_financials[statement],
-                                                              id_col='fiscalDateEnding')
-                self.ticker_tracking_dict[ticker] = True
+                merged, issues = run_end_to_end(target=target_tmp,
+                                                source=source_financials[statement],
+                                                id_col='fiscalDateEnding',
+                                                update_time=update_time,
+                                                checks=True)
+                if self.record_quality(ticker=ticker, statement=statement, stage='merge', issues=issues):
+                    # the stored statement is left as it is, the ticker is held until the statement is released
+                    self.quarantine(ticker=ticker, statement=statement, df=source_financials[statement])
+                    self.response_status.setdefault(ticker, {})[statement] = 'quarantined'
+                    results.append(None)
+                    continue
+                # the merge runs on the current records, the superseded versions are kept for point in time reads
+                history = target_financials[statement].filter(pl.col("is_current") == False)
+                target_financials[statement] = pl.concat([history, merged], how='diagonal_relaxed').sort(
+                    'fiscalDateEnding', 'update_time')
+                ttm_update_time = update_time
+                self.record_changes(ticker=ticker, statement=statement, previous=target_tmp,
+                                    merged=target_financials[statement], update_time=update_time)
+            # every stored file of the statement shares the canonical schema
+            target_financials[statement] = self.schemas.conform(statement=statement, df=target_financials[statement])
+            # the currencies are encoded with the category dictionary when the statements are read
+            self.categories.register(target_financials[statement])
             # write the data to s3 in specified location
-            self.s3.s3_write_parquet(df=target_financials[statement],
-                                     file_path=f"{statement}/{ticker}/{statement}.parq")
+            try:
+                self.s3.s3_write_parquet(df=target_financials[statement],
+                                         file_path=f"{statement}/{ticker}/{statement}.parq",
+                                         metadata={'schema-version': str(self.schemas.version(statement))},
+                                         write_profile=STATEMENT_WRITE_PROFILE, if_none_match=initialize)
+            except ConditionalWriteError:
+                # the stored history is kept, the ticker is merged into it by a later run
+                logging.warning(f"{statement} of {ticker} was created by another writer, skipping ...")
+                results.append(None)
+                continue
+            # keep the trailing twelve month aggregates of the flow statements in sync
+            if statement in TTM_STATEMENTS:
+                self.write_ttm_data(ticker=ticker,
+                                    statement=statement,
+                                    target=target_financials[statement],
+                                    update_time=ttm_update_time)
+            # the sector and industry rollups are updated with the statements of the run on persist
+            if statement == ROLLUP_STATEMENT:
+                self.rollups.add(ticker=ticker, statement=target_financials[statement])
+            results.append(True)
+        self.ticker_tracking_dict[ticker] = self._ticker_result(results)
+
+    def _missing_result(self, ticker: str, statement: str) -> bool | None:
+        """
+        the result of a statement that could not be retrieved, None when the request failed transiently
+        """
+        status = self.response_status.get(ticker, {}).get(statement)
+        logging.warning(f"source data missing ({status}), skipping {ticker}: {statement}")
+        # throttled or failed requests say nothing about the ticker, it is retried by a later run. A quarantined
+        # statement holds the ticker until it is released, see release_quarantine
+        return None if status in TRANSIENT_STATUSES or status == 'quarantined' else False
+
+    @staticmethod
+    def _ticker_result(results: list[bool | None]) -> bool | None:
+        """
+        True when the statements were stored, None when a transient failure leaves the ticker for a later run
+        and False when none of the statements could be retrieved
+        """
+        if None in results:
+            return None
+        return True in results
+
+    def initial_tables(self,
+                       ticker: str,
+                       source_financials: dict[str: pl.DataFrame],
+                       update_time: datetime) -> dict[str: pl.DataFrame]:
+        """
+        build the tables of a ticker without stored history. Every record is an insert, so no target is read
+        and no merge is run. Returns the statement and trailing twelve month tables by s3 path
+
+        ticker: str
+            ticker symbol
+        source_financials: dict[str: pl.DataFrame]
+            dictionary of source data frames
+        update_time: datetime
+            the update time of the records
+        """
+        tables = {}
+        results = []
+        for statement, df in source_financials.items():
+            if df is None:
+                results.append(self._missing_result(ticker=ticker, statement=statement))
+                continue
+            df = df.with_columns(pl.lit(True).alias("is_current"), pl.lit(update_time).alias("update_time"))
+            self.record_changes(ticker=ticker, statement=statement, previous=None, merged=df,
+                                update_time=update_time)
+            df = self.schemas.conform(statement=statement, df=df)
+            self.categories.register(df)
+            tables[f"{statement}/{ticker}/{statement}.parq"] = df
+            if statement in TTM_STATEMENTS:
+                tables[f"{statement}/{ticker}/{statement}_ttm.parq"] = compute_ttm(
+                    df.drop(["is_current", "update_time"]))
+            if statement == ROLLUP_STATEMENT:
+                self.rollups.add(ticker=ticker, statement=df)
+            results.append(True)
+        self.ticker_tracking_dict[ticker] = self._ticker_result(results)
+        return tables
+
+    def record_changes(self,
+                       ticker: str,
+                       statement: str,
+                       previous: pl.DataFrame | None,
+                       merged: pl.DataFrame,
+                       update_time: datetime) -> None:
+        """
+        add the records inserted or updated by the merge of a statement to the change log of the run
+
+        ticker: str
+            ticker symbol
+        statement: str
+            the statement that was merged
+        previous: pl.DataFrame
+            the current records before the merge, None when the statement was initialized
+        merged: pl.DataFrame
+            the merged statement data frame
+        update_time: datetime
+            the update time of the merge
+        """
+        df = get_change_log(previous=previous, merged=merged, update_time=update_time)
+        if df.height == 0:
+            return
+        self.changes.append(df.select(
+            pl.lit(self.run_id).alias('run_id'),
+            pl.lit(ticker).alias('Symbol'),
+            pl.lit(statement).alias('statement'),
+            pl.all(),
+            pl.lit(update_time).alias('update_time'),
+        ))
+        # the symbols of the change log are encoded with the category dictionary when it is queried
+        self.categories.register(self.changes[-1].select('Symbol'))
+        self.changes_written = False
+
+    def record_quality(self, ticker: str, statement: str, stage: str, issues: pl.DataFrame | None) -> bool:
+        """
+        add the values flagged by the data quality checks to the quality report of the run, returns True when
+        one of the quarantine checks failed
+
+        ticker: str
+            ticker symbol
+        statement: str
+            the checked statement
+        stage: str
+            parse for the checks of the retrieved statement, merge for the checks of the restated records
+        issues: pl.DataFrame
+            the flagged values, see alpha_utils.parse_data
+        """
+        if issues is None or issues.height == 0:
+            return False
+        quarantined = False
+        if self.quarantine_checks is not None and (ticker, statement) not in self.released:
+            flagged = pl.col('check').is_in(self.quarantine_checks)
+            if self.quarantine_fields is not None:
+                flagged = flagged & (pl.col('field').is_null() | pl.col('field').is_in(self.quarantine_fields))
+            quarantined = issues.select(flagged.any()).item()
+        self.quality.append(issues.select(
+            pl.lit(self.run_id).alias('run_id'),
+            pl.lit(ticker).alias('Symbol'),
+            pl.lit(statement).alias('statement'),
+            pl.lit(stage).alias('stage'),
+            pl.all(),
+            pl.lit(quarantined).alias('quarantined'),
+        ))
+        self.categories.register(self.quality[-1].select('Symbol'))
+        self.quality_written = False
+        logging.warning(f"{issues.height} values of {ticker}: {statement} failed the {stage} checks "
+                        f"{issues['check'].unique().to_list()}{', quarantining' if quarantined else ''}")
+        return quarantined
+
+    def quarantine(self, ticker: str, statement: str, df: pl.DataFrame) -> None:
+        """
+        write a retrieved statement that failed a check to the quarantine instead of the stored statements
+        """
+        self.s3.s3_write_parquet(df=df, file_path=f"{QUARANTINE_PATH}/{statement}/{ticker}/run_id={self.run_id}.parq",
+                                 write_profile='small-hot')
+
+    def release_quarantine(self, ticker: str, statement: str) -> bool:
+        """
+        merge the latest quarantined statement of a ticker into the stored statement once it was reviewed, the
+        flagged values are reported without quarantining it again. The quarantined copies are deleted. Returns
+        True when the statement was stored
+
+        ticker: str
+            ticker symbol
+        statement: str
+            the quarantined statement
+        """
+        keys = sorted(x for x in self.s3.s3_list(path=f"{QUARANTINE_PATH}/{statement}/{ticker}/")
+                      if x.endswith('.parq'))
+        if len(keys) == 0:
+            logging.warning(f"No quarantined {statement} statement of {ticker}")
+            return False
+        # the run ids start with the time of the run, the last key is the latest retrieval
+        source = self.schemas.conform(statement=statement, df=self.s3.s3_read_parquet(file_path=keys[-1]))
+        self.released.add((ticker, statement))
+        try:
+            self.write_data(ticker=ticker,
+                            target_financials={statement: self.get_target_data(ticker=ticker)[statement]},
+                            source_financials={statement: source})
+        finally:
+            self.released.discard((ticker, statement))
+        for key in keys:
+            self.s3.s3_delete(file_path=key)
+        logging.info(f"Released the quarantined {statement} statement of {ticker} from {keys[-1]}")
+        return self.ticker_tracking_dict[ticker] is True
+
+    def _quality_report_path(self) -> str:
+        return f"{QUALITY_PATH}/run_id={self.run_id}/report.parq"
+
+    def write_quality_report(self) -> None:
+        """
+        write the quality report of the run to s3, the partition of the run is rewritten with all its flagged values
+        """
+        if self.quality_written:
+            return
+        self.quality = [pl.concat(self.quality)]
+        self.s3.s3_write_parquet(df=self.quality[0], file_path=self._quality_report_path(), write_profile='small-hot')
+        self.quality_written = True
+
+    def _change_log_path(self) -> str:
+        return f"{CHANGES_PATH}/run_id={self.run_id}/changes.parq"
+
+    def write_change_log(self) -> None:
+        """
+        write the change log of the run to s3, the partition of the run is rewritten with all its changes
+        """
+        if self.changes_written:
+            return
+        self.changes = [pl.concat(self.changes)]
+        self.s3.s3_write_parquet(df=self.changes[0], file_path=self._change_log_path(), write_profile='small-hot')
+        self.changes_written = True
+
+    def get_prices(self, ticker: str, api_key: str, outputsize: str = 'compact') -> pl.DataFrame | None:
+        """
+        Get the daily price series for a given ticker
+
+        ticker: str
+            the ticker to get the prices for
+        api_key: str
+            the api key used for the request
+        outputsize: str
+            compact for the latest 100 trading days, full for the full history
+        """
+        ticker = ticker.upper()
+        status, data = self._fetch(ticker=ticker, function='TIME_SERIES_DAILY', api_key=api_key,
+                                   keys=('Time Series (Daily)',), outputsize=outputsize)
+        if status != 'ok':
+            logging.warning(f"Could not load prices from Alpha Vantage for {ticker}: {status}")
+            return None
+        try:
+            df = parse_prices(data=data['Time Series (Daily)'], ticker=ticker)
+            logging.info(f"{outputsize} prices retrieved for {ticker}")
+            return df
+        except Exception as e:
+            logging.warning(f"Could not load prices from Alpha Vantage for {ticker}\n{e}")
+            return None
+
+    def get_last_price_date(self, ticker: str) -> date | None:
+        """
+        Get the date of the last stored bar of the ticker from the manifest, None if no prices are stored
+        """
+        if self.s3.manifest is None:
+            # without the manifest the last bar is read from the latest yearly partition
+            keys = sorted(x for x in self.s3.s3_list(path=f"prices/{ticker}/") if x.endswith('.parq'))
+            if len(keys) == 0:
+                return None
+            return self.s3.s3_read_parquet(file_path=keys[-1], columns=['date'])['date'].max()
+        last_dates = [self.s3.manifest.last_fiscal_period(x) for x in self.s3.manifest.list(prefix=f"prices/{ticker}/")]
+        last_dates = [x for x in last_dates if x is not None]
+        if len(last_dates) == 0:
+            return None
+        return date.fromisoformat(max(last_dates))
+
+    def write_prices(self, ticker: str, df_prices: pl.DataFrame) -> None:
+        """
+        append new bars to the price history of the ticker. The history is partitioned by year in
+        prices/{ticker}/{year}.parq so only the partitions receiving new bars are rewritten
+
+        ticker: str
+            ticker symbol
+        df_prices: pl.DataFrame
+            the new bars, dates already stored are replaced
+        """
+        for (year,), df_year in df_prices.group_by(pl.col('date').dt.year()):
+            file_path = f"prices/{ticker}/{year}.parq"
+            if self.s3.s3_exists(file_path=file_path):
+                df_stored = self.s3.s3_read_parquet(file_path=file_path)
+                df_year = pl.concat([df_stored.join(df_year.select('date'), on='date', how='anti'),
+                                     df_year.select(df_stored.columns)])
+            self.categories.register(df_year)
+            self.s3.s3_write_parquet(df=df_year.sort('date'), file_path=file_path,
+                                     write_profile=STATEMENT_WRITE_PROFILE)
+
+    def update_prices(self, ticker: str, api_key: str) -> bool:
+        """
+        update the stored price history of the ticker. The compact series is requested when the stored
+        history is recent enough, the full series for new tickers or when the compact series leaves a gap
+        """
+        last_date = self.get_last_price_date(ticker=ticker)
+        if last_date is None or (date.today() - last_date).days > COMPACT_WINDOW_DAYS:
+            df_prices = self.get_prices(ticker=ticker, api_key=api_key, outputsize='full')
+        else:
+            df_prices = self.get_prices(ticker=ticker, api_key=api_key, outputsize='compact')
+            if df_prices is not None and df_prices.height > 0 and df_prices.select(pl.col('date').min()).item() > last_date:
+                logging.warning(f"compact prices leave a gap after {last_date} for {ticker}, requesting the full series")
+                df_prices = self.get_prices(ticker=ticker, api_key=api_key, outputsize='full')
+        if df_prices is None:
+            return False
+        if last_date is not None:
+            df_prices = df_prices.filter(pl.col('date') > last_date)
+        if df_prices.height == 0:
+            logging.info(f"No new bars for {ticker}")
+            return True
+        logging.info(f"Appending {df_prices.height} bars for {ticker}")
+        self.write_prices(ticker=ticker, df_prices=df_prices)
+        return True
+
+    def get_corporate_actions(self, ticker: str, api_key: str, action: str) -> pl.DataFrame | None:
+        """
+        Get the full history of the dividends or splits of a ticker, an empty frame when it has none
+
+        ticker: str
+            the ticker to get the events for
+        api_key: str
+            the api key used for the request
+        action: str
+            dividends or splits
+        """
+        ticker = ticker.upper()
+        function, parser = CORPORATE_ACTIONS[action]
+        status, data = self._fetch(ticker=ticker, function=function, api_key=api_key, keys=('data',))
+        if status not in ('ok', 'empty'):
+            logging.warning(f"Could not load {action} from Alpha Vantage for {ticker}: {status}")
+            return None
+        try:
+            return parser(data=(data or {}).get('data') or [], ticker=ticker)
+        except Exception as e:
+            logging.warning(f"Could not parse {action} from Alpha Vantage for {ticker}\n{e}")
+            return None
+
+    def write_corporate_actions(self, ticker: str, action: str, df_events: pl.DataFrame) -> bool:
+        """
+        merge the retrieved events into the stored events of the ticker, the table is only written when
+        an event is new or was revised. Returns True when the table was written
+
+        ticker: str
+            ticker symbol
+        action: str
+            dividends or splits
+        df_events: pl.DataFrame
+            the full history of the events retrieved from the API
+        """
+        file_path = f"{action}/{ticker}/{action}.parq"
+        if self.s3.s3_exists(file_path=file_path):
+            df_stored = self.s3.s3_read_parquet(file_path=file_path)
+            df_new = df_events.join(df_stored, on=df_stored.columns, how='anti', nulls_equal=True)
+            if df_new.height == 0:
+                logging.info(f"No new {action} for {ticker}")
+                return False
+            # revised events replace the stored event of the same date
+            df_events = pl.concat([df_stored.join(df_new.select('date'), on='date', how='anti'),
+                                   df_new.select(df_stored.columns)])
+        elif df_events.height == 0:
+            return False
+        logging.info(f"Storing {df_events.height} {action} for {ticker}")
+        self.categories.register(df_events)
+        self.s3.s3_write_parquet(df=df_events.sort('date'), file_path=file_path, write_profile='small-hot')
+        return True
+
+    def update_corporate_actions(self, ticker: str, api_key: str) -> bool:
+        """
+        update the stored dividends and splits of the ticker, returns False when any of them could not be retrieved
+        """
+        result = True
+        for action in CORPORATE_ACTIONS:
+            df_events = self.get_corporate_actions(ticker=ticker, api_key=api_key, action=action)
+            if df_events is None:
+                result = False
+                continue
+            self.write_corporate_actions(ticker=ticker, action=action, df_events=df_events)
+        return result
+
+    def run_prices(self) -> dict[str: bool]:
+        """
+        update the price histories and the corporate actions of the tickers, the tickers are split across the
+        api keys. return a dict with the key as the ticker and the value as a boolean representing the
+        prices have been updated
+        """
+        api_keys = get_alpha_key()
+        price_tracking_dict = {}
+        for i, ticker in enumerate(self.tickers):
+            api_key = api_keys[0] if i < len(self.tickers) / 2 else api_keys[1]
+            price_tracking_dict[ticker] = self.update_prices(ticker=ticker, api_key=api_key)
+            self.update_corporate_actions(ticker=ticker, api_key=api_key)
+        self.s3.s3_save_manifest()
+        return price_tracking_dict
+
+    def write_checkpoint(self) -> None:
+        """
+        write the progress of the batch to s3, the tickers of the batch and the results of the completed tickers.
+        The change log, the manifest and the schemas are saved first so the changes and the tables of the
+        completed tickers are always recorded
+        """
+        if self.checkpoint_path is None:
+            return
+        self.persist()
+        self.s3.s3_write_json(data={'tickers': list(self.tickers),
+                                    'completed': self.ticker_tracking_dict,
+                                    'run_id': self.run_id,
+                                    'checkpoint_time': datetime.now()},
+                              file_path=self.checkpoint_path)
+
+    def process_ticker(self, ticker: str, source_data: dict[str: pl.DataFrame]) -> None:
+        """
+        merge the retrieved statements of a ticker into the stored statements and write them to s3
+
+        ticker: str
+            ticker symbol
+        source_data: dict[str: pl.DataFrame]
+            the statements retrieved with get_statement
+        """
+        # get the target data
+        target_data = self.get_target_data(ticker=ticker)
+        if target_data is None and source_data is None:
+            logging.warning(f"Missing target and source data for ticker {ticker}, skipping ...")
+            return
+        self.write_data(ticker=ticker,
+                        target_financials=target_data,
+                        source_financials=source_data)
+
+    def persist(self, rollups: bool = True) -> None:
+        """
+        write the change log and the quality report, update the sector and industry rollups and save the
+        category dictionary, the manifest and the schemas, so the tables written so far are recorded
+
+        rollups: bool
+            update the rollups, False keeps the statements added to the rollups for a later persist
+        """
+        self.write_change_log()
+        self.write_quality_report()
+        if rollups:
+            self.rollups.save()
+        # the values are registered before the manifest lists the tables holding them
+        self.categories.save()
+        self.s3.s3_save_manifest()
+        self.schemas.save()
 
     def run(self) -> None:
         """
         run the end-to-end process of the alphio
         return a dict with the key as the ticker and the value as a boolean representing the
-        process of retrieving the data has been completed
+        process of retrieving the data has been completed, None when the ticker was throttled
         """
         # split the  tickers list in half then pass the api keys
         api_key, api_key2 = get_alpha_key()
         split_number = int(len(self.tickers) / 2)
         counter = 0
+        # a resumed batch keeps the changes of the tickers completed before it failed
+        if self.s3.s3_exists(file_path=self._change_log_path()):
+            self.changes = [self.s3.s3_read_parquet(file_path=self._change_log_path())]
+        if self.s3.s3_exists(file_path=self._quality_report_path()):
+            self.quality = [self.s3.s3_read_parquet(file_path=self._quality_report_path())]
+        # record the batch before any request is made
+        self.write_checkpoint()
         for ticker in self.tickers:
+            # the tickers throttled or failed transiently by the previous run are retrieved again
+            if self.ticker_tracking_dict.get(ticker) is not None:
+                logging.info(f"{ticker} was completed by a previous run, skipping ...")
+                counter += 1
+                continue
             if counter < split_number:
                 # get the source data
                 logging.info(f"Using the first api key for {ticker}")
                 source_data = self.get_statement(ticker=ticker,
                                                  api_key=api_key,
-                                                 statement=['income',
-                                                            'balance',
-                                                            'cash'])
+                                                 statement=STATEMENTS)
             else: # use the second api key
                 # get the source data
                 logging.info(f"Using the second api key for {ticker}")
                 source_data = self.get_statement(ticker=ticker,
                                                  api_key=api_key2,
-                                                 statement=['income',
-                                                            'balance',
-                                                            'cash'])
+                                                 statement=STATEMENTS)
             counter += 1
-            # get the target data
-            target_data = self.get_target_data(ticker=ticker)
-            if target_data is None and source_data is None:
-                logging.warning(f"Missing target and source data for ticker {ticker}, skipping ...")
-                continue
-            else:
-                self.write_data(ticker=ticker,
-                                target_financials=target_data,
-                                source_financials=source_data)
+            self.process_ticker(ticker=ticker, source_data=source_data)
+            self.write_checkpoint()
+        self.persist()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+"""
+Bulk backfill of the tickers without stored history, used when a new exchange file is added to data/.
+Instead of working through the new symbols queue_depth tickers per run, the statements of all of them
+are retrieved in parallel at the rate the api keys allow. Every record is an insert, so the stored tables
+are not read and the statements are not merged, the tables are built in memory and uploaded in batches
+with one manifest save per batch and the queue is marked in one update at the end.
+
+    python backfill.py --rate-per-minute 75 --batch-size 200
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import polars as pl
+from alpha_utils import get_alpha_key, init_logger
+from alphaio import AlphaIO, STATEMENTS, STATEMENT_WRITE_PROFILE
+from clients import ApiKeyPool
+from lease import get_shard
+from s3io import ConditionalWriteError
+from stock_tracker import StockTracker
+
+
+class Backfill:
+    """
+    Retrieves and stores the statements of the queued tickers that have no stored history
+    """
+    def __init__(self,
+                 tracker: StockTracker,
+                 rate_per_minute: float = 5.0,
+                 batch_size: int = 100,
+                 max_workers: int | None = None):
+        """
+        Initialize the backfill
+
+        tracker: StockTracker
+            the tracker holding the ticker table and the queue
+        rate_per_minute: float
+            the requests allowed per minute and api key
+        batch_size: int
+            the number of tickers retrieved before their tables are uploaded and recorded
+        max_workers: int
+            the number of parallel requests, twice the number of api keys if None
+        """
+        self.tracker = tracker
+        self.api_keys = list(get_alpha_key())
+        self.key_pool = ApiKeyPool(keys=self.api_keys, rate_per_minute=rate_per_minute)
+        self.batch_size = batch_size
+        self.max_workers = max_workers or 2 * len(self.api_keys)
+        self.alphaio = None
+
+    def get_new_tickers(self) -> list[str]:
+        """
+        Get the tickers of the queue without a stored income statement, only the tickers of the held shard
+        """
+        queue = self.tracker.ticker_queue.filter(pl.col('Download_Failed') == False)
+        tickers = [x for x in queue.select('Symbol').to_series()
+                   if not self.tracker.s3.s3_exists(file_path=f"income/{x}/income.parq")]
+        if self.tracker.lease is not None:
+            tickers = [x for x in tickers if self.tracker.lease.holds(x)]
+        return tickers
+
+    def _fetch(self, ticker: str) -> tuple[str, dict[str: pl.DataFrame]]:
+        # the preferred key spreads the tickers over the keys, the pool moves throttled requests to another key
+        api_key = self.api_keys[get_shard(ticker, len(self.api_keys))]
+        return ticker, self.alphaio.get_statement(ticker=ticker, api_key=api_key, statement=STATEMENTS)
+
+    def _upload(self, item: tuple[str, pl.DataFrame]) -> None:
+        file_path, df = item
+        statement = file_path.split('/')[0]
+        metadata = None
+        if not file_path.endswith('_ttm.parq'):
+            metadata = {'schema-version': str(self.alphaio.schemas.version(statement))}
+        try:
+            # a ticker stored by another worker in the meantime is not overwritten
+            self.tracker.s3.s3_write_parquet(df=df, file_path=file_path, metadata=metadata,
+                                             write_profile=STATEMENT_WRITE_PROFILE, if_none_match=True)
+        except ConditionalWriteError:
+            logging.warning(f"{file_path} was stored by another worker, skipping ...")
+
+    def run_batch(self, tickers: list[str], executor: ThreadPoolExecutor) -> None:
+        """
+        Retrieve the statements of a batch of tickers in parallel, build their tables and upload them
+        """
+        tables = {}
+        update_time = datetime.now()
+        for ticker, source_data in executor.map(self._fetch, tickers):
+            tables.update(self.alphaio.initial_tables(ticker=ticker, source_financials=source_data,
+                                                      update_time=update_time))
+        list(executor.map(self._upload, tables.items()))
+        # the uploaded tables and their changes are recorded before the next batch
+        self.alphaio.persist()
+        logging.info(f"Stored {len(tables)} tables of {len(tickers)} tickers, "
+                     f"{self.alphaio.request_count} requests so far")
+
+    def run(self) -> dict[str: bool]:
+        """
+        Backfill the new tickers of the queue and mark them in the queue, returns the result per ticker
+        """
+        if not self.tracker.prepare():
+            logging.warning("No source and target data, closing ...")
+            return {}
+        lease = self.tracker.lease
+        if lease is not None and len(lease.acquire(max_shards=1)) == 0:
+            logging.warning("No free shard of the queue, closing ...")
+            return {}
+        try:
+            tickers = self.get_new_tickers()
+            logging.info(f"Backfilling {len(tickers)} tickers without stored history")
+            self.alphaio = AlphaIO(tickers=tickers, s3=self.tracker.s3, key_pool=self.key_pool)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for i in range(0, len(tickers), self.batch_size):
+                    self.run_batch(tickers=tickers[i:i + self.batch_size], executor=executor)
+                    if lease is not None:
+                        lease.renew()
+            self.tracker.write_ticker_queue(download_dict=self.alphaio.ticker_tracking_dict)
+            self.tracker.s3.s3_save_manifest()
+        finally:
+            if lease is not None:
+                lease.release()
+        return self.alphaio.ticker_tracking_dict
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="retrieve the statements of the tickers without stored history")
+    parser.add_argument('--rate-per-minute', type=float, default=5.0, help="requests per minute and api key")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--shards', type=int, default=1,
+                        help="number of queue shards, each worker claims one through a lease")
+    parser.add_argument('--worker-id', default=None)
+    args = parser.parse_args()
+
+    init_logger("backfill.log")
+    stock_tracker = StockTracker(n_shards=args.shards, worker_id=args.worker_id)
+    Backfill(tracker=stock_tracker, rate_per_minute=args.rate_per_minute, batch_size=args.batch_size).run()
@@ -0,0 +1,290 @@
+"""
+Vectorized backtest of ranking and screening rules over the point in time statements. At every rebalance
+date a ticker only sees the version of its statements that was known at that date. A version is known
+from the day after its update_time, the first version of a quarter at the latest report_lag_days after
+the end of the quarter since the histories stored by the first download were reported long before it.
+
+The rules are polars expressions over the statement fields. The signals, the screens and the ranks of all
+the tickers and rebalance dates are evaluated as columns of one frame and the returns of the portfolios
+as products of the weight and return matrices, there is no loop over the dates.
+
+    python backtest.py --signal "netIncome / totalRevenue" --screen "totalRevenue > 0" --top 50 --freq 1mo
+"""
+import logging
+from datetime import timedelta
+import numpy as np
+import polars as pl
+from alpha_utils import get_adjustment_factors, apply_adjustments
+from s3io import decode_categories
+from schema_registry import SCD2_COLUMNS
+
+
+def get_rebalance_dates(prices: pl.DataFrame, freq: str = '1mo') -> pl.Series:
+    """
+    Get the last trading day of every period of the prices
+
+    prices: pl.DataFrame
+        the daily bars of the tickers
+    freq: str
+        the rebalance period as a polars duration, 1w, 1mo, 3mo or 1y
+    """
+    return (prices.select(pl.col('date').unique())
+            .group_by(pl.col('date').dt.truncate(freq).alias('period')).agg(pl.col('date').max())
+            .sort('date')['date'])
+
+
+def point_in_time(history: pl.DataFrame,
+                  symbols: list[str],
+                  dates: pl.Series,
+                  fields: list[str],
+                  report_lag_days: int = 90,
+                  max_age_days: int = 365) -> pl.DataFrame:
+    """
+    Get the fields of the latest quarter known at every rebalance date for every ticker
+
+    history: pl.DataFrame
+        all the versions of the records of a statement with a Symbol column, see query.StatementQuery
+    symbols: list[str]
+        the tickers of the universe
+    dates: pl.Series
+        the rebalance dates
+    fields: list[str]
+        the fields of the statement to keep
+    report_lag_days: int
+        the latest a quarter is assumed to be reported after its end
+    max_age_days: int
+        quarters that ended longer ago than this at a rebalance date are not used
+    :return:
+        pl.DataFrame with one row per ticker and rebalance date, nulls when no quarter was known
+    """
+    period = pl.col('fiscalDateEnding').str.to_date(strict=False)
+    updated = pl.col('update_time').dt.date() + timedelta(days=1)
+    first = pl.col('update_time') == pl.col('update_time').min().over('Symbol', 'fiscalDateEnding')
+    # the symbols encoded by the query layer are decoded to join the grid of the ticker strings
+    versions = (decode_categories(history.select('Symbol', 'fiscalDateEnding', *fields, 'update_time'))
+                .with_columns(period.alias('period'))
+                .with_columns(pl.when(first)
+                              .then(pl.min_horizontal(updated, pl.col('period') + timedelta(days=report_lag_days)))
+                              .otherwise(updated).alias('known_from'))
+                .drop_nulls('period')
+                .sort('Symbol', 'known_from', 'period'))
+    # only the versions of the latest quarter known at the time, a late revision of an older quarter does not
+    # replace the latest quarter
+    versions = (versions.filter(pl.col('period') == pl.col('period').cum_max().over('Symbol'))
+                .sort('known_from'))
+    grid = (pl.DataFrame({'Symbol': symbols}, schema={'Symbol': pl.String})
+            .join(pl.DataFrame({'date': dates}), how='cross').sort('date'))
+    panel = grid.join_asof(versions, left_on='date', right_on='known_from', by='Symbol', strategy='backward',
+                           check_sortedness=False)
+    stale = (pl.col('date') - pl.col('period')).dt.total_days() > max_age_days
+    return panel.select('Symbol', 'date', *[pl.when(stale).then(None).otherwise(pl.col(x)).alias(x) for x in fields])
+
+
+class Backtest:
+    """
+    Evaluates ranking and screening rules on the point in time statements and the adjusted prices
+    """
+    def __init__(self,
+                 prices: pl.DataFrame,
+                 statements: dict[str: pl.DataFrame],
+                 dividends: pl.DataFrame | None = None,
+                 splits: pl.DataFrame | None = None,
+                 report_lag_days: int = 90,
+                 max_age_days: int = 365,
+                 price_tolerance_days: int = 7):
+        """
+        Initialize the backtest
+
+        Parameters
+        ----------
+        prices: pl.DataFrame
+            the unadjusted daily bars with the Symbol, date and close columns
+        statements: dict[str: pl.DataFrame | pl.LazyFrame]
+            all the versions of the records of every statement by statement name, with a Symbol column. Only the
+            fields used by the rules are collected from lazy frames
+        dividends: pl.DataFrame
+            the dividend events, the returns are total returns when they are passed
+        splits: pl.DataFrame
+            the split events
+        report_lag_days: int
+            the latest a quarter is assumed to be reported after its end, see point_in_time
+        max_age_days: int
+            quarters that ended longer ago than this at a rebalance date are not used
+        price_tolerance_days: int
+            the oldest bar used as the price of a ticker at a rebalance date, delisted tickers get no price
+        """
+        # the symbols encoded by the query layer are decoded, the panels are keyed by the ticker strings
+        prices = decode_categories(prices.select('Symbol', 'date', 'close')).drop_nulls()
+        dividends, splits = [decode_categories(x) if x is not None else None for x in [dividends, splits]]
+        if dividends is not None or splits is not None:
+            factors = get_adjustment_factors(prices=prices, dividends=dividends, splits=splits)
+            prices = apply_adjustments(df=prices, factors=factors, price_cols=['close'])
+        self.prices = prices
+        self.statements = statements
+        self.symbols = sorted(self.prices['Symbol'].unique().to_list())
+        self.report_lag_days = report_lag_days
+        self.max_age_days = max_age_days
+        self.price_tolerance_days = price_tolerance_days
+
+    def panel(self, dates: pl.Series, fields: list[str]) -> pl.DataFrame:
+        """
+        Get the point in time fields of every ticker at every rebalance date, the fields are looked up in
+        the statements that report them
+        """
+        panel = (pl.DataFrame({'Symbol': self.symbols}, schema={'Symbol': pl.String})
+                 .join(pl.DataFrame({'date': dates}), how='cross'))
+        for statement, history in self.statements.items():
+            statement_fields = [x for x in fields if x in history.collect_schema().names()
+                                and x not in SCD2_COLUMNS and x not in panel.columns]
+            if len(statement_fields) == 0:
+                continue
+            if isinstance(history, pl.LazyFrame):
+                # only the fields of the rules are read
+                history = history.select('Symbol', 'fiscalDateEnding', *statement_fields, 'update_time').collect()
+            df = point_in_time(history=history, symbols=self.symbols, dates=dates, fields=statement_fields,
+                               report_lag_days=self.report_lag_days, max_age_days=self.max_age_days)
+            panel = panel.join(df, on=['Symbol', 'date'], how='left')
+        missing = [x for x in fields if x not in panel.columns]
+        if len(missing) > 0:
+            raise ValueError(f"Fields {missing} are not reported by any of the statements")
+        return panel
+
+    def _to_matrix(self, df: pl.DataFrame, column: str) -> np.ndarray:
+        """
+        Reshape a column of a frame with one row per rebalance date and ticker to a matrix of the dates by
+        the tickers, a sort and a reshape instead of a pivot to thousands of columns
+        """
+        values = df.sort('date', 'Symbol')[column].to_numpy().astype(np.float64)
+        return values.reshape(-1, len(self.symbols))
+
+    def forward_returns(self, dates: pl.Series) -> np.ndarray:
+        """
+        Get the returns from every rebalance date to the next one, a matrix of the dates by the tickers.
+        The last date and the tickers without a price at both dates get NaN
+        """
+        grid = (pl.DataFrame({'date': dates}).join(pl.DataFrame({'Symbol': self.symbols}), how='cross')
+                .sort('date'))
+        # only the bars within the tolerance of a rebalance date can be its price
+        windows = pl.date_ranges(dates - timedelta(days=self.price_tolerance_days), dates, eager=True)
+        prices = self.prices.filter(pl.col('date').is_in(windows.explode().unique().implode())).sort('date')
+        closes = grid.join_asof(prices, on='date', by='Symbol', strategy='backward',
+                                tolerance=timedelta(days=self.price_tolerance_days), check_sortedness=False)
+        values = self._to_matrix(closes, 'close')
+        returns = np.full_like(values, np.nan)
+        returns[:-1] = values[1:] / values[:-1] - 1
+        return returns
+
+    def run(self,
+            signal: pl.Expr,
+            screen: pl.Expr | None = None,
+            top: int | None = None,
+            quantile: float | None = None,
+            descending: bool = True,
+            freq: str = '1mo',
+            cost_bps: float = 0.0) -> pl.DataFrame:
+        """
+        Backtest an equally weighted portfolio of the best ranked tickers, rebalanced every period
+
+        Parameters
+        ----------
+        signal: pl.Expr
+            the expression ranking the tickers, over the fields of the statements
+        screen: pl.Expr
+            optional boolean expression of the tickers that can be held
+        top: int
+            hold the top ranked tickers
+        quantile: float
+            hold the top quantile of the ranked tickers, used when top is None. All the tickers passing the
+            screen are held when neither is passed
+        descending: bool
+            the highest signal is the best rank
+        freq: str
+            the rebalance period, see get_rebalance_dates
+        cost_bps: float
+            the trading cost in basis points of the traded weight
+        :return:
+            pl.DataFrame with the holdings, the turnover and the return of every period
+        """
+        dates = get_rebalance_dates(self.prices, freq=freq)
+        fields = signal.meta.root_names() + (screen.meta.root_names() if screen is not None else [])
+        panel = self.panel(dates=dates, fields=list(dict.fromkeys(fields)))
+        score = (panel.with_columns(signal.cast(pl.Float64).alias('__signal'),
+                                    (screen if screen is not None else pl.lit(True)).alias('__screen'))
+                 .with_columns(pl.when(pl.col('__screen') & pl.col('__signal').is_finite())
+                               .then(pl.col('__signal')).alias('__signal')))
+        # the ranks of the tickers at every date in one pass
+        rank = pl.col('__signal').rank(method='ordinal', descending=descending).over('date')
+        if top is not None:
+            selected = rank <= top
+        elif quantile is not None:
+            selected = rank <= (pl.col('__signal').count().over('date') * quantile).ceil()
+        else:
+            selected = pl.col('__signal').is_not_null()
+        score = score.with_columns(selected.fill_null(False).alias('__selected'))
+        score = score.with_columns((pl.col('__selected').cast(pl.Float64)
+                                    / pl.col('__selected').sum().over('date')).fill_nan(0.0).alias('__weight'))
+        weights = np.nan_to_num(self._to_matrix(score, '__weight'))
+        returns = self.forward_returns(dates=dates)
+        # a held ticker without a price at the next date, delisted or halted, contributes no return
+        gross = np.sum(weights * np.nan_to_num(returns), axis=1)
+        traded = np.abs(np.diff(weights, axis=0, prepend=np.zeros((1, weights.shape[1])))).sum(axis=1)
+        net = gross - traded * cost_bps / 10000
+        result = pl.DataFrame({'date': dates,
+                               'holdings': (weights > 0).sum(axis=1),
+                               'turnover': traded / 2,
+                               'gross_return': gross,
+                               'return': net})
+        # the last date has no next period
+        result = result.head(result.height - 1)
+        return result.with_columns((1 + pl.col('return')).cum_prod().alias('equity'))
+
+
+def summarize(result: pl.DataFrame) -> dict[str: float]:
+    """
+    Get the annualized return, the volatility, the sharpe ratio without a risk free rate and the maximum
+    drawdown of a backtest
+    """
+    if result.height < 2:
+        return {}
+    days = result.select(pl.col('date').diff().dt.total_days().median()).item()
+    periods_per_year = 365.25 / days
+    returns = result['return'].to_numpy()
+    equity = result['equity'].to_numpy()
+    years = result.height / periods_per_year
+    volatility = returns.std(ddof=1) * np.sqrt(periods_per_year)
+    return {'annual_return': equity[-1] ** (1 / years) - 1,
+            'volatility': volatility,
+            'sharpe': returns.mean() * periods_per_year / volatility if volatility > 0 else np.nan,
+            'max_drawdown': (equity / np.maximum.accumulate(equity) - 1).min(),
+            'periods': result.height}
+
+
+if __name__ == '__main__':
+    import argparse
+    from alpha_utils import init_logger
+    from query import StatementQuery, STATEMENTS
+    parser = argparse.ArgumentParser(description="backtest a ranking rule over the point in time statements")
+    parser.add_argument('--signal', required=True, help="SQL expression over the statement fields")
+    parser.add_argument('--screen', default=None, help="SQL boolean expression of the tickers that can be held")
+    parser.add_argument('--top', type=int, default=None)
+    parser.add_argument('--quantile', type=float, default=None)
+    parser.add_argument('--ascending', action='store_true', help="the lowest signal is the best rank")
+    parser.add_argument('--freq', default='1mo')
+    parser.add_argument('--cost-bps', type=float, default=0.0)
+    parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+
+    init_logger("backtest.log")
+    query = StatementQuery(cache_dir=args.cache_dir)
+    signal_expr = pl.sql_expr(args.signal)
+    screen_expr = pl.sql_expr(args.screen) if args.screen is not None else None
+    events = {x: query.execute(f"SELECT * FROM {x}") for x in ['dividends', 'splits']
+              if query.s3.s3_list(path=f"{x}/")}
+    backtest = Backtest(prices=query.execute("SELECT Symbol, date, close FROM prices"),
+                        statements={x: query.execute(f"SELECT * FROM {x}_history", eager=False) for x in STATEMENTS},
+                        **events)
+    df_result = backtest.run(signal=signal_expr, screen=screen_expr, top=args.top, quantile=args.quantile,
+                             descending=not args.ascending, freq=args.freq, cost_bps=args.cost_bps)
+    with pl.Config(tbl_rows=50):
+        print(df_result)
+    logging.info(f"Summary: {summarize(df_result)}")
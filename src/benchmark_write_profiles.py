@@ -0,0 +1,121 @@
+"""
+Benchmark of the parquet write profiles in s3io.WRITE_PROFILES. For every profile and table shape the
+file size, the write time and the read time are reported, so the S3 bytes can be traded against CPU.
+
+By default synthetic tables with the shapes of the ticker table, the ticker queue and the statements
+are used. Real tables can be benchmarked by passing their s3 paths, for example
+
+    python benchmark_write_profiles.py --s3 stock_tracker/tickers.parq income/AAPL/income.parq
+"""
+import argparse
+import io
+import logging
+import time
+import random
+from datetime import datetime, timedelta
+import polars as pl
+from s3io import WRITE_PROFILES, write_parquet_profile
+from alpha_utils import init_logger, get_bucket_name, get_profile_name
+
+
+def ticker_table(n_rows: int = 7000) -> pl.DataFrame:
+    """
+    synthetic table with the shape of stock_tracker/tickers.parq
+    """
+    rng = random.Random(0)
+    sectors = [f"Sector {x}" for x in range(12)]
+    industries = [f"Industry {x}" for x in range(140)]
+    countries = [f"Country {x}" for x in range(50)]
+    return pl.DataFrame({
+        'Symbol': [f"T{x:05d}" for x in range(n_rows)],
+        'Name': [f"Company {x} Common Stock" for x in range(n_rows)],
+        'Market Cap': [rng.lognormvariate(20, 2) for _ in range(n_rows)],
+        'Country': [rng.choice(countries) for _ in range(n_rows)],
+        'IPO Year': [rng.choice([None, *range(1970, 2025)]) for _ in range(n_rows)],
+        'Sector': [rng.choice(sectors) for _ in range(n_rows)],
+        'Industry': [rng.choice(industries) for _ in range(n_rows)],
+        'Market Cap Name': [rng.choice(['Mega', 'Large', 'Medium', 'Small', 'Micro', 'Nano']) for _ in range(n_rows)],
+        'is_current': [True] * n_rows,
+        'updated_time': [datetime(2024, 1, 1)] * n_rows,
+    }, schema_overrides={'IPO Year': pl.Int64})
+
+
+def queue_table(n_rows: int = 7000) -> pl.DataFrame:
+    """
+    synthetic table with the shape of stock_tracker/tickers_queue.parq
+    """
+    return pl.DataFrame({
+        'Symbol': [f"T{x:05d}" for x in range(n_rows)],
+        'Download_time': [datetime(2024, 1, 1) + timedelta(minutes=x) for x in range(n_rows)],
+        'Downloaded': [x % 3 == 0 for x in range(n_rows)],
+        'Download_Failed': [x % 50 == 0 for x in range(n_rows)],
+    })
+
+
+def statement_table(n_tickers: int = 1, n_quarters: int = 80, n_fields: int = 50) -> pl.DataFrame:
+    """
+    synthetic table with the shape of the statement tables, a single ticker or several tickers stacked
+    """
+    rng = random.Random(0)
+    n_rows = n_tickers * n_quarters
+    periods = [(datetime(2004, 3, 31) + timedelta(days=91 * (x % n_quarters))).strftime('%Y-%m-%d')
+               for x in range(n_rows)]
+    data = {
+        'Symbol': [f"T{x // n_quarters:05d}" for x in range(n_rows)],
+        'fiscalDateEnding': periods,
+        'reportedCurrency': ['USD'] * n_rows,
+    }
+    for field in range(n_fields):
+        data[f"field{field}"] = [rng.choice([None, rng.uniform(-1e9, 1e10)]) for _ in range(n_rows)]
+    data['is_current'] = [True] * n_rows
+    data['update_time'] = [datetime(2024, 1, 1)] * n_rows
+    return pl.DataFrame(data)
+
+
+def benchmark(df: pl.DataFrame, repeat: int = 5) -> list[dict]:
+    """
+    write and read the dataframe with every profile, the best time of the repeats is kept
+    """
+    results = []
+    for write_profile in WRITE_PROFILES.keys():
+        write_times, read_times = [], []
+        for _ in range(repeat):
+            buffer = io.BytesIO()
+            start = time.perf_counter()
+            write_parquet_profile(df=df, file=buffer, write_profile=write_profile)
+            write_times.append(time.perf_counter() - start)
+            buffer.seek(0)
+            start = time.perf_counter()
+            pl.read_parquet(buffer)
+            read_times.append(time.perf_counter() - start)
+        results.append({'profile': write_profile,
+                        'size_kb': len(buffer.getvalue()) / 1024,
+                        'write_ms': min(write_times) * 1000,
+                        'read_ms': min(read_times) * 1000})
+    return results
+
+
+if __name__ == '__main__':
+    init_logger("benchmark_write_profiles.log")
+    parser = argparse.ArgumentParser(description="benchmark the parquet write profiles")
+    parser.add_argument('--s3', nargs='*', default=None, help="s3 paths of real tables to benchmark")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.s3:
+        from s3io import S3IO
+        s3 = S3IO(bucket=get_bucket_name(), profile=get_profile_name())
+        tables = {path: s3.s3_read_parquet(file_path=path) for path in args.s3}
+    else:
+        tables = {
+            'tickers': ticker_table(),
+            'tickers_queue': queue_table(),
+            'statement (1 ticker)': statement_table(),
+            'statements (500 tickers)': statement_table(n_tickers=500),
+        }
+    rows = []
+    for name, df in tables.items():
+        logging.info(f"benchmarking {name} {df.shape}")
+        rows.extend({'table': name, **x} for x in benchmark(df=df, repeat=args.repeat))
+    with pl.Config(tbl_rows=-1, float_precision=2):
+        logging.info(f"write profile benchmark\n{pl.DataFrame(rows)}")
@@ -0,0 +1,167 @@
+"""
+Global dictionary of the low cardinality string columns, the symbols, the classifications of the ticker
+table and the reporting currency of the statements. Every column has one append only list of its values,
+the position of a value is its code, so the frames of all the tables are encoded with the same pl.Enum and
+joins, filters and sorts on these columns compare integer codes instead of strings.
+
+The stored tables keep the columns as dictionary encoded strings, see s3io.decode_categories, files
+written with different versions of the dictionary are read and scanned together. The columns are encoded
+with the dictionary when the tables are loaded. The writers of the tables register their values, the tables
+stored before the dictionary existed are registered once with
+
+    python categories.py
+"""
+import logging
+import threading
+import polars as pl
+from s3io import ConditionalWriteError, DICTIONARY_COLUMNS
+
+CATEGORY_PATH = "stock_tracker/categories.json"
+
+# the encoded columns, the same columns are stored dictionary encoded
+CATEGORICAL_COLUMNS = DICTIONARY_COLUMNS
+
+
+class CategoryDictionary:
+    """
+    The values of the encoded columns, loaded once and written back with save
+    """
+    def __init__(self, s3, path: str = CATEGORY_PATH, columns: list[str] | None = None):
+        """
+        Initialize the dictionary
+
+        Parameters
+        ----------
+        s3: S3IO
+            the store holding the dictionary document
+        path: str
+            the path of the json document of the dictionary
+        columns: list[str]
+            the encoded columns, CATEGORICAL_COLUMNS if None
+        """
+        self.s3 = s3
+        self.path = path
+        self.columns = columns if columns is not None else CATEGORICAL_COLUMNS
+        self._values = None
+        self._etag = None
+        # values added since the dictionary was loaded, replayed when another writer saved first
+        self._added = {}
+        self._dtypes = {}
+        self._lock = threading.RLock()
+
+    def _load(self) -> None:
+        document, self._etag = self.s3.s3_read_json_versioned(file_path=self.path)
+        if document is None:
+            logging.info("No category dictionary stored, starting a new one")
+            document = {}
+        self._values = {x: list(document.get(x, [])) for x in self.columns}
+        self._dtypes = {}
+
+    @property
+    def values(self) -> dict[str: list[str]]:
+        """
+        The values of every column in the order of their codes, loaded from the store on first use
+        """
+        if self._values is None:
+            self._load()
+        return self._values
+
+    def dtype(self, column: str) -> pl.Enum:
+        """
+        The enum of a column with all the values registered so far
+        """
+        with self._lock:
+            if column not in self._dtypes:
+                self._dtypes[column] = pl.Enum(self.values[column])
+            return self._dtypes[column]
+
+    def _add_values(self, column: str, values: list[str]) -> None:
+        known = set(self.values[column])
+        new_values = [x for x in dict.fromkeys(values) if x is not None and x not in known]
+        if len(new_values) == 0:
+            return
+        self.values[column].extend(new_values)
+        self._added.setdefault(column, []).extend(new_values)
+        self._dtypes.pop(column, None)
+
+    def register(self, df: pl.DataFrame) -> None:
+        """
+        Add the values of the encoded columns of the frame that are not in the dictionary yet
+        """
+        with self._lock:
+            for column in self.columns:
+                if column not in df.columns:
+                    continue
+                known = pl.Series(self.values[column], dtype=pl.String)
+                new_values = (df.select(pl.col(column).cast(pl.String).unique(maintain_order=True))
+                              .filter(~pl.col(column).is_in(known.implode()))
+                              .to_series().to_list())
+                if len(new_values) > 0:
+                    logging.info(f"Adding {len(new_values)} values to the dictionary of {column}")
+                    self._add_values(column, new_values)
+
+    def encode(self, *frames: pl.DataFrame | pl.LazyFrame | None, register: bool = True) -> list | pl.DataFrame:
+        """
+        Encode the columns of the frames with the dictionary. The values of all the frames are registered first
+        so the frames share one enum per column and can be joined and concatenated. The values of lazy frames
+        and of frames encoded without registering have to be in the dictionary, a missing value fails the cast
+        instead of becoming a null. Returns the encoded frame, a list for several frames
+        """
+        with self._lock:
+            if register:
+                for df in frames:
+                    if isinstance(df, pl.DataFrame):
+                        self.register(df)
+            encoded = []
+            for df in frames:
+                if df is None:
+                    encoded.append(None)
+                    continue
+                columns = [x for x in self.columns if x in df.collect_schema().names()]
+                encoded.append(df.with_columns(pl.col(x).cast(pl.String).cast(self.dtype(x))
+                                               for x in columns))
+        return encoded if len(frames) > 1 else encoded[0]
+
+    def save(self, retries: int = 5) -> None:
+        """
+        Write the dictionary with the new values to the store. The write is conditional on the dictionary not
+        being saved by another writer in the meantime, otherwise the other writer's dictionary is loaded, the
+        new values are added after its values and the write is retried. The codes of saved values never change
+        """
+        if len(self._added) == 0:
+            return
+        with self._lock:
+            for _ in range(retries):
+                try:
+                    self._etag = self.s3.s3_write_json(data=self.values, file_path=self.path, if_match=self._etag,
+                                                       if_none_match=self._etag is None)
+                except ConditionalWriteError:
+                    logging.warning("Category dictionary was saved by another writer, merging ...")
+                    added = self._added
+                    self._added = {}
+                    self._load()
+                    for column, values in added.items():
+                        self._add_values(column, values)
+                    continue
+                self._added = {}
+                return
+            raise ConditionalWriteError(f"Could not save the category dictionary after {retries} attempts")
+
+
+if __name__ == '__main__':
+    from alpha_utils import init_logger
+    from localio import get_store
+    from manifest import MANIFEST_PATH
+
+    init_logger("categories.log")
+    store = get_store(manifest_path=MANIFEST_PATH)
+    dictionary = CategoryDictionary(s3=store)
+    for prefix in ['stock_tracker/', 'income/', 'balance/', 'cash/', 'prices/', 'dividends/', 'splits/', 'changes/',
+                   'quality/']:
+        for key in store.s3_list(path=prefix):
+            if not key.endswith('.parq'):
+                continue
+            columns = [x for x in store.s3_read_parquet_metadata(file_path=key).schema.names if x in dictionary.columns]
+            if len(columns) > 0:
+                dictionary.register(store.s3_read_parquet(file_path=key, columns=columns))
+    dictionary.save()
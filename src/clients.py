@@ -0,0 +1,177 @@
+"""
+Process wide clients shared by the S3IO and AlphaIO objects. The boto3 session, the s3 client and
+resource and the http session are created lazily on first use and reused afterwards, so runs that
+never touch S3 or the API do not pay for loading the botocore models or resolving credentials.
+"""
+import logging
+import threading
+import time
+
+_lock = threading.RLock()
+_sessions = {}
+_s3_clients = {}
+_s3_resources = {}
+_http_session = None
+
+
+def get_boto_session(profile: str = 'default'):
+    """
+    Get the shared boto3 session for the profile, creating it on first use
+
+    Parameters
+    ______________
+    profile: str
+        The name of the profile that holds the access key
+        and access id in the AWS credentials file
+    """
+    with _lock:
+        if profile not in _sessions:
+            import boto3
+            logging.info(f"Establishing a boto3 session for profile {profile}")
+            try:
+                _sessions[profile] = boto3.Session(profile_name=profile)
+            except Exception as e:
+                logging.error(f"{e}\nCheck spelling of profile or properly set it in credentials file")
+                raise ValueError
+        return _sessions[profile]
+
+
+def get_s3_client(profile: str = 'default'):
+    """
+    Get the shared s3 client for the profile, boto3 clients are thread safe
+    """
+    with _lock:
+        if profile not in _s3_clients:
+            _s3_clients[profile] = get_boto_session(profile=profile).client('s3')
+        return _s3_clients[profile]
+
+
+def get_s3_resource(profile: str = 'default'):
+    """
+    Get the shared s3 resource for the profile
+    """
+    with _lock:
+        if profile not in _s3_resources:
+            _s3_resources[profile] = get_boto_session(profile=profile).resource('s3')
+        return _s3_resources[profile]
+
+
+def get_http_session():
+    """
+    Get the shared requests session, keeping the connections to the API open between requests
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _http_session.mount('https://', adapter)
+        return _http_session
+
+
+class RateLimiter:
+    """
+    Token bucket pacing the requests to the API, shared by the threads of the process
+    """
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        """
+        Parameters
+        ______________
+        rate_per_minute: float
+            the number of requests allowed per minute
+        burst: int
+            the number of requests that can be made at once after an idle period
+        """
+        self.interval = 60.0 / rate_per_minute
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) / self.interval)
+        self._last = now
+
+    def wait_time(self) -> float:
+        """
+        The seconds until the next request is allowed
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) * self.interval)
+
+    def acquire(self) -> float:
+        """
+        Block until a request is allowed, returns the seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) * self.interval
+            time.sleep(delay)
+            waited += delay
+
+
+class ApiKeyPool:
+    """
+    The API keys with their own rate limit and the time a throttled key can be used again. Requests go to
+    the key that is available the soonest, so a throttled key does not hold up the others
+    """
+    def __init__(self, keys: list[str], rate_per_minute: float | None = None):
+        """
+        Parameters
+        ______________
+        keys: list[str]
+            the API keys
+        rate_per_minute: float
+            the requests allowed per minute and key, the requests are not paced if None
+        """
+        self.keys = list(keys)
+        self._limiters = {x: RateLimiter(rate_per_minute) for x in self.keys} if rate_per_minute else {}
+        self._throttled_until = {x: 0.0 for x in self.keys}
+        self._lock = threading.Lock()
+
+    def _wait(self, key: str) -> float:
+        wait = max(0.0, self._throttled_until[key] - time.monotonic())
+        if key in self._limiters:
+            wait = max(wait, self._limiters[key].wait_time())
+        return wait
+
+    def wait_time(self) -> float:
+        """
+        The seconds until any key can be used
+        """
+        with self._lock:
+            return min(self._wait(x) for x in self.keys)
+
+    def throttled(self, key: str, seconds: float) -> None:
+        """
+        Do not use the key for the given seconds
+        """
+        with self._lock:
+            self._throttled_until[key] = max(self._throttled_until[key], time.monotonic() + seconds)
+        logging.warning(f"API key ...{key[-4:]} is throttled for {seconds:.0f} seconds")
+
+    def acquire(self, preferred: str | None = None, max_wait: float | None = None) -> str | None:
+        """
+        Get the key available the soonest, the preferred key on a tie, blocking until it can be used.
+        None when no key can be used within max_wait seconds
+        """
+        with self._lock:
+            order = sorted(self.keys, key=lambda x: (self._wait(x), x != preferred))
+            key = order[0]
+            wait = self._wait(key)
+        if max_wait is not None and wait > max_wait:
+            return None
+        if wait > 0:
+            time.sleep(max(0.0, self._throttled_until[key] - time.monotonic()))
+        if key in self._limiters:
+            self._limiters[key].acquire()
+        return key
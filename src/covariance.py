@@ -0,0 +1,254 @@
+"""
+Incremental covariance and correlation of the daily returns of all the tickers. Instead of recomputing
+the matrices from the full price histories, the engine keeps pairwise running sums of the returns, the
+count, the sums and the sums of squares and cross products over the days both tickers have a return, and
+adds the new bars to them. Tickers with histories of different lengths or with missing days are handled
+pairwise, every pair only uses the days both of them traded.
+
+The sums and the matrices are saved in a local directory as one generation of files named after the
+generation, the state file names the current generation, readers memory map the .npy files of the matrices
+
+    python covariance.py --root ~/.tt_covariance update
+    python covariance.py --root ~/.tt_covariance show AAPL MSFT
+"""
+import json
+import logging
+import os
+import uuid
+from datetime import date
+import numpy as np
+import polars as pl
+from alpha_utils import get_adjustment_factors, apply_adjustments
+from s3io import decode_categories
+
+# the running sums, see ReturnCovariance.add_returns
+SUMS = ['count', 'sum', 'sum_sq', 'sum_prod']
+STATE_FILE = "state.json"
+# the files of a generation, the sums in one .npz file and the matrices in .npy files
+GENERATION_FILES = {'sums': 'npz', 'covariance': 'npy', 'correlation': 'npy'}
+
+
+def get_generation_path(root: str, name: str, generation: str) -> str:
+    """
+    Get the path of a file of a saved generation
+    """
+    return os.path.join(root, f"{name}-{generation}.{GENERATION_FILES[name]}")
+
+
+def get_returns(prices: pl.DataFrame,
+                dividends: pl.DataFrame | None = None,
+                splits: pl.DataFrame | None = None) -> pl.DataFrame:
+    """
+    Compute the daily total returns of the tickers from the consecutive bars of every ticker. The closes
+    are adjusted for the splits and dividends, the ratio of consecutive adjusted closes does not change
+    when later events are added so the returns of the stored bars stay the same
+
+    prices: pl.DataFrame
+        the daily bars with the Symbol, date and close columns
+    dividends: pl.DataFrame
+        the dividend events, see alpha_utils.parse_dividends
+    splits: pl.DataFrame
+        the split events, see alpha_utils.parse_splits
+    """
+    # the symbols encoded by the query layer are decoded, the sums are kept by the ticker strings
+    prices = decode_categories(prices.select('Symbol', 'date', 'close')).drop_nulls()
+    dividends, splits = [decode_categories(x) if x is not None else None for x in [dividends, splits]]
+    if dividends is not None or splits is not None:
+        factors = get_adjustment_factors(prices=prices, dividends=dividends, splits=splits)
+        prices = apply_adjustments(df=prices, factors=factors, price_cols=['close'])
+    return (prices.sort('Symbol', 'date')
+            .with_columns((pl.col('close') / pl.col('close').shift(1).over('Symbol') - 1).alias('return'))
+            .drop_nulls('return')
+            .select('Symbol', 'date', 'return'))
+
+
+class ReturnCovariance:
+    """
+    Pairwise running sums of the daily returns with the covariance and correlation matrices derived from them
+    """
+    def __init__(self, root: str, min_periods: int = 20):
+        """
+        Initialize the engine, the state saved in the root directory is loaded
+
+        Parameters
+        ----------
+        root: str
+            the local directory of the sums and the matrices
+        min_periods: int
+            the least number of common days of a pair, the pairs with fewer days get NaN
+        """
+        self.root = root
+        self.min_periods = min_periods
+        self.symbols = []
+        # the date of the last return added per ticker
+        self.last_dates = {}
+        self.sums = {x: np.zeros((0, 0)) for x in SUMS}
+        self.generation = None
+        if os.path.exists(os.path.join(root, STATE_FILE)):
+            self._load()
+
+    def _load(self) -> None:
+        with open(os.path.join(self.root, STATE_FILE)) as f:
+            state = json.load(f)
+        self.symbols = state['symbols']
+        self.last_dates = {x: date.fromisoformat(y) for x, y in state['last_dates'].items()}
+        self.generation = state['generation']
+        with np.load(get_generation_path(self.root, 'sums', self.generation)) as sums:
+            self.sums = {x: sums[x] for x in SUMS}
+
+    def save(self) -> None:
+        """
+        Save the running sums and the matrices as a new generation. The state naming the generation is replaced
+        last in one rename, so a save that did not finish leaves the previous generation and its last dates
+        """
+        os.makedirs(self.root, exist_ok=True)
+        generation = uuid.uuid4().hex
+        np.savez(get_generation_path(self.root, 'sums', generation), **self.sums)
+        np.save(get_generation_path(self.root, 'covariance', generation), self.covariance())
+        np.save(get_generation_path(self.root, 'correlation', generation), self.correlation())
+        path = os.path.join(self.root, STATE_FILE)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'symbols': self.symbols, 'min_periods': self.min_periods, 'generation': generation,
+                       'last_dates': {x: y.isoformat() for x, y in self.last_dates.items()}}, f)
+        os.replace(tmp_path, path)
+        self.generation = generation
+        # the files of the previous generations and of unfinished saves, readers that have a matrix of the
+        # previous generation mapped keep reading it
+        for name in os.listdir(self.root):
+            prefix, _, suffix = name.partition('-')
+            if (prefix in GENERATION_FILES and not suffix.startswith(generation)) or name.endswith('.tmp'):
+                os.remove(os.path.join(self.root, name))
+
+    def _add_symbols(self, symbols: list[str]) -> None:
+        """
+        Grow the sums by the new tickers, their pairs start without any common day
+        """
+        new_symbols = [x for x in dict.fromkeys(symbols) if x not in self.symbols]
+        if len(new_symbols) == 0:
+            return
+        self.symbols = self.symbols + new_symbols
+        n = len(self.symbols)
+        for name, array in self.sums.items():
+            grown = np.zeros((n, n))
+            grown[:array.shape[0], :array.shape[1]] = array
+            self.sums[name] = grown
+
+    def add_returns(self, returns: pl.DataFrame) -> int:
+        """
+        Add the returns to the running sums, returns the number of days added. With the mask m of the days a
+        ticker has a return and the returns r set to 0 on the other days, the sums of the pair (i, j) over
+        their common days are
+
+            count[i, j] = sum m_i m_j, sum[i, j] = sum r_i m_j, sum_sq[i, j] = sum r_i^2 m_j, sum_prod[i, j] = sum r_i r_j
+
+        returns: pl.DataFrame
+            the daily returns with the Symbol, date and return columns, see get_returns. Returns on or before
+            the last date added for the ticker are skipped
+        """
+        last_dates = pl.DataFrame({'Symbol': list(self.last_dates.keys()),
+                                   'last_date': list(self.last_dates.values())},
+                                  schema={'Symbol': pl.String, 'last_date': pl.Date})
+        returns = (decode_categories(returns).join(last_dates, on='Symbol', how='left')
+                   .filter(pl.col('last_date').is_null() | (pl.col('date') > pl.col('last_date')))
+                   .filter(pl.col('return').is_finite()))
+        if returns.height == 0:
+            return 0
+        self._add_symbols(returns['Symbol'].unique(maintain_order=True).to_list())
+        # one row per day and one column per ticker in the order of the sums, NaN when the ticker has no return
+        wide = returns.pivot(on='Symbol', index='date', values='return', aggregate_function='last').sort('date')
+        position = {x: i for i, x in enumerate(self.symbols)}
+        columns = sorted(wide.columns[1:], key=position.get)
+        index = np.array([position[x] for x in columns])
+        values = wide.select(columns).to_numpy().astype(np.float64)
+        mask = (~np.isnan(values)).astype(np.float64)
+        values = np.nan_to_num(values)
+        block = np.ix_(index, index)
+        self.sums['count'][block] += mask.T @ mask
+        self.sums['sum'][block] += values.T @ mask
+        self.sums['sum_sq'][block] += (values ** 2).T @ mask
+        self.sums['sum_prod'][block] += values.T @ values
+        for symbol, last_date in returns.group_by('Symbol').agg(pl.col('date').max()).iter_rows():
+            self.last_dates[symbol] = last_date
+        return wide.height
+
+    def update(self,
+               prices: pl.DataFrame,
+               dividends: pl.DataFrame | None = None,
+               splits: pl.DataFrame | None = None) -> int:
+        """
+        Add the returns of the new bars, the prices have to include the last bar already added of every
+        ticker so the first new return can be computed. Returns the number of days added
+        """
+        return self.add_returns(get_returns(prices=prices, dividends=dividends, splits=splits))
+
+    def _moments(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        count = self.sums['count']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = count >= max(self.min_periods, 2)
+            # the mean of ticker i over the common days of (i, j), the transpose is the mean of j
+            mean = np.where(valid, self.sums['sum'] / count, np.nan)
+            cov = (self.sums['sum_prod'] - count * mean * mean.T) / (count - 1)
+            var = (self.sums['sum_sq'] - count * mean ** 2) / (count - 1)
+        return np.where(valid, cov, np.nan), np.where(valid, var, np.nan), count
+
+    def covariance(self) -> np.ndarray:
+        """
+        The sample covariance matrix of the returns, ordered as the symbols
+        """
+        return self._moments()[0]
+
+    def correlation(self) -> np.ndarray:
+        """
+        The correlation matrix of the returns, every pair uses the variances over its common days
+        """
+        cov, var, _ = self._moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return cov / np.sqrt(var * var.T)
+
+    def to_frame(self, matrix: np.ndarray, symbols: list[str] | None = None) -> pl.DataFrame:
+        """
+        The matrix as a data frame with a Symbol column and a column per ticker, optionally only some tickers
+        """
+        symbols = symbols or self.symbols
+        index = [self.symbols.index(x) for x in symbols]
+        return pl.DataFrame({'Symbol': symbols, **{x: matrix[index, i] for x, i in zip(symbols, index)}})
+
+
+def load_matrix(root: str, name: str = 'correlation') -> tuple[list[str], np.ndarray]:
+    """
+    Memory map a saved matrix, returns the symbols of its rows and columns and the matrix
+    """
+    with open(os.path.join(root, STATE_FILE)) as f:
+        state = json.load(f)
+    return state['symbols'], np.load(get_generation_path(root, name, state['generation']), mmap_mode='r')
+
+
+if __name__ == '__main__':
+    import argparse
+    from alpha_utils import init_logger
+    from query import StatementQuery
+    parser = argparse.ArgumentParser(description="update or show the covariance of the daily returns")
+    parser.add_argument('--root', default=os.path.join(os.path.expanduser('~'), '.tt_covariance'))
+    parser.add_argument('--min-periods', type=int, default=20)
+    parser.add_argument('command', choices=['update', 'show'])
+    parser.add_argument('symbols', nargs='*')
+    args = parser.parse_args()
+
+    init_logger("covariance.log")
+    engine = ReturnCovariance(root=args.root, min_periods=args.min_periods)
+    if args.command == 'update':
+        query = StatementQuery()
+        # the bars from the earliest last date on, the last bar added of every ticker is included. The tickers
+        # without a last date are new to the covariance, their bars are read from the earliest stored bar
+        start = min(engine.last_dates.values(), default=date(1900, 1, 1))
+        known = ', '.join(f"'{x}'" for x in engine.last_dates)
+        condition = f"date >= '{start}' OR CAST(Symbol AS VARCHAR) NOT IN ({known})" if known else "TRUE"
+        prices = query.execute(f"SELECT Symbol, date, close FROM prices WHERE {condition}")
+        events = {x: query.execute(f"SELECT * FROM {x}") for x in ['dividends', 'splits']
+                  if query.s3.s3_list(path=f"{x}/")}
+        logging.info(f"Added {engine.update(prices=prices, **events)} days of returns")
+        engine.save()
+    else:
+        with pl.Config(tbl_rows=50, tbl_cols=-1):
+            print(engine.to_frame(engine.correlation(), symbols=args.symbols or None))
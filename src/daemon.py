@@ -0,0 +1,307 @@
+"""
+Daemon mode of the stock tracker. Instead of a batch of queue_depth tickers per invocation, the daemon keeps
+the tracker state, the storage clients and the http pool in memory and retrieves the due tickers one after
+the other, paced at the allowed API rate. The queue updates are written back periodically, the due tickers
+are refreshed daily or when the daemon ran out of work, and SIGTERM or SIGINT finish the current ticker
+and persist the pending updates before exiting.
+
+The health and the statistics of the daemon are served on a local port
+
+    python daemon.py --port 8765 --rate-per-minute 5
+    curl localhost:8765/health
+    curl localhost:8765/stats
+"""
+import json
+import logging
+import signal
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from alpha_utils import get_alpha_key, init_logger
+from alphaio import AlphaIO, STATEMENTS, THROTTLE_MAX_WAIT_SECONDS
+from clients import ApiKeyPool
+from stock_tracker import StockTracker
+
+# the daemon is reported unhealthy when the loop did not make progress for this many seconds longer
+# than it is expected to sleep
+HEALTH_GRACE_SECONDS = 600
+
+
+class _StatusHandler(BaseHTTPRequestHandler):
+    """
+    Serves the health and the statistics of the daemon
+    """
+    tracker_daemon = None
+
+    def do_GET(self):
+        if self.path == '/health':
+            status, body = self.tracker_daemon.health()
+        elif self.path == '/stats':
+            status, body = 200, self.tracker_daemon.get_stats()
+        else:
+            status, body = 404, {'error': f"unknown path {self.path}"}
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class TrackerDaemon:
+    """
+    Long running loop retrieving the due tickers of the queue at the allowed API rate
+    """
+    def __init__(self,
+                 tracker: StockTracker,
+                 rate_per_minute: float = 5.0,
+                 persist_seconds: float = 300,
+                 refresh_seconds: float = 86400,
+                 idle_seconds: float = 3600,
+                 port: int | None = 8765):
+        """
+        Initialize the daemon
+
+        tracker: StockTracker
+            the tracker holding the ticker table and the queue
+        rate_per_minute: float
+            the requests allowed per minute and api key
+        persist_seconds: float
+            the interval the queue updates are written back to s3
+        refresh_seconds: float
+            the interval the ticker table, the queue and the due tickers are refreshed
+        idle_seconds: float
+            the time slept when no ticker is due before refreshing the due tickers, with a lease the sleep is
+            split in steps of half the lease ttl and the lease is renewed after every step
+        port: int
+            the local port of the health and stats endpoints, None to not serve them
+        """
+        self.tracker = tracker
+        self.api_keys = list(get_alpha_key())
+        self.key_pool = ApiKeyPool(keys=self.api_keys, rate_per_minute=rate_per_minute)
+        self.persist_seconds = persist_seconds
+        self.refresh_seconds = refresh_seconds
+        self.idle_seconds = idle_seconds
+        self.port = port
+        self.stop_event = threading.Event()
+        self.alphaio = None
+        self.server = None
+        # the due tickers not retrieved yet and the queue updates not written yet
+        self.pending = []
+        self.downloads = {}
+        self.last_refresh = None
+        self.last_persist = time.monotonic()
+        self.heartbeat = time.monotonic()
+        self.stats = {'started': datetime.now(), 'tickers': 0, 'failed': 0, 'throttled': 0, 'quarantined': 0,
+                      'requests': 0, 'queue_writes': 0, 'refreshes': 0, 'last_ticker': None, 'last_ticker_time': None,
+                      'last_persist_time': None}
+
+    def _new_alphaio(self) -> None:
+        """
+        Start a new AlphaIO object, every persist interval has its own partition of the change log
+        """
+        if self.alphaio is not None:
+            self.stats['requests'] += self.alphaio.request_count
+        self.alphaio = AlphaIO(tickers=[], s3=self.tracker.s3, key_pool=self.key_pool)
+
+    def health(self) -> tuple[int, dict]:
+        """
+        The health of the daemon, unhealthy when the loop stopped making progress
+        """
+        stalled = time.monotonic() - self.heartbeat
+        healthy = stalled < max(self.idle_seconds, self.persist_seconds) + HEALTH_GRACE_SECONDS
+        body = {'status': 'ok' if healthy else 'stalled', 'seconds_since_progress': round(stalled, 1),
+                'stopping': self.stop_event.is_set()}
+        return (200 if healthy else 503), body
+
+    def get_stats(self) -> dict:
+        """
+        The counters of the daemon
+        """
+        requests = self.stats['requests'] + (self.alphaio.request_count if self.alphaio is not None else 0)
+        return {**self.stats, 'requests': requests, 'pending': len(self.pending),
+                'unpersisted': len(self.downloads),
+                'uptime_seconds': round((datetime.now() - self.stats['started']).total_seconds()),
+                'shards': [] if self.tracker.lease is None else sorted(self.tracker.lease.shards)}
+
+    def _renew_lease(self) -> bool:
+        """
+        Extend the lease of the held shard, False when the lease was lost or no shard is held
+        """
+        lease = self.tracker.lease
+        if lease is None or len(lease.renew()) > 0:
+            return True
+        logging.warning("The lease of the shard was lost, refreshing the due tickers ...")
+        return False
+
+    def _sleep(self, seconds: float) -> bool:
+        """
+        Sleep until the time passed or the daemon is stopped, waking up before the lease expires to renew it.
+        Returns False when the lease was lost
+        """
+        lease = self.tracker.lease
+        step = seconds if lease is None else lease.ttl.total_seconds() / 2
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.stop_event.wait(min(remaining, step))
+            self.heartbeat = time.monotonic()
+            if not self._renew_lease():
+                return False
+        return True
+
+    def refresh(self) -> None:
+        """
+        Refresh the ticker table and the queue and take the due tickers of the held shard
+        """
+        self.last_refresh = time.monotonic()
+        self.stats['refreshes'] += 1
+        self.pending = []
+        if not self.tracker.prepare():
+            return
+        lease = self.tracker.lease
+        if lease is not None and len(lease.acquire(max_shards=1)) == 0:
+            logging.warning("No free shard of the queue, waiting for one ...")
+            return
+        if self.tracker.use_earnings_calendar:
+            tickers = self.tracker.get_due_tickers()
+        else:
+            tickers = self.tracker.get_queue_total()
+        if lease is not None:
+            tickers = [x for x in tickers if lease.holds(x)]
+        self.pending = tickers
+        logging.info(f"{len(self.pending)} tickers are due")
+
+    def process(self, ticker: str) -> None:
+        """
+        Retrieve and store the statements of a ticker, the queue update is kept until the next persist.
+        A throttled ticker is rescheduled at the end of the due tickers
+        """
+        api_key = self.api_keys[self.stats['tickers'] % len(self.api_keys)]
+        try:
+            source_data = self.alphaio.get_statement(ticker=ticker, api_key=api_key, statement=STATEMENTS)
+            self.alphaio.process_ticker(ticker=ticker, source_data=source_data)
+            if self.tracker.include_prices:
+                self.alphaio.update_prices(ticker=ticker, api_key=api_key)
+                self.alphaio.update_corporate_actions(ticker=ticker, api_key=api_key)
+            # the tables of the ticker are recorded before the next ticker, the rollups are rewritten with the
+            # statements of all the tickers on the next persist
+            self.alphaio.persist(rollups=False)
+            self.downloads[ticker] = self.alphaio.ticker_tracking_dict.get(ticker, False)
+        except Exception as e:
+            logging.error(f"Could not process {ticker}\n{e}")
+            self.downloads[ticker] = False
+        self.stats['tickers'] += 1
+        if self.downloads[ticker] is None and 'quarantined' in self.alphaio.response_status.get(ticker, {}).values():
+            # a quarantined ticker is held in the queue until the statement is released, it is not retried
+            self.stats['quarantined'] += 1
+        elif self.downloads[ticker] is None:
+            self.stats['throttled'] += 1
+            self.pending.append(ticker)
+        elif not self.downloads[ticker]:
+            self.stats['failed'] += 1
+        self.stats['last_ticker'] = ticker
+        self.stats['last_ticker_time'] = datetime.now()
+
+    def persist(self) -> None:
+        """
+        Update the rollups with the statements of the tickers since the last persist and write the queue
+        updates back to s3
+        """
+        self.last_persist = time.monotonic()
+        if len(self.downloads) == 0:
+            return
+        self.alphaio.persist()
+        self.tracker.write_ticker_queue(download_dict=self.downloads)
+        logging.info(f"Persisted the queue updates of {len(self.downloads)} tickers")
+        self.downloads = {}
+        self.stats['queue_writes'] += 1
+        self.stats['last_persist_time'] = datetime.now()
+        self._new_alphaio()
+
+    def stop(self, signum=None, frame=None) -> None:
+        """
+        Ask the loop to stop after the current ticker
+        """
+        logging.info(f"Received signal {signum}, stopping after the current ticker ...")
+        self.stop_event.set()
+
+    def _start_server(self) -> None:
+        if self.port is None:
+            return
+        handler = type('StatusHandler', (_StatusHandler,), {'tracker_daemon': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Serving /health and /stats on port {self.server.server_address[1]}")
+
+    def run(self) -> None:
+        """
+        Run the loop until SIGTERM or SIGINT is received
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._start_server()
+        self._new_alphaio()
+        try:
+            while not self.stop_event.is_set():
+                self.heartbeat = time.monotonic()
+                if self.last_refresh is None or time.monotonic() - self.last_refresh > self.refresh_seconds:
+                    self.persist()
+                    self.refresh()
+                elif not self._renew_lease():
+                    # the pending tickers may belong to another worker now
+                    self.persist()
+                    self.refresh()
+                if len(self.pending) == 0:
+                    self.persist()
+                    logging.info(f"No ticker is due, sleeping {self.idle_seconds} seconds ...")
+                    self._sleep(self.idle_seconds)
+                    self.last_refresh = None
+                    continue
+                wait = self.key_pool.wait_time()
+                if wait > THROTTLE_MAX_WAIT_SECONDS:
+                    # every key reached its limit, wait for the first key to be usable again
+                    self.persist()
+                    logging.info(f"All api keys are throttled, sleeping {wait:.0f} seconds ...")
+                    if not self._sleep(wait):
+                        self.last_refresh = None
+                    continue
+                self.process(self.pending.pop(0))
+                if time.monotonic() - self.last_persist > self.persist_seconds:
+                    self.persist()
+        finally:
+            self.persist()
+            if self.tracker.lease is not None:
+                self.tracker.lease.release()
+            if self.server is not None:
+                self.server.shutdown()
+            logging.info(f"Stopped after {self.stats['tickers']} tickers")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="retrieve the due tickers continuously")
+    parser.add_argument('--rate-per-minute', type=float, default=5.0, help="requests per minute and api key")
+    parser.add_argument('--persist-seconds', type=float, default=300)
+    parser.add_argument('--idle-seconds', type=float, default=3600)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--include-prices', action='store_true')
+    parser.add_argument('--shards', type=int, default=1,
+                        help="number of queue shards, each worker claims one through a lease")
+    parser.add_argument('--worker-id', default=None)
+    args = parser.parse_args()
+
+    init_logger("stock_tracker_daemon.log")
+    stock_tracker = StockTracker(include_prices=args.include_prices, n_shards=args.shards, worker_id=args.worker_id)
+    TrackerDaemon(tracker=stock_tracker,
+                  rate_per_minute=args.rate_per_minute,
+                  persist_seconds=args.persist_seconds,
+                  idle_seconds=args.idle_seconds,
+                  port=args.port).run()
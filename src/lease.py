@@ -0,0 +1,128 @@
+"""
+Expiring leases on the shared store, used to split the ticker queue into shards so several workers can
+run the tracker at the same time without fetching the same tickers. A lease is a small json document per
+shard holding the worker id and an expiry time, created and taken over with conditional writes.
+"""
+import logging
+import socket
+import os
+import zlib
+from datetime import datetime, timedelta
+from s3io import S3IO, ConditionalWriteError
+
+LEASE_PATH = "stock_tracker/leases"
+
+
+def get_shard(symbol: str, n_shards: int) -> int:
+    """
+    Get the shard of a ticker, stable across processes, hosts and library versions
+    """
+    return zlib.crc32(symbol.encode()) % n_shards
+
+
+def get_worker_id() -> str:
+    """
+    Get an id of the worker that is unique across the hosts
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ShardLease:
+    """
+    Claims and renews expiring leases on shards of the ticker queue
+    """
+    def __init__(self,
+                 s3: S3IO,
+                 worker_id: str,
+                 n_shards: int,
+                 ttl_seconds: int = 3600):
+        """
+        Parameters
+        ----------
+        s3: S3IO
+            the shared store holding the leases
+        worker_id: str
+            the id of this worker
+        n_shards: int
+            the number of shards the queue is split into
+        ttl_seconds: int
+            the time a lease is held without renewal, a crashed worker's shards are free after it
+        """
+        self.s3 = s3
+        self.worker_id = worker_id
+        self.n_shards = n_shards
+        self.ttl = timedelta(seconds=ttl_seconds)
+        # the held shards with the ETag of their lease document
+        self.shards = {}
+
+    def _lease_path(self, shard: int) -> str:
+        return f"{LEASE_PATH}/{self.n_shards}/shard={shard}.json"
+
+    def _lease_document(self) -> dict:
+        return {'worker_id': self.worker_id, 'expires_at': (datetime.now() + self.ttl).isoformat()}
+
+    def try_acquire(self, shard: int) -> bool:
+        """
+        Try to claim a shard, succeeds when the shard has no lease, the lease expired or is already ours
+        """
+        path = self._lease_path(shard)
+        lease, etag = self.s3.s3_read_json_versioned(file_path=path)
+        try:
+            if lease is None:
+                self.shards[shard] = self.s3.s3_write_json(data=self._lease_document(), file_path=path,
+                                                           if_none_match=True)
+                return True
+            expired = datetime.fromisoformat(lease['expires_at']) < datetime.now()
+            if lease['worker_id'] == self.worker_id or expired:
+                self.shards[shard] = self.s3.s3_write_json(data=self._lease_document(), file_path=path,
+                                                           if_match=etag)
+                return True
+        except ConditionalWriteError:
+            logging.info(f"Shard {shard} was claimed by another worker")
+        return False
+
+    def acquire(self, max_shards: int = 1) -> list[int]:
+        """
+        Claim up to max_shards free shards, the search starts at a shard derived from the worker id
+        so workers starting together do not race for the same shard
+        """
+        start = get_shard(self.worker_id, self.n_shards)
+        for i in range(self.n_shards):
+            if len(self.shards) >= max_shards:
+                break
+            shard = (start + i) % self.n_shards
+            if shard not in self.shards:
+                self.try_acquire(shard)
+        logging.info(f"Worker {self.worker_id} holds shards {sorted(self.shards)} of {self.n_shards}")
+        return sorted(self.shards)
+
+    def renew(self) -> list[int]:
+        """
+        Extend the held leases, shards whose lease was taken over after expiring are dropped
+        """
+        for shard, etag in list(self.shards.items()):
+            try:
+                self.shards[shard] = self.s3.s3_write_json(data=self._lease_document(),
+                                                           file_path=self._lease_path(shard), if_match=etag)
+            except ConditionalWriteError:
+                logging.warning(f"Lease of shard {shard} was lost")
+                del self.shards[shard]
+        return sorted(self.shards)
+
+    def release(self) -> None:
+        """
+        Give up the held leases so other workers can claim the shards immediately
+        """
+        for shard, etag in self.shards.items():
+            try:
+                self.s3.s3_write_json(data={'worker_id': self.worker_id, 'expires_at': datetime.now().isoformat()},
+                                      file_path=self._lease_path(shard), if_match=etag)
+            except ConditionalWriteError:
+                logging.warning(f"Lease of shard {shard} was lost before it was released")
+        self.shards = {}
+
+    def holds(self, symbol: str) -> bool:
+        """
+        Check if the ticker belongs to one of the held shards
+        """
+        return get_shard(symbol, self.n_shards) in self.shards
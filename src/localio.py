@@ -0,0 +1,221 @@
+"""
+Local directory store with the same interface as S3IO. The keys of the bucket are laid out as files under
+a root directory, so the tracker can run against a shared local or network file system. Conditional writes
+are made atomic with a lock file per object and an atomic rename of a fully written temporary file.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from s3io import S3IO, ConditionalWriteError
+from alpha_utils import get_bucket_name, get_profile_name, get_local_store_dir
+
+# a lock older than this is left over by a crashed writer and is broken
+STALE_LOCK_SECONDS = 30
+
+
+def get_store(manifest_path: str | None = None) -> S3IO:
+    """
+    Get the store of the tracker data, the local directory store when LOCAL_STORE_DIR is set
+    otherwise the s3 bucket
+
+    Parameters
+    ----------
+    manifest_path: str
+        optional key of the manifest catalog
+    """
+    local_dir = get_local_store_dir()
+    if local_dir:
+        return LocalIO(root=local_dir, manifest_path=manifest_path)
+    return S3IO(bucket=get_bucket_name(), profile=get_profile_name(), manifest_path=manifest_path)
+
+
+class LocalIO(S3IO):
+    """
+    Store keeping the objects in a local directory instead of a bucket
+    """
+    def __init__(self,
+                 root: str,
+                 manifest_path: str | None = None):
+        """
+        Initialization of the LocalIO object.
+
+        Parameters
+        ----------
+        root: str
+            the directory holding the objects
+
+        manifest_path: str
+            optional key of the manifest catalog
+        """
+        super().__init__(bucket=root, manifest_path=manifest_path)
+        self.root = root
+
+    def _path(self, file_path: str) -> str:
+        return os.path.join(self.root, *file_path.split('/'))
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return hashlib.md5(body).hexdigest()
+
+    @staticmethod
+    def _break_lock(lock_path: str) -> None:
+        """
+        Break a stale lock. The lock is renamed to a unique name first, so of several waiters breaking the same
+        lock only one takes it, and a lock created again in the meantime is never removed. A lock found fresh
+        after the rename is put back unless another writer holds the lock by then
+        """
+        stale_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+        os.rename(lock_path, stale_path)
+        if time.time() - os.path.getmtime(stale_path) > STALE_LOCK_SECONDS:
+            logging.warning(f"Breaking stale lock {lock_path}")
+        else:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                logging.warning(f"Lock {lock_path} was taken while it was checked")
+        os.remove(stale_path)
+
+    @contextmanager
+    def _lock(self, path: str, timeout: float = 10.0):
+        """
+        Hold the lock file of an object, created exclusively so only one writer holds it
+        """
+        lock_path = f"{path}.lock"
+        start = time.monotonic()
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                        self._break_lock(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Could not acquire the lock {lock_path}")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def _put_object(self,
+                    file_path: str,
+                    body: bytes,
+                    metadata: dict[str: str] | None = None,
+                    if_match: str | None = None,
+                    if_none_match: bool = False) -> str:
+        path = self._path(file_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write the content first so the rename under the lock is the only step other writers can observe
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            with self._lock(path):
+                current = None
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        current = self._etag(f.read())
+                if if_none_match and current is not None:
+                    raise ConditionalWriteError(f"Conditional write of {file_path} failed: the object exists")
+                if if_match is not None and current != if_match:
+                    raise ConditionalWriteError(f"Conditional write of {file_path} failed: the object changed")
+                os.replace(tmp_path, path)
+                self._write_metadata(path, metadata or {})
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self._etag(body)
+
+    def _get_object(self,
+                    file_path: str,
+                    missing_ok: bool = False) -> tuple[bytes | None, str | None]:
+        try:
+            with open(self._path(file_path), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            if missing_ok:
+                return None, None
+            raise
+        return body, self._etag(body)
+
+    def _open_ranges(self, file_path: str, size: int | None = None):
+        return open(self._path(file_path), 'rb')
+
+    def _head_object(self, file_path: str) -> dict | None:
+        body, etag = self._get_object(file_path=file_path, missing_ok=True)
+        if body is None:
+            return None
+        return {'size': len(body), 'etag': etag, 'metadata': self._read_metadata(self._path(file_path))}
+
+    def _replace_metadata(self, file_path: str, metadata: dict[str: str]) -> str:
+        path = self._path(file_path)
+        with self._lock(path):
+            self._write_metadata(path, metadata)
+        return self._head_object(file_path=file_path)['etag']
+
+    def _delete_object(self, file_path: str) -> None:
+        path = self._path(file_path)
+        with self._lock(path):
+            for x in (path, f"{path}.meta.json"):
+                if os.path.exists(x):
+                    os.remove(x)
+
+    def s3_uri(self, file_path: str) -> str:
+        return self._path(file_path)
+
+    def storage_options(self) -> dict[str: str] | None:
+        return None
+
+    @staticmethod
+    def _write_metadata(path: str, metadata: dict[str: str]) -> None:
+        """
+        user metadata is kept in a sidecar json file next to the object
+        """
+        meta_path = f"{path}.meta.json"
+        if not metadata:
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            return
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def _read_metadata(path: str) -> dict[str: str]:
+        try:
+            with open(f"{path}.meta.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def s3_list_objects(self, path: str = '') -> list[dict]:
+        result = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.lock') or name.endswith('.tmp') or name.endswith('.meta.json'):
+                    continue
+                full_path = os.path.join(directory, name)
+                key = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                if not key.startswith(path):
+                    continue
+                with open(full_path, 'rb') as f:
+                    body = f.read()
+                result.append({'key': key, 'size': len(body), 'etag': self._etag(body),
+                               'last_modified': datetime.fromtimestamp(os.path.getmtime(full_path))})
+        return sorted(result, key=lambda x: x['key'])
@@ -0,0 +1,220 @@
+"""
+Manifest catalog of the tables stored in the bucket. The manifest is a single small parquet file that
+records the key, size, ETag, row count, last fiscal period and fingerprint of every table written through
+S3IO, so existence checks, listings and refresh decisions are local lookups instead of S3 requests.
+"""
+import logging
+import threading
+from datetime import datetime
+import polars as pl
+
+MANIFEST_PATH = "stock_tracker/manifest.parq"
+
+MANIFEST_SCHEMA = {
+    'key': pl.String,
+    'size': pl.Int64,
+    'etag': pl.String,
+    'row_count': pl.Int64,
+    'last_fiscal_period': pl.String,
+    'fingerprint': pl.String,
+    'update_time': pl.Datetime,
+}
+
+# columns holding the period of a record, the maximum is recorded as the last fiscal period
+PERIOD_COLUMNS = ['fiscalDateEnding', 'date']
+
+
+def get_last_period(df: pl.DataFrame) -> str | None:
+    """
+    Get the last period of the records of a table, None if the table has no period column
+    """
+    for column in PERIOD_COLUMNS:
+        if column in df.columns and df.height > 0:
+            value = df.select(pl.col(column).max()).item()
+            return None if value is None else str(value)
+    return None
+
+
+def get_fingerprint(df: pl.DataFrame) -> str:
+    """
+    Get a fingerprint of the content of a table that does not depend on the parquet encoding
+    """
+    return f"{df.height}-{df.hash_rows(seed=0).sum():x}"
+
+
+class Manifest:
+    """
+    Catalog of the stored tables, loaded once and kept in memory, written back with save
+    """
+    def __init__(self, s3, manifest_path: str = MANIFEST_PATH):
+        """
+        Initialize the manifest
+
+        Parameters
+        ----------
+        s3: S3IO
+            the s3 object of the bucket the manifest describes
+        manifest_path: str
+            the key of the manifest file
+        """
+        self.s3 = s3
+        self.manifest_path = manifest_path
+        self._entries = None
+        self._etag = None
+        # keys recorded or removed since the manifest was loaded, replayed when another writer saved first
+        self._changed = set()
+        self._removed = set()
+        # tables are recorded by the threads uploading them in parallel
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self) -> dict[str: dict]:
+        """
+        The manifest entries by key, loaded from s3 on first use
+        """
+        if self._entries is None:
+            self.load()
+        return self._entries
+
+    def load(self) -> None:
+        """
+        Load the manifest from s3, the manifest is rebuilt from a listing of the bucket if it does not exist
+        """
+        df, self._etag = self.s3.s3_read_parquet_versioned(file_path=self.manifest_path)
+        if df is None:
+            logging.warning(f"Manifest {self.manifest_path} does not exist, rebuilding it from the bucket listing")
+            self.rebuild()
+            return
+        self._entries = {x['key']: x for x in df.iter_rows(named=True)}
+        logging.info(f"Loaded manifest with {len(self._entries)} tables")
+
+    def rebuild(self) -> None:
+        """
+        Rebuild the manifest by listing the bucket once, the row count and last fiscal period of the parquet
+        tables are read from their footers with ranged requests
+        """
+        self._entries = {}
+        for obj in self.s3.s3_list_objects():
+            key = obj['key']
+            if key == self.manifest_path:
+                continue
+            entry = {'key': key, 'size': obj['size'], 'etag': obj['etag'],
+                     'row_count': None, 'last_fiscal_period': None, 'fingerprint': None,
+                     'update_time': obj['last_modified']}
+            if key.endswith('.parq') or key.endswith('.parquet'):
+                try:
+                    metadata = self.s3.s3_read_parquet_metadata(file_path=key, size=obj['size'])
+                    entry['row_count'] = metadata.num_rows
+                    entry['last_fiscal_period'] = self._footer_last_period(metadata)
+                except Exception as e:
+                    logging.warning(f"Could not read the parquet footer of {key}\n{e}")
+            self._entries[key] = entry
+            self._changed.add(key)
+        logging.info(f"Rebuilt manifest with {len(self._entries)} tables")
+
+    @staticmethod
+    def _footer_last_period(metadata) -> str | None:
+        """
+        Get the last period from the row group statistics of a parquet footer
+        """
+        names = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+        for column in PERIOD_COLUMNS:
+            if column not in names:
+                continue
+            index = names.index(column)
+            values = []
+            for i in range(metadata.num_row_groups):
+                stats = metadata.row_group(i).column(index).statistics
+                if stats is not None and stats.has_min_max:
+                    values.append(stats.max)
+            return str(max(values)) if values else None
+        return None
+
+    def record(self,
+               key: str,
+               size: int,
+               etag: str,
+               row_count: int | None = None,
+               last_fiscal_period: str | None = None,
+               fingerprint: str | None = None) -> None:
+        """
+        Record a table written to s3
+        """
+        entries = self.entries
+        with self._lock:
+            entries[key] = {'key': key, 'size': size, 'etag': etag, 'row_count': row_count,
+                            'last_fiscal_period': last_fiscal_period, 'fingerprint': fingerprint,
+                            'update_time': datetime.now()}
+            self._changed.add(key)
+            self._removed.discard(key)
+
+    def remove(self, key: str) -> None:
+        """
+        Remove a table deleted from s3
+        """
+        entries = self.entries
+        with self._lock:
+            if entries.pop(key, None) is not None:
+                self._removed.add(key)
+                self._changed.discard(key)
+
+    def get(self, key: str) -> dict | None:
+        """
+        Get the entry of a table, None if the table is not stored
+        """
+        return self.entries.get(key)
+
+    def exists(self, key: str) -> bool:
+        """
+        Check if a table is stored
+        """
+        return key in self.entries
+
+    def list(self, prefix: str) -> list[str]:
+        """
+        List the keys of the stored tables starting with the prefix
+        """
+        return sorted(x for x in self.entries.keys() if x.startswith(prefix))
+
+    def last_fiscal_period(self, key: str) -> str | None:
+        """
+        Get the last fiscal period stored in a table, None if unknown or the table is not stored
+        """
+        entry = self.get(key)
+        return None if entry is None else entry['last_fiscal_period']
+
+    def to_frame(self) -> pl.DataFrame:
+        """
+        The manifest as a dataframe, one row per table
+        """
+        return pl.DataFrame(list(self.entries.values()), schema=MANIFEST_SCHEMA)
+
+    def save(self, retries: int = 5) -> None:
+        """
+        Write the manifest to s3 if it changed since it was loaded. The write is conditional on the
+        manifest not being saved by another writer in the meantime, otherwise the other writer's manifest
+        is loaded, the local changes are replayed on top of it and the write is retried
+        """
+        if len(self._changed) == 0 and len(self._removed) == 0:
+            return
+        from s3io import ConditionalWriteError
+        for _ in range(retries):
+            try:
+                self._etag = self.s3.s3_write_parquet(df=self.to_frame(), file_path=self.manifest_path,
+                                                      write_profile='small-hot',
+                                                      if_match=self._etag, if_none_match=self._etag is None)
+            except ConditionalWriteError:
+                logging.warning("Manifest was saved by another writer, merging ...")
+                changed = {x: self._entries[x] for x in self._changed}
+                removed = set(self._removed)
+                df, self._etag = self.s3.s3_read_parquet_versioned(file_path=self.manifest_path)
+                self._entries = {} if df is None else {x['key']: x for x in df.iter_rows(named=True)}
+                self._entries.update(changed)
+                for key in removed:
+                    self._entries.pop(key, None)
+                continue
+            self._changed = set()
+            self._removed = set()
+            logging.info(f"Saved manifest with {len(self.entries)} tables")
+            return
+        raise ConditionalWriteError(f"Could not save the manifest after {retries} attempts")
@@ -0,0 +1,179 @@
+"""
+Local mirror of the stored tables for analytics. The ticker table and the statement histories of all the
+tickers are kept as uncompressed Arrow IPC files in a local directory, one file per table, so readers
+memory map them instead of downloading and decoding parquet. Processes reading the same file share the
+pages of the OS page cache and loading a table does not copy it.
+
+The mirror is synced incrementally, only the objects whose ETag changed since the last sync are
+downloaded and the rows of their tickers are replaced. The files are replaced atomically, readers that
+have the previous version mapped keep reading it.
+
+    python mirror.py --root ~/.tt_mirror sync
+    python mirror.py --root ~/.tt_mirror show income
+"""
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import polars as pl
+import pyarrow as pa
+from localio import get_store
+from manifest import MANIFEST_PATH
+from alphaio import STATEMENTS
+
+TICKER_TABLE = "stock_tracker/tickers.parq"
+# the file of the mirror holding the ETags of the mirrored objects
+STATE_FILE = "_etags.json"
+
+
+class ArrowMirror:
+    """
+    Memory mapped Arrow IPC mirror of the ticker table and the statement histories
+    """
+    def __init__(self, root: str, s3=None):
+        """
+        Initialize the mirror
+
+        Parameters
+        ----------
+        root: str
+            the local directory of the mirror
+        s3: S3IO
+            the store that is mirrored, the store of the tracker with its manifest if None
+        """
+        self.root = root
+        self._s3 = s3
+
+    @property
+    def s3(self):
+        """
+        The mirrored store, only connected when the mirror is synced
+        """
+        if self._s3 is None:
+            self._s3 = get_store(manifest_path=MANIFEST_PATH)
+        return self._s3
+
+    def tables(self) -> list[str]:
+        """
+        The names of the mirrored tables
+        """
+        return ['tickers'] + STATEMENTS
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.arrow")
+
+    def _load_state(self) -> dict[str: dict[str: str]]:
+        try:
+            with open(os.path.join(self.root, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self, state: dict[str: dict[str: str]]) -> None:
+        path = os.path.join(self.root, STATE_FILE)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    def _write(self, name: str, df: pl.DataFrame) -> None:
+        """
+        Write a table uncompressed so it can be memory mapped, the rename replaces the file atomically
+        """
+        path = self._path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        df.write_ipc(tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+
+    def _list_etags(self) -> dict[str: str]:
+        """
+        The ETags of the stored objects, from the manifest when the store has one
+        """
+        if self.s3.manifest is not None:
+            return {key: x['etag'] for key, x in self.s3.manifest.entries.items()}
+        return {x['key']: x['etag'] for x in self.s3.s3_list_objects()}
+
+    def _read_statement(self, key: str) -> pl.DataFrame:
+        # the statements are stored per ticker, the ticker is the directory of the file
+        df = self.s3.s3_read_parquet(file_path=key)
+        return df.select(pl.lit(key.split('/')[-2]).alias('Symbol'), pl.all())
+
+    def sync(self, tables: list[str] | None = None) -> dict[str: int]:
+        """
+        Download the objects that changed since the last sync and update their tables in the mirror.
+        Returns the number of objects downloaded per table
+
+        Parameters
+        ----------
+        tables: list[str]
+            the tables to sync, all the tables if None
+        """
+        os.makedirs(self.root, exist_ok=True)
+        state = self._load_state()
+        etags = self._list_etags()
+        downloaded = {}
+        for name in tables or self.tables():
+            if name == 'tickers':
+                keys = {x: etags[x] for x in [TICKER_TABLE] if x in etags}
+            else:
+                keys = {x: etag for x, etag in etags.items()
+                        if x.startswith(f"{name}/") and x.split('/')[-1] == f"{name}.parq"}
+            previous = state.get(name, {})
+            exists = os.path.exists(self._path(name))
+            changed = [x for x in keys if not exists or previous.get(x) != keys[x]]
+            removed = [x for x in previous if x not in keys] if exists else []
+            downloaded[name] = len(changed)
+            if len(changed) == 0 and len(removed) == 0:
+                logging.info(f"Mirror of {name} is up to date")
+                continue
+            logging.info(f"Syncing {name}: {len(changed)} changed and {len(removed)} removed objects")
+            if name == 'tickers':
+                df = self.s3.s3_read_parquet(file_path=TICKER_TABLE) if keys else None
+            else:
+                with ThreadPoolExecutor(max_workers=16) as executor:
+                    frames = list(executor.map(self._read_statement, changed))
+                if exists:
+                    # keep the rows of the tickers that did not change
+                    symbols = [x.split('/')[-2] for x in changed + removed]
+                    frames.insert(0, self.read(name).filter(~pl.col('Symbol').is_in(symbols)))
+                df = pl.concat(frames, how='diagonal_relaxed') if frames else None
+            if df is None:
+                os.remove(self._path(name))
+            else:
+                self._write(name, df)
+            state[name] = keys
+            self._save_state(state)
+        return downloaded
+
+    def read(self, name: str) -> pl.DataFrame:
+        """
+        Read a mirrored table, the file is memory mapped instead of read into memory
+        """
+        # the buffers of the table keep the map open, the data is paged in from the file on access
+        table = pa.ipc.open_file(pa.memory_map(self._path(name))).read_all()
+        return pl.from_arrow(table, rechunk=False)
+
+    def scan(self, name: str) -> pl.LazyFrame:
+        """
+        Scan a mirrored table lazily
+        """
+        return pl.scan_ipc(self._path(name))
+
+
+if __name__ == '__main__':
+    import argparse
+    from alpha_utils import init_logger
+    parser = argparse.ArgumentParser(description="sync or read the local Arrow IPC mirror")
+    parser.add_argument('--root', default=os.path.join(os.path.expanduser('~'), '.tt_mirror'))
+    parser.add_argument('command', choices=['sync', 'show'])
+    parser.add_argument('tables', nargs='*')
+    args = parser.parse_args()
+
+    init_logger("mirror.log")
+    mirror = ArrowMirror(root=args.root)
+    if args.command == 'sync':
+        logging.info(f"Downloaded objects per table: {mirror.sync(tables=args.tables or None)}")
+    else:
+        for table in args.tables or mirror.tables():
+            print(table, mirror.read(table))
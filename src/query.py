@@ -0,0 +1,217 @@
+"""
+SQL query layer over the stored dataset. The tracker tables, the statements of all the tickers, their
+trailing twelve month tables and the daily prices are registered as lazily scanned tables of a polars
+SQL context, so queries only read the columns and row groups they need. The symbol, classification and
+currency columns are encoded with the category dictionary, so the joins and filters on them compare codes.
+Sorting on them follows the order the values were registered in, CAST(Sector AS VARCHAR) sorts
+alphabetically. The scans are registered on first use and kept for the next queries, with a cache
+directory the objects are downloaded once and only downloaded again when their ETag in the manifest
+changes.
+
+    python query.py "SELECT Symbol, fiscalDateEnding, totalRevenue FROM income WHERE fiscalDateEnding >= '2024-01-01'"
+
+Tables
+    tickers, tickers_queue, earnings_calendar, manifest: the tracker tables
+    income, balance, cash: the current records of the statements with a Symbol column
+    income_history, balance_history, cash_history: all the versions of the records
+    income_ttm, cash_ttm: the trailing twelve month tables
+    prices: the daily prices
+    dividends, splits: the corporate actions of the tickers
+    changes: the change log of the runs, the records inserted or updated by every run
+    quality: the quality reports of the runs, the values flagged by the data quality checks
+    sector_rollup, industry_rollup: the income statements aggregated by sector, industry and fiscal quarter
+"""
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import polars as pl
+from localio import get_store
+from manifest import MANIFEST_PATH
+from schema_registry import SchemaRegistry, SCD2_COLUMNS
+from categories import CategoryDictionary
+from alphaio import TTM_STATEMENTS
+from rollups import ROLLUP_TABLES
+
+STATEMENTS = ['income', 'balance', 'cash']
+
+TRACKER_TABLES = {
+    'tickers': "stock_tracker/tickers.parq",
+    'tickers_queue': "stock_tracker/tickers_queue.parq",
+    'earnings_calendar': "stock_tracker/earnings_calendar.parq",
+    'manifest': MANIFEST_PATH,
+}
+
+# the column holding the path of the scanned file, the ticker of the statements is taken from it
+_PATH_COLUMN = '__file_path'
+
+
+class StatementQuery:
+    """
+    Runs SQL queries over the stored tables
+    """
+    def __init__(self, s3=None, cache_dir: str | None = None):
+        """
+        Initialize the query layer
+
+        Parameters
+        ----------
+        s3: S3IO
+            the store of the tables, the store of the tracker with its manifest if None
+        cache_dir: str
+            optional directory the objects of a remote store are downloaded to, without it the objects
+            are scanned remotely by every query
+        """
+        self.s3 = s3 if s3 is not None else get_store(manifest_path=MANIFEST_PATH)
+        self.schemas = SchemaRegistry(s3=self.s3)
+        self.categories = CategoryDictionary(s3=self.s3)
+        self.cache_dir = cache_dir
+        self.context = pl.SQLContext()
+        self._registered = set()
+
+    def tables(self) -> list[str]:
+        """
+        The names of the tables that can be queried
+        """
+        names = list(TRACKER_TABLES.keys())
+        names += STATEMENTS + [f"{x}_history" for x in STATEMENTS] + [f"{x}_ttm" for x in TTM_STATEMENTS]
+        names += [f"{x}_rollup" for x in ROLLUP_TABLES]
+        return names + ['prices', 'dividends', 'splits', 'changes', 'quality']
+
+    def _list_keys(self, prefix: str, file_name: str | None = None) -> list[str]:
+        keys = [x for x in self.s3.s3_list(path=prefix) if x.endswith('.parq')]
+        if file_name is not None:
+            keys = [x for x in keys if x.split('/')[-1] == file_name]
+        return keys
+
+    def _download(self, key: str) -> str:
+        """
+        Download an object to the cache directory unless the cached copy has the current ETag
+        """
+        path = os.path.join(self.cache_dir, *key.split('/'))
+        entry = self.s3.manifest.get(key) if self.s3.manifest is not None else None
+        if entry is not None and os.path.exists(path) and os.path.exists(f"{path}.etag"):
+            with open(f"{path}.etag") as f:
+                if f.read() == entry['etag']:
+                    return path
+        body, etag = self.s3._get_object(file_path=key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        with open(f"{path}.etag", 'w') as f:
+            f.write(etag)
+        return path
+
+    def _scan(self, keys: list[str], schema: dict[str: pl.DataType] | None = None) -> pl.LazyFrame:
+        """
+        Scan the objects as one table, files missing columns of the schema get nulls
+        """
+        storage_options = self.s3.storage_options()
+        if self.cache_dir is not None and storage_options is not None:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                sources = list(executor.map(self._download, keys))
+            storage_options = None
+        else:
+            sources = [self.s3.s3_uri(x) for x in keys]
+        return pl.scan_parquet(sources, schema=schema, storage_options=storage_options,
+                               include_file_paths=_PATH_COLUMN, missing_columns='insert', extra_columns='ignore')
+
+    def _statement_schema(self, statement: str) -> dict[str: pl.DataType] | None:
+        columns = self.schemas.columns(statement)
+        if len(columns) == 0:
+            return None
+        return {**columns, 'is_current': pl.Boolean, 'update_time': pl.Datetime('us')}
+
+    def _build(self, name: str) -> pl.LazyFrame | None:
+        """
+        Build the scan of a table, None if nothing is stored for it
+        """
+        if name == 'manifest' and self.s3.manifest is not None:
+            # the manifest does not list itself
+            return self.s3.manifest.to_frame().lazy()
+        if name in TRACKER_TABLES:
+            keys = self._list_keys(prefix=TRACKER_TABLES[name])
+            return self._scan(keys).drop(_PATH_COLUMN) if keys else None
+        if name.endswith('_rollup'):
+            keys = self._list_keys(prefix=ROLLUP_TABLES[name.removesuffix('_rollup')])
+            return self._scan(keys).drop(_PATH_COLUMN) if keys else None
+        if name in ('changes', 'quality'):
+            keys = self._list_keys(prefix=f"{name}/")
+            return self._scan(keys).drop(_PATH_COLUMN) if keys else None
+        if name in ('prices', 'dividends', 'splits'):
+            keys = self._list_keys(prefix=f"{name}/")
+            if not keys:
+                return None
+            # the tables are stored per ticker, the tickers stored before their writers registered them
+            self.categories.register(pl.DataFrame({'Symbol': [x.split('/')[-2] for x in keys]}))
+            return self._scan(keys).drop(_PATH_COLUMN)
+        statement, _, kind = name.partition('_')
+        file_name = f"{statement}_ttm.parq" if kind == 'ttm' else f"{statement}.parq"
+        keys = self._list_keys(prefix=f"{statement}/", file_name=file_name)
+        if not keys:
+            return None
+        lf = self._scan(keys, schema=None if kind == 'ttm' else self._statement_schema(statement))
+        # the statements are stored per ticker, the ticker is the directory of the file
+        self.categories.register(pl.DataFrame({'Symbol': [x.split('/')[-2] for x in keys]}))
+        lf = lf.with_columns(pl.col(_PATH_COLUMN).str.split('/').list.get(-2).alias('Symbol'))
+        lf = lf.select('Symbol', pl.exclude('Symbol', _PATH_COLUMN))
+        if kind == '':
+            lf = lf.filter(pl.col('is_current')).drop(SCD2_COLUMNS)
+        return lf
+
+    def register(self, name: str) -> None:
+        """
+        Register the scan of a table in the SQL context, the scan is kept until refresh is called
+        """
+        if name in self._registered:
+            return
+        lf = self._build(name)
+        if lf is None:
+            logging.warning(f"Nothing is stored for table {name}, it is not registered")
+            return
+        # the writers register the values before the manifest lists their files, a value missing from the
+        # dictionary fails the query instead of being read as a null
+        lf = self.categories.encode(lf, register=False)
+        self.context.register(name, lf)
+        self._registered.add(name)
+
+    def refresh(self) -> None:
+        """
+        Drop the registered scans so the next queries see the tables written since they were registered
+        """
+        for name in self._registered:
+            self.context.unregister(name)
+        self._registered = set()
+        self.schemas = SchemaRegistry(s3=self.s3)
+        self.categories = CategoryDictionary(s3=self.s3)
+        if self.s3.manifest is not None:
+            self.s3.manifest.load()
+
+    def execute(self, query: str, eager: bool = True) -> pl.DataFrame | pl.LazyFrame:
+        """
+        Run a SQL query, the tables it references are registered on first use
+
+        Parameters
+        ----------
+        query: str
+            the SQL query
+        eager: bool
+            collect the result, otherwise the lazy frame of the query is returned
+        """
+        for name in self.tables():
+            if re.search(rf"\b{name}\b", query, flags=re.IGNORECASE):
+                self.register(name)
+        return self.context.execute(query, eager=eager)
+
+
+if __name__ == '__main__':
+    import argparse
+    from alpha_utils import init_logger
+    parser = argparse.ArgumentParser(description="run a SQL query over the stored tables")
+    parser.add_argument('query')
+    parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+
+    init_logger("query.log")
+    with pl.Config(tbl_rows=50, tbl_cols=-1):
+        print(StatementQuery(cache_dir=args.cache_dir).execute(args.query))
@@ -0,0 +1,294 @@
+"""
+Sector and industry rollups of the income statements, keyed by sector, industry and fiscal quarter. The
+rollup tables hold the partial aggregates of every group, the number of tickers, the sums of the income
+fields and the market cap weighted sums of the margins, with the totals, margins, medians and weighted
+averages derived from them. Every ticker's contribution to its groups, one row per ticker and quarter, is
+stored alongside. When the statements of a ticker change its previous contribution is subtracted from the
+partial aggregates and the new one added, only the medians of the affected groups are recomputed from the
+contributions of these groups.
+
+The fiscal quarter of a record is the calendar quarter its fiscal period ends in, the market cap and the
+classification of a ticker are the current ones of the ticker table. The stored contributions of the tickers
+whose classification or market cap changed are moved to their current groups on every save and when the
+ticker table is refreshed. The sums only add the statements reported in ROLLUP_CURRENCY.
+
+    SELECT Sector, fiscalQuarter, totalRevenue, netMargin_median FROM sector_rollup ORDER BY fiscalQuarter
+"""
+import logging
+import threading
+import polars as pl
+from s3io import ConditionalWriteError
+
+ROLLUP_STATEMENT = 'income'
+ROLLUP_CURRENCY = 'USD'
+CONTRIBUTIONS_TABLE = "rollups/contributions.parq"
+ROLLUP_TABLES = {'sector': "rollups/sector.parq", 'industry': "rollups/industry.parq"}
+ROLLUP_KEYS = {'sector': ['Sector'], 'industry': ['Sector', 'Industry']}
+QUARTER_COLUMN = 'fiscalQuarter'
+# parquet write profile of the rollup tables, see s3io.WRITE_PROFILES
+ROLLUP_WRITE_PROFILE = 'small-hot'
+
+# the fields added up per group and the margins, the ratio of a field to the revenue
+TOTAL_FIELDS = ['totalRevenue', 'grossProfit', 'operatingIncome', 'netIncome']
+MARGINS = {'grossMargin': 'grossProfit', 'operatingMargin': 'operatingIncome', 'netMargin': 'netIncome'}
+# the partial aggregates, they are updated by adding and subtracting the contributions
+PARTIAL_COLUMNS = (['n_tickers'] + TOTAL_FIELDS + [f"{x}_weighted_sum" for x in MARGINS]
+                   + [f"{x}_weight" for x in MARGINS])
+MEDIAN_COLUMNS = [f"{x}_median" for x in MARGINS]
+
+
+def get_contributions(statements: pl.DataFrame, tickers: pl.DataFrame) -> pl.DataFrame:
+    """
+    Get the contribution of the tickers to their groups, one row per ticker and fiscal quarter with the
+    classification, the market cap, the income fields and the margins
+
+    statements: pl.DataFrame
+        the current records of the income statements with a Symbol column
+    tickers: pl.DataFrame
+        the current records of the ticker table, the tickers without a sector are left out
+    """
+    period = pl.col('fiscalDateEnding').str.to_date(strict=False)
+    if 'reportedCurrency' in statements.columns:
+        statements = statements.filter(pl.col('reportedCurrency') == ROLLUP_CURRENCY)
+    statements = statements.with_columns([pl.lit(None, dtype=pl.Float64).alias(x)
+                                          for x in TOTAL_FIELDS if x not in statements.columns])
+    revenue = pl.col('totalRevenue')
+    return (statements
+            .with_columns((period.dt.year().cast(pl.String) + 'Q' + period.dt.quarter().cast(pl.String))
+                          .alias(QUARTER_COLUMN))
+            .drop_nulls(QUARTER_COLUMN)
+            # a quarter with two fiscal periods, after a change of the fiscal year, keeps the last one
+            .sort('Symbol', 'fiscalDateEnding')
+            .unique(subset=['Symbol', QUARTER_COLUMN], keep='last', maintain_order=True)
+            .join(tickers.filter(pl.col('Sector').is_not_null())
+                  .select('Symbol', 'Sector', 'Industry', pl.col('Market Cap').cast(pl.Float64)),
+                  on='Symbol', how='inner')
+            .select('Symbol', 'Sector', 'Industry', QUARTER_COLUMN, 'Market Cap',
+                    *[pl.col(x).cast(pl.Float64) for x in TOTAL_FIELDS],
+                    *[pl.when(revenue > 0).then(pl.col(y).cast(pl.Float64) / revenue).alias(x)
+                      for x, y in MARGINS.items()]))
+
+
+def reclassify_contributions(contributions: pl.DataFrame,
+                             tickers: pl.DataFrame) -> tuple[pl.DataFrame, list[str]]:
+    """
+    Get the contributions of the tickers whose classification or market cap in the ticker table differs from
+    their stored contributions, with the current values. Returns the updated contributions and the changed
+    tickers, a ticker without a sector in the ticker table has no contributions anymore
+
+    contributions: pl.DataFrame
+        the stored contributions
+    tickers: pl.DataFrame
+        the current records of the ticker table
+    """
+    columns = ['Sector', 'Industry', 'Market Cap']
+    current = (tickers.filter(pl.col('Sector').is_not_null())
+               .select('Symbol', 'Sector', 'Industry', pl.col('Market Cap').cast(pl.Float64))
+               .with_columns(pl.col('Symbol', 'Sector', 'Industry').cast(pl.String)))
+    joined = (contributions.join(current, on='Symbol', how='left', suffix='_current')
+              .filter(pl.any_horizontal(pl.col(x).ne_missing(pl.col(f"{x}_current")) for x in columns)))
+    symbols = joined['Symbol'].unique(maintain_order=True).to_list()
+    reclassified = (joined.filter(pl.col('Sector_current').is_not_null())
+                    .with_columns(pl.col(f"{x}_current").alias(x) for x in columns)
+                    .select(contributions.columns))
+    return reclassified, symbols
+
+
+def partial_aggregates(contributions: pl.DataFrame, keys: list[str]) -> pl.DataFrame:
+    """
+    Aggregate the contributions into the partial aggregates of the groups, the market cap weights of a margin
+    only count the tickers with the margin
+    """
+    market_cap = pl.col('Market Cap')
+    return contributions.group_by(keys + [QUARTER_COLUMN]).agg(
+        pl.len().cast(pl.Int64).alias('n_tickers'),
+        *[pl.col(x).sum() for x in TOTAL_FIELDS],
+        *[(pl.col(x) * market_cap).sum().alias(f"{x}_weighted_sum") for x in MARGINS],
+        *[market_cap.filter(pl.col(x).is_not_null()).sum().alias(f"{x}_weight") for x in MARGINS],
+    )
+
+
+def _finalize(partials: pl.DataFrame, medians: pl.DataFrame, keys: list[str]) -> pl.DataFrame:
+    """
+    Add the medians and derive the margins of the totals and the market cap weighted margins
+    """
+    group = keys + [QUARTER_COLUMN]
+    return (partials.join(medians, on=group, how='left', nulls_equal=True)
+            .with_columns(
+                *[pl.when(pl.col('totalRevenue') > 0).then(pl.col(y) / pl.col('totalRevenue')).alias(x)
+                  for x, y in MARGINS.items()],
+                *[pl.when(pl.col(f"{x}_weight") > 0).then(pl.col(f"{x}_weighted_sum") / pl.col(f"{x}_weight"))
+                  .alias(f"{x}_mcap_weighted") for x in MARGINS])
+            .sort(group))
+
+
+def update_rollups(contributions: pl.DataFrame | None,
+                   rollups: dict[str: pl.DataFrame | None],
+                   new_contributions: pl.DataFrame,
+                   symbols: list[str]) -> tuple[pl.DataFrame, dict[str: pl.DataFrame]]:
+    """
+    Replace the contributions of the tickers and update the rollup tables. The partial aggregates of a stored
+    rollup table are updated by subtracting the replaced rows and adding the new ones, the medians are only
+    recomputed for the groups of these rows. A missing rollup table is computed from all the contributions.
+    Returns the updated contributions and rollup tables
+
+    contributions: pl.DataFrame
+        the stored contributions, None if nothing is stored yet
+    rollups: dict[str: pl.DataFrame]
+        the stored rollup table per level of ROLLUP_KEYS, None when it has to be computed from scratch
+    new_contributions: pl.DataFrame
+        the contributions of the tickers, see get_contributions
+    symbols: list[str]
+        the tickers whose contributions are replaced, a ticker without new contributions is removed
+    """
+    if contributions is None:
+        contributions = new_contributions.head(0)
+    new_contributions = new_contributions.select(contributions.columns)
+    symbols = pl.Series(symbols, dtype=pl.String).implode()
+    replaced = contributions.filter(pl.col('Symbol').is_in(symbols))
+    # the rows that did not change cancel out, they do not affect any group
+    removed = replaced.join(new_contributions, on=contributions.columns, how='anti', nulls_equal=True)
+    added = new_contributions.join(replaced, on=contributions.columns, how='anti', nulls_equal=True)
+    contributions = pl.concat([contributions.filter(~pl.col('Symbol').is_in(symbols)), new_contributions])
+    tables = {}
+    for level, keys in ROLLUP_KEYS.items():
+        group = keys + [QUARTER_COLUMN]
+        stored = rollups.get(level)
+        if stored is None:
+            logging.info(f"Computing the {level} rollup from the contributions of all the tickers")
+            partials = partial_aggregates(contributions, keys)
+            affected = contributions.select(group).unique()
+            medians = stored_medians = None
+        else:
+            partials = pl.concat([stored.select(group + PARTIAL_COLUMNS),
+                                  partial_aggregates(added, keys),
+                                  partial_aggregates(removed, keys).with_columns(-pl.col(PARTIAL_COLUMNS))],
+                                 how='vertical_relaxed')
+            partials = (partials.group_by(group).agg(pl.col(PARTIAL_COLUMNS).sum())
+                        .filter(pl.col('n_tickers') > 0))
+            affected = pl.concat([added.select(group), removed.select(group)]).unique()
+            stored_medians = (stored.select(group + MEDIAN_COLUMNS)
+                              .join(affected, on=group, how='anti', nulls_equal=True))
+        medians = (contributions.join(affected, on=group, how='semi', nulls_equal=True)
+                   .group_by(group).agg(pl.col(x).median().alias(f"{x}_median") for x in MARGINS))
+        if stored_medians is not None:
+            medians = pl.concat([stored_medians, medians], how='vertical_relaxed')
+        tables[level] = _finalize(partials, medians, keys)
+        logging.info(f"Updated {affected.height} groups of the {level} rollup")
+    return contributions, tables
+
+
+class SectorRollup:
+    """
+    Collects the income statements written by a run and updates the stored rollups with them in one pass
+    """
+    def __init__(self, s3, tickers_table: str = "stock_tracker/tickers.parq", categories=None):
+        """
+        Initialize the rollup
+
+        Parameters
+        ----------
+        s3: S3IO
+            the store of the statements and the rollup tables
+        tickers_table: str
+            the ticker table with the classification and the market cap of the tickers
+        categories: CategoryDictionary
+            optional dictionary the classifications of the rollups are registered in, saved by its owner
+        """
+        self.s3 = s3
+        self.tickers_table = tickers_table
+        self.categories = categories
+        # the current income records per ticker written since the last save
+        self.pending = {}
+        # statements are written by the threads retrieving them in parallel
+        self._lock = threading.Lock()
+
+    def add(self, ticker: str, statement: pl.DataFrame) -> None:
+        """
+        Add the income statement of a ticker written by the run, its contributions are replaced on save
+        """
+        if 'is_current' in statement.columns:
+            statement = statement.filter(pl.col('is_current') == True).drop(['is_current', 'update_time'])
+        with self._lock:
+            self.pending[ticker] = statement.with_columns(pl.lit(ticker).alias('Symbol'))
+
+    def _get_tickers(self) -> pl.DataFrame | None:
+        if not self.s3.s3_exists(file_path=self.tickers_table):
+            return None
+        columns = ['Symbol', 'Sector', 'Industry', 'Market Cap', 'is_current']
+        return (self.s3.s3_read_parquet(file_path=self.tickers_table, columns=columns)
+                .filter(pl.col('is_current') == True))
+
+    def _get_rollup(self, level: str, contributions_etag: str | None) -> pl.DataFrame | None:
+        """
+        Get a stored rollup table, None when it was not built from the stored contributions, which happens
+        when a writer stopped between writing the contributions and the rollup tables
+        """
+        if contributions_etag is None:
+            return None
+        metadata = self.s3.s3_get_metadata(file_path=ROLLUP_TABLES[level])
+        if metadata is None or metadata.get('contributions-etag') != contributions_etag:
+            if metadata is not None:
+                logging.warning(f"The {level} rollup does not match the stored contributions, rebuilding it")
+            return None
+        return self.s3.s3_read_parquet(file_path=ROLLUP_TABLES[level])
+
+    def save(self, retries: int = 5, reclassify: bool = False) -> None:
+        """
+        Update the stored rollups with the statements added since the last save, the contributions of the other
+        tickers whose classification or market cap changed are moved to their current groups. The contributions
+        are written conditionally on not being written by another writer in the meantime, otherwise they are
+        reloaded and the update is applied again. The rollup tables are written after them with the ETag of the
+        contributions
+
+        reclassify: bool
+            also update the rollups when no statements were added, after the ticker table was refreshed
+        """
+        with self._lock:
+            if len(self.pending) == 0 and not reclassify:
+                return
+            tickers = self._get_tickers()
+            if tickers is None:
+                logging.warning(f"No ticker table {self.tickers_table}, the rollups are not updated")
+                return
+            pending_symbols = list(self.pending.keys())
+            new_contributions = None
+            if len(self.pending) > 0:
+                new_contributions = get_contributions(pl.concat(list(self.pending.values()), how='diagonal_relaxed'),
+                                                      tickers)
+                if self.categories is not None:
+                    self.categories.register(new_contributions)
+            for _ in range(retries):
+                contributions, etag = self.s3.s3_read_parquet_versioned(file_path=CONTRIBUTIONS_TABLE)
+                symbols = list(pending_symbols)
+                changed = new_contributions
+                if contributions is not None:
+                    reclassified, reclassified_symbols = reclassify_contributions(
+                        contributions.filter(~pl.col('Symbol').is_in(pl.Series(symbols, dtype=pl.String).implode())),
+                        tickers)
+                    if len(reclassified_symbols) > 0:
+                        logging.info(f"Moving the contributions of {len(reclassified_symbols)} reclassified tickers")
+                    symbols += reclassified_symbols
+                    changed = (reclassified if changed is None
+                               else pl.concat([changed, reclassified.select(changed.columns)], how='vertical_relaxed'))
+                if changed is None or len(symbols) == 0:
+                    self.pending = {}
+                    return
+                rollups = {x: self._get_rollup(level=x, contributions_etag=etag) for x in ROLLUP_TABLES}
+                contributions, tables = update_rollups(contributions=contributions, rollups=rollups,
+                                                       new_contributions=changed, symbols=symbols)
+                try:
+                    etag = self.s3.s3_write_parquet(df=contributions, file_path=CONTRIBUTIONS_TABLE,
+                                                    write_profile=ROLLUP_WRITE_PROFILE,
+                                                    if_match=etag, if_none_match=etag is None)
+                except ConditionalWriteError:
+                    logging.warning("Rollup contributions were written by another writer, reloading ...")
+                    continue
+                for level, df in tables.items():
+                    self.s3.s3_write_parquet(df=df, file_path=ROLLUP_TABLES[level],
+                                             metadata={'contributions-etag': etag},
+                                             write_profile=ROLLUP_WRITE_PROFILE)
+                logging.info(f"Updated the rollups with the contributions of {len(symbols)} tickers")
+                self.pending = {}
+                return
+            raise ConditionalWriteError(f"Could not update the rollups after {retries} attempts")
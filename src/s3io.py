@@ -12,10 +12,199 @@ __AUTHORS__ = "Terrill, Nebiyu, Estephanos"
 __status__ = "Development"
 
 import logging
-import boto3
-import tempfile
+import json
+import io
 import os
 import polars as pl
+from clients import get_boto_session, get_s3_client, get_s3_resource
+
+# low cardinality string columns that are dictionary encoded by the profiles that ask for it
+DICTIONARY_COLUMNS = ['reportedCurrency', 'Symbol', 'Sector', 'Industry', 'Country', 'Market Cap Name']
+
+# named parquet write profiles, the keys are passed to pl.DataFrame.write_parquet except for
+# dictionary which dictionary encodes the DICTIONARY_COLUMNS present in the frame
+WRITE_PROFILES = {
+    # polars defaults
+    'default': {},
+    # small tables read and rewritten on every run, cheap to encode and decode
+    'small-hot': {'compression': 'lz4', 'statistics': True},
+    # rarely read history, smallest size at the cost of write time
+    'archive': {'compression': 'zstd', 'compression_level': 19, 'statistics': False, 'dictionary': True},
+    # statement tables scanned across tickers, row group statistics for predicate pushdown
+    'scan-optimized': {'compression': 'zstd', 'compression_level': 3, 'statistics': True,
+                       'row_group_size': 65536, 'dictionary': True},
+}
+
+
+def decode_categories(df: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Function casts the enum and categorical columns back to strings. The enums of the category dictionary are
+    stored in the parquet metadata of every file, files written with different versions of the dictionary
+    could not be scanned together, so the tables are stored with dictionary encoded strings
+
+    Parameters
+    ----------
+    df: pl.DataFrame | pl.LazyFrame
+        polars dataframe with encoded columns, see categories.CategoryDictionary
+    """
+    columns = [x for x, dtype in df.collect_schema().items() if isinstance(dtype, (pl.Enum, pl.Categorical))]
+    if len(columns) == 0:
+        return df
+    return df.with_columns(pl.col(columns).cast(pl.String))
+
+
+def write_parquet_profile(df: pl.DataFrame,
+                          file,
+                          write_profile: str = 'default') -> None:
+    """
+    Function writes a dataframe as parquet using a named write profile
+
+    Parameters
+    ----------
+    df: pl.DataFrame
+        local polars dataframe
+
+    file: str | IO[bytes]
+        the local path or buffer the parquet is written to
+
+    write_profile: str
+        the name of the profile in WRITE_PROFILES
+    """
+    if write_profile not in WRITE_PROFILES:
+        raise ValueError(f"Unknown write profile {write_profile}, expected one of {list(WRITE_PROFILES.keys())}")
+    options = dict(WRITE_PROFILES[write_profile])
+    if options.pop('dictionary', False):
+        # only the pyarrow writer allows choosing the dictionary encoded columns
+        options['use_pyarrow'] = True
+        options['pyarrow_options'] = {'use_dictionary': [x for x in df.columns if x in DICTIONARY_COLUMNS]}
+    df.write_parquet(file, **options)
+
+
+# comparison operators accepted in the read filters, following the pyarrow (column, op, value) convention
+_FILTER_OPS = {
+    '==': lambda col, val: col == val,
+    '=': lambda col, val: col == val,
+    '!=': lambda col, val: col != val,
+    '<': lambda col, val: col < val,
+    '<=': lambda col, val: col <= val,
+    '>': lambda col, val: col > val,
+    '>=': lambda col, val: col >= val,
+    'in': lambda col, val: col.is_in(list(val)),
+    'not in': lambda col, val: ~col.is_in(list(val)),
+}
+
+
+def filters_to_expr(filters: list[tuple]) -> pl.Expr:
+    """
+    Function converts a list of (column, op, value) filters into a polars expression,
+    the filters are combined with a logical and
+    """
+    for column, op, value in filters:
+        if op not in _FILTER_OPS:
+            raise ValueError(f"Unsupported filter operator {op}, expected one of {list(_FILTER_OPS.keys())}")
+    return pl.all_horizontal(_FILTER_OPS[op](pl.col(column), value) for column, op, value in filters)
+
+
+def _row_group_may_match(row_group, column_index: dict[str: int], filters: list[tuple]) -> bool:
+    """
+    Function checks the min max statistics of a parquet row group against the filters,
+    False is only returned when no row of the row group can match
+    """
+    for column, op, value in filters:
+        if column not in column_index:
+            continue
+        stats = row_group.column(column_index[column]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        low, high = stats.min, stats.max
+        try:
+            if op in ('==', '=') and (value < low or value > high):
+                return False
+            if op == 'in' and all(x < low or x > high for x in value):
+                return False
+            if op == '<' and low >= value:
+                return False
+            if op == '<=' and low > value:
+                return False
+            if op == '>' and high <= value:
+                return False
+            if op == '>=' and high < value:
+                return False
+            if op == '!=' and low == high == value:
+                return False
+        except TypeError:
+            # statistics not comparable with the value, keep the row group
+            continue
+    return True
+
+
+class ConditionalWriteError(Exception):
+    """
+    Raised when a conditional write fails because the object was created or changed by another writer
+    """
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Read only, seekable file object over an s3 object where every read is a ranged GET. Parquet readers
+    use it to fetch the footer first and then only the column chunks of the row groups they need
+    """
+    def __init__(self, s3_client, bucket: str, key: str, size: int | None = None):
+        """
+        Parameters
+        ----------
+        s3_client:
+            the boto3 s3 client
+        bucket: str
+            The name of the AWS bucket
+        key: str
+            the key of the object
+        size: int
+            the size of the object in bytes, retrieved with a HEAD request if not passed
+        """
+        super().__init__()
+        self._client = s3_client
+        self.bucket = bucket
+        self.key = key
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.size = size
+        self._pos = 0
+        self.requests = 0
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        n_bytes = min(len(buffer), self.size - self._pos)
+        if n_bytes <= 0:
+            return 0
+        obj = self._client.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range=f"bytes={self._pos}-{self._pos + n_bytes - 1}")
+        data = obj['Body'].read()
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        self.requests += 1
+        self.bytes_read += len(data)
+        return len(data)
 
 
 class S3IO():
@@ -26,7 +215,8 @@ class S3IO():
     # initialization
     def __init__(self,
                  bucket: str,
-                 profile: str = 'default'):
+                 profile: str = 'default',
+                 manifest_path: str | None = None):
         """
         Initialization of the S3IO object.
 
@@ -38,18 +228,185 @@ class S3IO():
         profile: str
             The name of the profile that holds the access key
             and access id in the AWS credentials file
+
+        manifest_path: str
+            optional key of the manifest catalog. When set every parquet write is recorded
+            in the manifest and existence checks and listings are answered from it
         """
         self.bucket = bucket
         self._profile = profile
-        # establish a connection with s3
-        logging.info("Establishing a connection with S3 using passed parameters")
+        self.manifest_path = manifest_path
+        self._manifest = None
+
+    @property
+    def s3_client(self):
+        """
+        The s3 client shared across the process, the connection is established on first use
+        """
+        return get_s3_client(profile=self._profile)
+
+    @property
+    def s3_resource(self):
+        """
+        The s3 resource shared across the process, the connection is established on first use
+        """
+        return get_s3_resource(profile=self._profile)
+
+    @property
+    def manifest(self):
+        """
+        The manifest catalog of the bucket, None if the object was initialized without a manifest path
+        """
+        if self.manifest_path is None:
+            return None
+        if self._manifest is None:
+            from manifest import Manifest
+            self._manifest = Manifest(s3=self, manifest_path=self.manifest_path)
+        return self._manifest
+
+    # storage primitives, the only methods talking to s3 directly
+
+    def _put_object(self,
+                    file_path: str,
+                    body: bytes,
+                    metadata: dict[str: str] | None = None,
+                    if_match: str | None = None,
+                    if_none_match: bool = False) -> str:
+        """
+        Function writes the bytes of an object and returns its ETag. The write fails with a
+        ConditionalWriteError when if_match is passed and the object has a different ETag, or
+        when if_none_match is set and the object already exists
+        """
+        from botocore.exceptions import ClientError
+        extra_args = {}
+        if metadata:
+            extra_args['Metadata'] = metadata
+        if if_match is not None:
+            extra_args['IfMatch'] = f'"{if_match}"'
+        if if_none_match:
+            extra_args['IfNoneMatch'] = '*'
         try:
-            session = boto3.Session(profile_name=self._profile)
+            obj = self.s3_client.put_object(Bucket=self.bucket, Key=file_path, Body=body, **extra_args)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise ConditionalWriteError(f"Conditional write of {file_path} failed: {e}")
+            raise
+        return obj['ETag'].strip('"')
+
+    def _get_object(self,
+                    file_path: str,
+                    missing_ok: bool = False) -> tuple[bytes | None, str | None]:
+        """
+        Function reads the bytes and the ETag of an object, (None, None) is returned for a
+        missing object when missing_ok is set
+        """
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket, Key=file_path)
+        except self.s3_client.exceptions.NoSuchKey:
+            if missing_ok:
+                return None, None
+            raise
+        return obj['Body'].read(), obj['ETag'].strip('"')
+
+    def _open_ranges(self, file_path: str, size: int | None = None) -> io.RawIOBase:
+        """
+        Function opens a seekable file over an object where every read is a ranged GET
+        """
+        return S3RangeReader(s3_client=self.s3_client, bucket=self.bucket, key=file_path, size=size)
+
+    def _head_object(self, file_path: str) -> dict | None:
+        """
+        Function returns the size, ETag and user metadata of an object, None if it does not exist
+        """
+        try:
+            obj = self.s3_client.head_object(Bucket=self.bucket, Key=file_path)
         except Exception as e:
-            logging.error(f"{e}\nCheck spelling of profile or properly set it in credentials file")
-            raise ValueError
-        self.s3_client = session.client('s3')
-        self.s3_resource = session.resource('s3')
+            logging.warning(f"Could not retrieve metadata for {file_path}: {e}")
+            return None
+        return {'size': obj['ContentLength'], 'etag': obj['ETag'].strip('"'), 'metadata': obj['Metadata']}
+
+    def _replace_metadata(self, file_path: str, metadata: dict[str: str]) -> str:
+        """
+        Function replaces the user metadata of an object with a server side copy and returns the new ETag
+        """
+        obj = self.s3_client.copy_object(Bucket=self.bucket, Key=file_path,
+                                         CopySource={'Bucket': self.bucket, 'Key': file_path},
+                                         Metadata=metadata, MetadataDirective='REPLACE')
+        return obj['CopyObjectResult']['ETag'].strip('"')
+
+    def _delete_object(self, file_path: str) -> None:
+        """
+        Function deletes an object
+        """
+        self.s3_client.delete_object(Bucket=self.bucket, Key=file_path)
+
+    def s3_uri(self, file_path: str) -> str:
+        """
+        The uri of an object, for scanning it with polars or pyarrow
+        """
+        return f"s3://{self.bucket}/{file_path}"
+
+    def storage_options(self) -> dict[str: str] | None:
+        """
+        The storage options of the scans of the objects, the credentials and region of the profile
+        """
+        session = get_boto_session(profile=self._profile)
+        credentials = session.get_credentials().get_frozen_credentials()
+        options = {'aws_access_key_id': credentials.access_key,
+                   'aws_secret_access_key': credentials.secret_key}
+        if credentials.token:
+            options['aws_session_token'] = credentials.token
+        if session.region_name:
+            options['aws_region'] = session.region_name
+        return options
+
+    def s3_list_objects(self, path: str = '') -> list[dict]:
+        """
+        Function lists the objects under a path without using the manifest
+
+        Parameters
+        ----------
+        path: str
+            The path where objects are stored
+
+        Returns
+        -------
+        list:   the key, size, etag and last_modified of every object
+        """
+        result = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=path):
+            for obj in page.get('Contents', []):
+                result.append({'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag'].strip('"'),
+                               'last_modified': obj['LastModified'].replace(tzinfo=None)})
+        return result
+
+    # public api
+
+    def s3_save_manifest(self) -> None:
+        """
+        Function writes the manifest back to s3 if any table was written or deleted
+        """
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def s3_exists(self,
+                  file_path: str) -> bool:
+        """
+        Function checks if an object exists, using the manifest when available
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.parq
+
+        Returns
+        -------
+        bool:   True if the object exists and False if not
+        """
+        if self.manifest is not None:
+            return self.manifest.exists(file_path)
+        return self._head_object(file_path=file_path) is not None
 
     def s3_is_dir(self,
                   path: str) -> bool:
@@ -65,9 +422,11 @@ class S3IO():
         -------
         bool:   True if the path exists and False if not
         """
-        objs = list(self.s3_resource.Bucket(
-            self.bucket).objects.filter(Prefix=path))
-        return len(objs) > 1 or (len(objs) == 1 and objs[0].key != path)
+        if self.manifest is not None:
+            keys = self.manifest.list(prefix=path)
+        else:
+            keys = [x['key'] for x in self.s3_list_objects(path=path)]
+        return len(keys) > 1 or (len(keys) == 1 and keys[0] != path)
 
     def s3_list(self,
                 path: str) -> list:
@@ -86,10 +445,11 @@ class S3IO():
                     If the path is a directory that does not exist in the bucket,
                     the function will return an empty list.
         """
-        # Retrieve the objects in the passed path
-        all_obj = self.s3_resource.Bucket(self.bucket).objects.filter(Prefix=path)
-        # Parse dictionary to retrieve the objects
-        result = [x.key for x in all_obj]
+        if self.manifest is not None:
+            result = self.manifest.list(prefix=path)
+        else:
+            # Retrieve the objects in the passed path
+            result = [x['key'] for x in self.s3_list_objects(path=path)]
         # Check if the reusults is an empty list
         if not result:
             logging.warning((f"Results produced an empty list for path: {path} "
@@ -97,28 +457,105 @@ class S3IO():
         return result
 
     def s3_read_parquet(self,
-                        file_path: str) -> pl.DataFrame:
+                        file_path: str,
+                        columns: list[str] | None = None,
+                        filters: list[tuple] | None = None) -> pl.DataFrame:
         """
         Function takes the full path of a csv file as input and outputs
-        a pandas dataframe of the file.
+        a pandas dataframe of the file. When columns or filters are passed the footer
+        is fetched first and only the column chunks of the needed row groups are
+        fetched with ranged GETs.
 
         Parameters
         ----------
         file_path: str
             The full path of the file, example -> file/located/here.csv
 
+        columns: list[str]
+            the columns to read, all columns if None
+
+        filters: list[tuple]
+            (column, op, value) filters combined with a logical and, for example
+            [('is_current', '==', True)]. Row groups that can not match are skipped
+            using their statistics
+
         Returns
         -------
         pd.DataFrame:   Dataframe of the file content
         """
-        # Get object from s3
-        obj = self.s3_client.get_object(Bucket=self.bucket, Key=file_path)
-        data = pl.read_parquet(obj['Body'])
+        if columns is None and filters is None:
+            # Get object from s3
+            body, _ = self._get_object(file_path=file_path)
+            data = pl.read_parquet(io.BytesIO(body))
+            return data
+        import pyarrow.parquet as pq
+        filters = filters or []
+        reader = self._open_ranges(file_path=file_path)
+        parquet_file = pq.ParquetFile(reader)
+        metadata = parquet_file.metadata
+        column_index = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+        row_groups = [i for i in range(metadata.num_row_groups)
+                      if _row_group_may_match(metadata.row_group(i), column_index, filters)]
+        read_columns = None
+        if columns is not None:
+            read_columns = list(dict.fromkeys([*columns, *[x[0] for x in filters]]))
+        data = pl.from_arrow(parquet_file.read_row_groups(row_groups, columns=read_columns))
+        if filters:
+            data = data.filter(filters_to_expr(filters))
+        if columns is not None:
+            data = data.select(columns)
+        if isinstance(reader, S3RangeReader):
+            logging.info(f"Read {file_path} with {reader.requests} ranged requests, "
+                         f"{reader.bytes_read} of {reader.size} bytes")
         return data
 
+    def s3_read_parquet_versioned(self,
+                                  file_path: str) -> tuple[pl.DataFrame | None, str | None]:
+        """
+        Function reads a parquet file together with its ETag, used for conditional writes
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.parq
+
+        Returns
+        -------
+        tuple:  the dataframe and the ETag, (None, None) if the object does not exist
+        """
+        body, etag = self._get_object(file_path=file_path, missing_ok=True)
+        if body is None:
+            return None, None
+        return pl.read_parquet(io.BytesIO(body)), etag
+
+    def s3_read_parquet_metadata(self,
+                                 file_path: str,
+                                 size: int | None = None):
+        """
+        Function reads only the footer of a parquet file
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.parq
+
+        size: int
+            the size of the object if known, saves a HEAD request
+
+        Returns
+        -------
+        pyarrow.parquet.FileMetaData:   the metadata of the parquet file
+        """
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(self._open_ranges(file_path=file_path, size=size)).metadata
+
     def s3_write_parquet(self,
                          df: pl.DataFrame,
-                         file_path: str) -> None:
+                         file_path: str,
+                         metadata: dict[str: str] | None = None,
+                         write_profile: str = 'default',
+                         if_match: str | None = None,
+                         if_none_match: bool = False) -> str:
         """
         Function takes a local pandas dataframe and writes it to a specified
         path as a csv file
@@ -131,6 +568,22 @@ class S3IO():
         file_path: str
             the full file path where the dataframe will be saved in s3
             example ->  file/located/here.csv
+
+        metadata: dict
+            optional user metadata stored with the object
+
+        write_profile: str
+            the name of the parquet write profile, see WRITE_PROFILES
+
+        if_match: str
+            only write if the stored object still has this ETag, raises ConditionalWriteError otherwise
+
+        if_none_match: bool
+            only write if the object does not exist, raises ConditionalWriteError otherwise
+
+        Returns
+        -------
+        str:    the ETag of the written object
         """
         # Check if the path for the file exists
         # split_path = file_path.split("/")[:-1]
@@ -138,8 +591,143 @@ class S3IO():
         # if not self.s3_is_dir(path):
         #     logging.error(f"The given path does not exist: {path}")
         #     raise ValueError("Please pass a valid path")
-        # Create a temp file locally using df and load to the path s3
-        with tempfile.NamedTemporaryFile(delete=True, mode='r+') as temp:
-            df.write_parquet(f"{temp.name}.parq")
-            self.s3_resource.Bucket(self.bucket).upload_file(
-                f"{temp.name}.parq", Key=file_path)
\ No newline at end of file
+        # write the parquet in memory and load to the path s3
+        df = decode_categories(df)
+        buffer = io.BytesIO()
+        write_parquet_profile(df=df, file=buffer, write_profile=write_profile)
+        body = buffer.getvalue()
+        etag = self._put_object(file_path=file_path, body=body, metadata=metadata,
+                                if_match=if_match, if_none_match=if_none_match)
+        # record the table in the manifest
+        if self.manifest is not None and file_path != self.manifest_path:
+            from manifest import get_last_period, get_fingerprint
+            fingerprint = metadata.get('source-fingerprint') if metadata else None
+            self.manifest.record(key=file_path,
+                                 size=len(body),
+                                 etag=etag,
+                                 row_count=df.height,
+                                 last_fiscal_period=get_last_period(df),
+                                 fingerprint=fingerprint or get_fingerprint(df))
+        return etag
+
+    def s3_get_metadata(self,
+                        file_path: str) -> dict[str: str] | None:
+        """
+        Function returns the user metadata of an object without downloading it
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.parq
+
+        Returns
+        -------
+        dict:   the user metadata of the object, None if the object does not exist
+        """
+        obj = self._head_object(file_path=file_path)
+        return None if obj is None else obj['metadata']
+
+    def s3_set_metadata(self,
+                        file_path: str,
+                        metadata: dict[str: str]) -> None:
+        """
+        Function replaces the user metadata of an object with a server side copy,
+        the object content is not transferred
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.parq
+
+        metadata: dict
+            the user metadata stored with the object
+        """
+        etag = self._replace_metadata(file_path=file_path, metadata=metadata)
+        # the copy creates a new version of the object, keep the manifest entry in sync
+        if self.manifest is not None and self.manifest.exists(file_path):
+            entry = self.manifest.get(file_path)
+            self.manifest.record(key=file_path,
+                                 size=entry['size'],
+                                 etag=etag,
+                                 row_count=entry['row_count'],
+                                 last_fiscal_period=entry['last_fiscal_period'],
+                                 fingerprint=metadata.get('source-fingerprint') or entry['fingerprint'])
+
+    def s3_write_json(self,
+                      data: dict,
+                      file_path: str,
+                      if_match: str | None = None,
+                      if_none_match: bool = False) -> str:
+        """
+        Function writes a small json document to a specified path in s3
+
+        Parameters
+        ----------
+        data: dict
+            the json serializable document
+
+        file_path: str
+            the full file path where the document will be saved in s3
+            example ->  file/located/here.json
+
+        if_match: str
+            only write if the stored object still has this ETag, raises ConditionalWriteError otherwise
+
+        if_none_match: bool
+            only write if the object does not exist, raises ConditionalWriteError otherwise
+
+        Returns
+        -------
+        str:    the ETag of the written object
+        """
+        return self._put_object(file_path=file_path, body=json.dumps(data, default=str).encode(),
+                                if_match=if_match, if_none_match=if_none_match)
+
+    def s3_read_json(self,
+                     file_path: str) -> dict | None:
+        """
+        Function reads a json document from s3
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.json
+
+        Returns
+        -------
+        dict:   the json document, None if the object does not exist
+        """
+        return self.s3_read_json_versioned(file_path=file_path)[0]
+
+    def s3_read_json_versioned(self,
+                               file_path: str) -> tuple[dict | None, str | None]:
+        """
+        Function reads a json document together with its ETag, used for conditional writes
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.json
+
+        Returns
+        -------
+        tuple:  the json document and the ETag, (None, None) if the object does not exist
+        """
+        body, etag = self._get_object(file_path=file_path, missing_ok=True)
+        if body is None:
+            return None, None
+        return json.loads(body), etag
+
+    def s3_delete(self,
+                  file_path: str) -> None:
+        """
+        Function deletes an object from s3
+
+        Parameters
+        ----------
+        file_path: str
+            The full path of the file, example -> file/located/here.json
+        """
+        self._delete_object(file_path=file_path)
+        if self.manifest is not None:
+            self.manifest.remove(file_path)
@@ -0,0 +1,139 @@
+"""
+Registry of the canonical schema of every statement. The schema is the union of all the fields ever
+reported for the statement, in the order they were first seen, with their dtype and the version of the
+schema they were introduced in. Sources are conformed to it when they are parsed and the merged tables
+before they are written, so every stored file of a statement shares one schema and frames of different
+tickers can be concatenated without reconciling their columns.
+"""
+import logging
+import threading
+import polars as pl
+from s3io import ConditionalWriteError
+
+SCHEMA_PATH = "stock_tracker/schemas"
+
+# columns of the slowly changing dimension, kept after the fields and not part of the schema
+SCD2_COLUMNS = ['is_current', 'update_time']
+
+_DTYPES = {str(x): x for x in [pl.String, pl.Float64, pl.Int64, pl.Boolean, pl.Date, pl.Datetime]}
+
+
+class SchemaRegistry:
+    """
+    Canonical schemas of the statements, loaded once per statement and written back with save
+    """
+    def __init__(self, s3, schema_path: str = SCHEMA_PATH):
+        """
+        Initialize the registry
+
+        Parameters
+        ----------
+        s3: S3IO
+            the store holding the schema documents
+        schema_path: str
+            the prefix of the schema documents, one json document per statement
+        """
+        self.s3 = s3
+        self.schema_path = schema_path
+        self._schemas = {}
+        self._etags = {}
+        # fields introduced since the schema was loaded, replayed when another writer saved first
+        self._added = {}
+        # statements are conformed by the threads retrieving them in parallel
+        self._lock = threading.RLock()
+
+    def _path(self, statement: str) -> str:
+        return f"{self.schema_path}/{statement}.json"
+
+    def _load(self, statement: str) -> None:
+        schema, self._etags[statement] = self.s3.s3_read_json_versioned(file_path=self._path(statement))
+        if schema is None:
+            logging.info(f"No schema registered for statement {statement}, starting a new one")
+            schema = {'statement': statement, 'version': 0, 'columns': []}
+        self._schemas[statement] = schema
+
+    def get(self, statement: str) -> dict:
+        """
+        Get the schema document of a statement, loaded from the store on first use
+        """
+        if statement not in self._schemas:
+            self._load(statement)
+        return self._schemas[statement]
+
+    def version(self, statement: str) -> int:
+        """
+        Get the current version of the schema of a statement
+        """
+        return self.get(statement)['version']
+
+    def columns(self, statement: str) -> dict[str: pl.DataType]:
+        """
+        Get the canonical columns of a statement with their dtypes, in the canonical order
+        """
+        return {x['name']: _DTYPES[x['dtype']] for x in self.get(statement)['columns']}
+
+    def _add_columns(self, statement: str, columns: dict[str: str]) -> None:
+        schema = self.get(statement)
+        known = {x['name'] for x in schema['columns']}
+        columns = {name: dtype for name, dtype in columns.items() if name not in known}
+        if len(columns) == 0:
+            return
+        schema['version'] += 1
+        schema['columns'].extend({'name': name, 'dtype': dtype, 'version': schema['version']}
+                                 for name, dtype in columns.items())
+        logging.info(f"Schema of {statement} is at version {schema['version']}, new fields {list(columns)}")
+
+    def register(self, statement: str, df: pl.DataFrame) -> int:
+        """
+        Add the fields of the data frame that are not in the schema yet, a new version of the schema
+        is created when there are any. Returns the version of the schema
+        """
+        with self._lock:
+            known = self.columns(statement)
+            new_columns = {}
+            for name, dtype in df.schema.items():
+                if name in known or name in SCD2_COLUMNS:
+                    continue
+                # statement fields are numeric, a field without any reported value is a numeric field
+                dtype = pl.Float64 if dtype == pl.Null else dtype.base_type()
+                new_columns[name] = str(dtype)
+            if len(new_columns) > 0:
+                self._add_columns(statement, new_columns)
+                self._added.setdefault(statement, {}).update(new_columns)
+            return self.version(statement)
+
+    def conform(self, statement: str, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Conform the data frame to the schema of the statement. The fields are ordered as in the schema
+        and cast to their dtype, missing fields are added as nulls and new fields are registered
+        """
+        with self._lock:
+            self.register(statement, df)
+            columns = self.columns(statement)
+        fields = [pl.col(name).cast(dtype, strict=False) if name in df.columns
+                  else pl.lit(None, dtype=dtype).alias(name)
+                  for name, dtype in columns.items()]
+        return df.select(fields + [x for x in SCD2_COLUMNS if x in df.columns])
+
+    def save(self, retries: int = 5) -> None:
+        """
+        Write the schemas with new fields to the store. The write is conditional on the schema not being
+        saved by another writer in the meantime, otherwise the other writer's schema is loaded, the new
+        fields are added on top of it and the write is retried
+        """
+        for statement in list(self._added.keys()):
+            for _ in range(retries):
+                try:
+                    self._etags[statement] = self.s3.s3_write_json(data=self._schemas[statement],
+                                                                   file_path=self._path(statement),
+                                                                   if_match=self._etags[statement],
+                                                                   if_none_match=self._etags[statement] is None)
+                except ConditionalWriteError:
+                    logging.warning(f"Schema of {statement} was saved by another writer, merging ...")
+                    self._load(statement)
+                    self._add_columns(statement, self._added[statement])
+                    continue
+                del self._added[statement]
+                break
+            else:
+                raise ConditionalWriteError(f"Could not save the schema of {statement} after {retries} attempts")
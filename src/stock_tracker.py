@@ -5,9 +5,16 @@ A data object that keeps track of all the stocks that have been persisted for th
 import polars as pl
 import logging
 from alphaio import AlphaIO
-from alpha_utils import list_local_files, run_end_to_end, get_bucket_name, init_logger, get_profile_name
-from datetime import datetime
-from s3io import S3IO
+from clients import ApiKeyPool
+from alpha_utils import (list_local_files, run_end_to_end, init_logger,
+                         fingerprint_files, find_changed_records, select_due_tickers, get_alpha_key)
+from datetime import datetime, date
+from s3io import ConditionalWriteError
+from localio import get_store
+from lease import ShardLease, get_worker_id
+from manifest import MANIFEST_PATH
+from categories import CategoryDictionary
+from rollups import SectorRollup
 
 SCHEMA_DEF = {
     'Symbol': pl.String,
@@ -19,6 +26,8 @@ SCHEMA_DEF = {
     'Industry': pl.String,
     # 'Market Cap Name': pl.String
 }
+# parquet write profile of the ticker and queue tables, see s3io.WRITE_PROFILES
+TRACKER_WRITE_PROFILE = 'small-hot'
 
 
 class StockTracker:
@@ -26,22 +35,46 @@ class StockTracker:
     data object to keep track of the stocks that have been persisted
     """
 
-    def __init__(self, queue_depth=16):
+    def __init__(self, queue_depth=16, include_prices=False, use_earnings_calendar=True,
+                 n_shards=1, worker_id=None):
         """
         initialize the object
+
+        queue_depth: int
+            the number of tickers retrieved per run
+        include_prices: bool
+            also append the new daily bars of the tickers to their price histories and update their
+            dividends and splits
+        use_earnings_calendar: bool
+            only queue the tickers that reported since their last download, are new or are overdue
+            according to the earnings calendar, instead of cycling through every ticker
+        n_shards: int
+            the number of shards of the queue, with more than one shard every worker claims a shard
+            through an expiring lease and only retrieves the tickers of its shard
+        worker_id: str
+            the id of the worker holding the lease, defaults to the host name and process id
         """
         self.df_source = None
         self.df_target = None
         self.queue_depth = queue_depth
+        self.include_prices = include_prices
+        self.use_earnings_calendar = use_earnings_calendar
         self.ticker_table = "stock_tracker/tickers.parq"
         self.ticker_queue_table = "stock_tracker/tickers_queue.parq"
+        self.checkpoint_table = "stock_tracker/tickers_queue_checkpoint.json"
+        self.earnings_calendar_table = "stock_tracker/earnings_calendar.parq"
         self.ticker_queue = None
+        self.ticker_queue_etag = None
         self.alphaio = None
+        self.source_fingerprint = None
+        self.target_exists = False
 
-        # get bucket name
-        bucket = get_bucket_name()
-        profile = get_profile_name()
-        self.s3 = S3IO(bucket=bucket, profile=profile)
+        # the s3 bucket or the local directory store
+        self.s3 = get_store(manifest_path=MANIFEST_PATH)
+        self.categories = CategoryDictionary(s3=self.s3)
+        self.lease = None
+        if n_shards > 1:
+            self.lease = ShardLease(s3=self.s3, worker_id=worker_id or get_worker_id(), n_shards=n_shards)
 
     def _market_cap_define(self) -> None:
         """
@@ -102,6 +135,7 @@ class StockTracker:
         # get data from target
         try:
             self.df_target = self.s3.s3_read_parquet(file_path=self.ticker_table)
+            self.target_exists = True
             logging.info(f"successfully loaded stock_tracker data from s3: {self.df_target.head()}")
             # cast IPO year if string
             if 'IPO Year' in self.df_target.columns:
@@ -122,6 +156,58 @@ class StockTracker:
                 logging.warning(f"While setting target, no data available and source is empty setting target to None")
                 self.df_target = None
 
+    def _source_unchanged(self) -> bool:
+        """
+        Check if the fingerprint of the local source files matches the fingerprint stored
+        with the ticker table, in which case the ticker table does not need refreshing
+        """
+        if self.source_fingerprint is None:
+            return False
+        if self.s3.manifest is not None:
+            entry = self.s3.manifest.get(self.ticker_table)
+            return entry is not None and entry['fingerprint'] == self.source_fingerprint
+        metadata = self.s3.s3_get_metadata(file_path=self.ticker_table)
+        if metadata is None:
+            return False
+        return metadata.get('source-fingerprint') == self.source_fingerprint
+
+    def _refresh_target(self) -> None:
+        """
+        Update or insert the records from the source into the target and write the target to s3
+        along with the fingerprint of the source files
+        """
+        metadata = {'source-fingerprint': self.source_fingerprint} if self.source_fingerprint else None
+        if self.target_exists:
+            if self.df_source is None:
+                logging.info("No source data available, the ticker table does not need refreshing")
+                return
+            target_tmp = self.df_target.filter(pl.col("is_current") == True)
+            changed = find_changed_records(target=target_tmp, source=self.df_source, id_col="Symbol")
+            if changed.height == 0:
+                logging.info("Source and target data are the same for the ticker data, skipping the write")
+                if metadata is not None:
+                    self.s3.s3_set_metadata(file_path=self.ticker_table, metadata=metadata)
+                return
+            logging.info(f"Found {changed.height} new or changed tickers in the source, updating ...")
+            self.df_target = run_end_to_end(target=target_tmp, source=changed, id_col="Symbol",
+                                            update_time=datetime.now())
+        logging.info(f"Size of the target being written to s3, {self.df_target.shape}")
+        # write the target data to s3
+        self.s3.s3_write_parquet(self.df_target, file_path=self.ticker_table, metadata=metadata,
+                                write_profile=TRACKER_WRITE_PROFILE)
+        # the rollups follow the changed classifications and market caps of the tickers
+        SectorRollup(s3=self.s3, tickers_table=self.ticker_table, categories=self.categories).save(reclassify=True)
+
+    def _get_symbols(self) -> pl.Series:
+        """
+        Get the symbols of the ticker table, only the Symbol column is read from s3 when the
+        target was not loaded because the source files did not change
+        """
+        if self.df_target is not None:
+            return self.df_target.select('Symbol').to_series()
+        return self.categories.encode(self.s3.s3_read_parquet(file_path=self.ticker_table,
+                                                              columns=['Symbol'])).to_series()
+
     def get_queue_total(self) -> list[str]:
         """
         Get the total number of items in the queue
@@ -132,19 +218,69 @@ class StockTracker:
             pl.col('Download_Failed') == False
         ).select("Symbol").to_series())
 
+    def _get_earnings_calendar(self) -> pl.DataFrame | None:
+        """
+        Pull the earnings calendar once per run and merge it into the stored calendar, the stored calendar
+        keeps the past reports that are no longer part of the pulled horizon
+        """
+        df_stored = None
+        if self.s3.s3_exists(file_path=self.earnings_calendar_table):
+            df_stored = self.s3.s3_read_parquet(file_path=self.earnings_calendar_table)
+        api_key, _ = get_alpha_key()
+        df_pulled = AlphaIO(tickers=[], s3=self.s3).get_earnings_calendar(api_key=api_key)
+        if df_pulled is None:
+            return df_stored
+        # the symbols of the calendar are registered, most of them are not in the ticker table. Both frames are
+        # registered before they are encoded so they share the enum of the symbols
+        df_stored, df_pulled = self.categories.encode(df_stored, df_pulled)
+        if df_stored is not None:
+            # the latest pull holds the latest expected report date of a fiscal period
+            df_pulled = pl.concat([df_stored.join(df_pulled, on=['Symbol', 'fiscalDateEnding'], how='anti'),
+                                   df_pulled.select(df_stored.columns)])
+        self.s3.s3_write_parquet(df=df_pulled, file_path=self.earnings_calendar_table,
+                                 write_profile=TRACKER_WRITE_PROFILE)
+        return df_pulled
+
+    def get_due_tickers(self) -> list[str]:
+        """
+        Get the tickers of the queue that reported since their last download, are new or are overdue.
+        Falls back to the full queue when no earnings calendar is available
+        """
+        calendar = self._get_earnings_calendar()
+        if calendar is None:
+            logging.warning("No earnings calendar available, cycling through the queue")
+            return self.get_queue_total()
+        queue = self.ticker_queue.filter(pl.col('Download_Failed') == False)
+        symbols = list(queue.select('Symbol').to_series())
+        # the last stored period of every ticker is a local lookup in the manifest
+        last_periods = pl.DataFrame({
+            'Symbol': symbols,
+            'last_period': [self.s3.manifest.last_fiscal_period(f"income/{x}/income.parq") for x in symbols]
+        }, schema={'Symbol': pl.String, 'last_period': pl.String})
+        # the joins with the queue compare the codes of the symbols, the queue is encoded again because the
+        # calendar may have added symbols to the dictionary since the queue was loaded
+        queue, last_periods, calendar = self.categories.encode(queue, last_periods, calendar)
+        tickers = select_due_tickers(queue=queue, last_periods=last_periods, calendar=calendar, today=date.today())
+        logging.info(f"{len(tickers)} of {len(symbols)} tickers are due for a refresh")
+        return tickers
+
     def _get_ticker_queue(self) -> None:
         """
         Get the ticker queue which is a dataframe
         """
         # check if the queue is initialized in s3
-        try:
-            self.ticker_queue = self.s3.s3_read_parquet(file_path=self.ticker_queue_table)
+        # the ETag is kept so the queue is only written back if no other worker changed it
+        self.ticker_queue, self.ticker_queue_etag = self.s3.s3_read_parquet_versioned(file_path=self.ticker_queue_table)
+        if self.ticker_queue is not None:
+            self.ticker_queue = self.categories.encode(self.ticker_queue)
             logging.info(f"successfully loaded ticker queue from s3: {self.ticker_queue.head()}")
             logging.info(
                 f"total amount of items in queue: {len(self.get_queue_total())}")
 
-        except Exception as e:
-            logging.warning(f"queue file does not exist, initializing the queue using target data\n{e}")
+        else:
+            logging.warning(f"queue file does not exist, initializing the queue using target data")
+            if self.df_target is None:
+                self._get_target()
             self.ticker_queue = self.df_target.select(["Symbol"])
             # add the download column and download time
             self.ticker_queue = self.ticker_queue.with_columns(
@@ -163,12 +299,15 @@ class StockTracker:
         val: bool
             indicates if the downloaded tickers were successful or not
         """
-        # update the download flag to true
+        # update the download flag to true, a successful download clears an earlier failure
         if val:
             self.ticker_queue = self.ticker_queue.with_columns(
                                     Downloaded=pl.when(pl.col('Symbol').is_in(tickers))
                                     .then(pl.lit(True))
-                                    .otherwise(pl.col('Downloaded')))
+                                    .otherwise(pl.col('Downloaded')),
+                                    Download_Failed=pl.when(pl.col('Symbol').is_in(tickers))
+                                    .then(pl.lit(False))
+                                    .otherwise(pl.col('Download_Failed')))
             self.ticker_queue = self.ticker_queue.with_columns(
                                     Download_time=pl.when(pl.col('Symbol').is_in(tickers))
                                     .then(pl.lit(datetime.now()))
@@ -188,7 +327,7 @@ class StockTracker:
         Insert new tickers into the queue
         """
         # check the source if there are new tickers
-        ticker_list = list(set(self.df_target.select('Symbol').to_series()) - set(self.ticker_queue.select('Symbol').to_series()))
+        ticker_list = list(set(self._get_symbols()) - set(self.ticker_queue.select('Symbol').to_series()))
         if len(ticker_list) > 0:
             logging.info(f"Identified {len(ticker_list)} new tickers, updating ticker queue with the following tickers: {ticker_list}")
             downloaded_vals = [False for _ in range(len(ticker_list))]
@@ -205,31 +344,72 @@ class StockTracker:
                         'Downloaded': pl.Boolean,
                         'Download_Failed': pl.Boolean}
             )
-            # concat the ticker queue
+            # concat the ticker queue, both are encoded with the enum holding the new symbols
+            self.ticker_queue, diff = self.categories.encode(self.ticker_queue, diff)
             self.ticker_queue = pl.concat([self.ticker_queue, diff.select(self.ticker_queue.columns)])
             logging.info(f"Updated ticker_queue {self.ticker_queue.head()}")
         else:
             logging.info(f"no new tickers found to add to queue")
 
-    def write_ticker_queue(self, download_dict: dict[str: bool]) -> None:
+    def write_ticker_queue(self, download_dict: dict[str: bool], retries: int = 5) -> None:
         """
-        Update and write the ticker queue to s3
+        Update and write the ticker queue to s3. The write is conditional on the queue not being
+        changed by another worker since it was loaded, otherwise the queue is reloaded and the
+        updates are applied again. Tickers with a None result were throttled, they stay in the queue
+        as they are so they are retrieved first by the next run
         """
         # update the queue dataframe by ticker
         Download_success = []
         Download_falures = []
         for ticker in download_dict.keys():
+            if download_dict[ticker] is None:
+                continue
             if download_dict[ticker]:
                 Download_success.append(ticker)
             else:
                 Download_falures.append(ticker)
 
-        # update the download flag to true
-        self.update_queue(tickers=Download_success, val=True)
-        self.update_queue(tickers=Download_falures, val=False)
-        # write the queue back to s3
-        self.s3.s3_write_parquet(df=self.ticker_queue,
-                                 file_path=self.ticker_queue_table)
+        for _ in range(retries):
+            # update the download flag to true
+            self.update_queue(tickers=Download_success, val=True)
+            self.update_queue(tickers=Download_falures, val=False)
+            # write the queue back to s3
+            try:
+                self.ticker_queue_etag = self.s3.s3_write_parquet(df=self.ticker_queue,
+                                                                  file_path=self.ticker_queue_table,
+                                                                  write_profile=TRACKER_WRITE_PROFILE,
+                                                                  if_match=self.ticker_queue_etag,
+                                                                  if_none_match=self.ticker_queue_etag is None)
+                return
+            except ConditionalWriteError:
+                logging.warning("ticker queue was written by another worker, reloading and applying the updates again")
+                self._get_ticker_queue()
+                self.insert_new_queue_records()
+        raise ConditionalWriteError(f"Could not write the ticker queue after {retries} attempts")
+
+    def release_quarantine(self, ticker: str, statement: str) -> bool:
+        """
+        Store the reviewed quarantined statement of a ticker and mark the ticker as downloaded in the queue,
+        clearing an earlier failure. Returns True when the statement was stored
+        """
+        if self.ticker_queue is None:
+            self._get_ticker_queue()
+        alphaio = AlphaIO(tickers=[ticker], s3=self.s3)
+        released = alphaio.release_quarantine(ticker=ticker, statement=statement)
+        alphaio.persist()
+        if released:
+            self.write_ticker_queue(download_dict={ticker: True})
+        return released
+
+    def _get_checkpoint(self) -> dict | None:
+        """
+        Get the checkpoint of a batch that did not finish in a previous run
+        """
+        checkpoint = self.s3.s3_read_json(file_path=self.checkpoint_table)
+        if checkpoint is not None:
+            logging.info(f"Found checkpoint of an unfinished batch from {checkpoint['checkpoint_time']}, "
+                         f"{len(checkpoint['completed'])} of {len(checkpoint['tickers'])} tickers completed, resuming ...")
+        return checkpoint
 
     def reset_queue(self) -> None:
         """
@@ -250,15 +430,52 @@ class StockTracker:
             logging.info(f"No items in the queue resetting queue ...")
             self.reset_queue()
 
-    def run(self) -> None:
+    def _run_batch(self) -> None:
         """
-        The main run of stock tracker logical flow to return the stocks for retrieving data from alpha vantage
+        Retrieve the data of the next batch of tickers and write the results to the queue
+        """
+        # resume the batch of a previous run that did not finish
+        checkpoint = self._get_checkpoint()
+        if checkpoint is not None:
+            tickers = checkpoint['tickers']
+            completed = checkpoint['completed']
+            run_id = checkpoint.get('run_id')
+        else:
+            if self.use_earnings_calendar:
+                tickers = self.get_due_tickers()
+            else:
+                tickers = self.get_queue_total()
+            if self.lease is not None:
+                # only the tickers of the held shard
+                tickers = [x for x in tickers if self.lease.holds(x)]
+            tickers = tickers[:self.queue_depth]
+            completed = None
+            run_id = None
+        # pass the list of tickers to the alpha io object
+        self.alphaio = AlphaIO(tickers=tickers, checkpoint_path=self.checkpoint_table, completed=completed,
+                               s3=self.s3, run_id=run_id, key_pool=ApiKeyPool(keys=get_alpha_key()))
+        # run the alphaio object
+        self.alphaio.run()
+        if self.lease is not None and len(self.lease.renew()) == 0:
+            logging.warning("The lease of the shard expired during the batch, another worker may have fetched it too")
+        self.write_ticker_queue(download_dict=self.alphaio.ticker_tracking_dict)
+        if self.include_prices:
+            self.alphaio.run_prices()
+        # the results are persisted in the queue, the batch is finished
+        self.s3.s3_delete(file_path=self.checkpoint_table)
+        self.categories.save()
+        self.s3.s3_save_manifest()
+
+    def prepare(self) -> bool:
+        """
+        Refresh the ticker table and load the queue, returns False when there is no source and target data
 
         1. check locally if source data is available for updating or initializing the target ticker table
-        2. Check if the data in s3 needs initializing, initialize if not
-        3. make any updates inserts to the ticker table and write data to s3
-        4. Check if the ticker queue is initialized, if not initialize it
-        5. Add any new records to the queue
+        2. skip the ticker table refresh when the fingerprint of the source files did not change
+        3. Check if the data in s3 needs initializing, initialize if not
+        4. make any updates inserts to the ticker table and write data to s3
+        5. Check if the ticker queue is initialized, if not initialize it
+        6. Add any new records to the queue
 
         """
         # check if local files are available
@@ -267,44 +484,71 @@ class StockTracker:
             # get the source data
             logging.info(f"Found source data locally: {source_files}")
             self.get_stock_list_locally(file_path=source_files) # sets the source
-        self._get_target() # sets the target if not in s3 initiliaze the dataframe
+            self.source_fingerprint = fingerprint_files(source_files)
+        if self._source_unchanged():
+            logging.info("Source files have not changed since the last refresh, skipping the ticker table refresh")
+        else:
+            self._get_target() # sets the target if not in s3 initiliaze the dataframe
         # check if there is no data for both the source and target
         if self.df_source is None and self.df_target is None:
-            logging.warning("No source and target data, closing ...")
-        else:  # if no source or target data simply exit
+            logging.warning("No source and target data")
+            return False
+        # the values of both tables are registered first, so source and target share the encoding
+        self.df_source, self.df_target = self.categories.encode(self.df_source, self.df_target)
+        if self.df_target is not None:
             # update or insert the records from the source and target
-            if not (self.df_target.filter(pl.col("is_current") == True).sort(pl.col("Symbol"),
-                                                                             descending=False)
-                    .select(self.df_source.columns)
-                    .equals(self.df_source.sort(pl.col("Symbol"),
-                            descending=False))):
-                logging.info(f"Source and target data are not the same for the ticker data, updating ...")
-                # no need to run the process if target equals the source
-                target_tmp = self.df_target.filter(pl.col("is_current") == True)
-                self.df_target = run_end_to_end(target=target_tmp, source=self.df_source, id_col="Symbol",
-                                                update_time=datetime.now())
-            logging.info(f"Size of the target being written to s3, {self.df_target.shape}")
-            # write the target data to s3
-            self.s3.s3_write_parquet(self.df_target, file_path=self.ticker_table)
-            # get the queue
-            self._get_ticker_queue()
-            # check if the queue needs resetting
-            self._check_reset()
-            # update ticker queue
-            self.insert_new_queue_records()
-            tickers = self.get_queue_total()[:self.queue_depth]
-            # pass the list of tickers to the alpha io object
-            self.alphaio = AlphaIO(tickers=tickers)
-            # run the alphaio object
-            self.alphaio.run()
-            self.write_ticker_queue(download_dict=self.alphaio.ticker_tracking_dict)
+            self._refresh_target()
+        # get the queue
+        self._get_ticker_queue()
+        # check if the queue needs resetting
+        self._check_reset()
+        # update ticker queue
+        self.insert_new_queue_records()
+        self.categories.save()
+        return True
+
+    def run(self) -> None:
+        """
+        The main run of stock tracker logical flow to return the stocks for retrieving data from alpha vantage
+
+        1. refresh the ticker table and load the queue, see prepare
+        2. resume the batch of the checkpoint if a previous run failed, otherwise take the next batch of the queue,
+           only the tickers that are due according to the earnings calendar when it is used
+
+        """
+        if not self.prepare():
+            logging.warning("closing ...")
+        else:
+            if self.lease is not None:
+                # claim a shard of the queue, the checkpoint belongs to the shard so any worker resumes it
+                shards = self.lease.acquire(max_shards=1)
+                if len(shards) == 0:
+                    logging.warning("No free shard of the queue, closing ...")
+                    return
+                self.checkpoint_table = f"stock_tracker/checkpoints/{self.lease.n_shards}/shard={shards[0]}.json"
+            try:
+                self._run_batch()
+            finally:
+                if self.lease is not None:
+                    self.lease.release()
         logging.info(f"Finished")
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="retrieve the data of the next batch of tickers")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="number of queue shards, each worker claims one through a lease")
+    parser.add_argument('--worker-id', default=None)
+    parser.add_argument('--release', nargs=2, metavar=('TICKER', 'STATEMENT'), default=None,
+                        help="store the reviewed quarantined statement of a ticker instead of running a batch")
+    args = parser.parse_args()
 
     init_logger("stock_tracker.log")
-    stock_tracker = StockTracker()
-    stock_tracker.run()
+    stock_tracker = StockTracker(n_shards=args.shards, worker_id=args.worker_id)
+    if args.release is not None:
+        stock_tracker.release_quarantine(ticker=args.release[0], statement=args.release[1])
+    else:
+        stock_tracker.run()
 
 
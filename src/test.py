@@ -1,13 +1,58 @@
 import unittest
+import io
+import tempfile
+import time
+from unittest import mock
 import polars as pl
 from polars.testing import assert_frame_equal
-from datetime import datetime
+from datetime import datetime, date
 from alpha_utils import (parse_data,
                          check_new_field,
                          check_removed_field,
                          update_records,
                          insert_new_records,
-                         run_end_to_end)
+                         run_end_to_end,
+                         compute_ttm,
+                         update_ttm,
+                         find_changed_records,
+                         get_change_log,
+                         parse_prices,
+                         parse_dividends,
+                         parse_splits,
+                         get_adjustment_factors,
+                         apply_adjustments,
+                         select_due_tickers,
+                         classify_response,
+                         throttle_backoff)
+from s3io import S3IO, filters_to_expr, ConditionalWriteError, WRITE_PROFILES, write_parquet_profile
+from localio import LocalIO
+from lease import ShardLease
+from schema_registry import SchemaRegistry
+from categories import CategoryDictionary
+from query import StatementQuery
+from clients import ApiKeyPool
+from mirror import ArrowMirror
+from alphaio import AlphaIO
+from covariance import ReturnCovariance, get_returns, load_matrix
+from backtest import Backtest, point_in_time, get_rebalance_dates
+from rollups import SectorRollup, get_contributions, update_rollups, ROLLUP_TABLES
+from stock_tracker import StockTracker
+from daemon import TrackerDaemon
+from backfill import Backfill
+
+
+class StoreTestCase(unittest.TestCase):
+    """
+    Base of the tests running against a local directory store, a new empty store per test
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.store = LocalIO(root=self.root, manifest_path='stock_tracker/manifest.parq')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
 
 # TODO: test update function when their is nothing to update, the source and target are equal dfs
 class TestDfFunctions(unittest.TestCase):
@@ -233,8 +278,6 @@ class TestDfFunctions(unittest.TestCase):
         result_columns = list(result.columns).sort()
         self.assertEqual(assert_frame_equal(final.select(final_columns), result.select(result_columns)), None)
 
-
-
     def test_end_to_end3(self):
         """
         Test the end-to-end process of updating and inserting new records
@@ -265,6 +308,1037 @@ class TestDfFunctions(unittest.TestCase):
         result_columns = list(result.columns).sort()
         self.assertEqual(assert_frame_equal(final.select(final_columns), result.select(result_columns)), None)
 
+    def test_find_changed_records(self):
+        """
+        Test that only the new and changed source records are found
+        """
+        target = pl.DataFrame({
+            'Symbol': ['AAPL', 'MSFT', 'XOM'],
+            'Market Cap': [3.0e12, 2.5e12, 4.0e11],
+            'IPO Year': [1980, 1986, None],
+            'is_current': [True, True, True]
+        }, schema_overrides={'IPO Year': pl.Int64})
+        source = pl.DataFrame({
+            'Symbol': ['XOM', 'AAPL', 'MSFT', 'CVX'],
+            'Market Cap': [4.0e11, 3.0e12, 2.6e12, 3.0e11],
+            'IPO Year': [None, 1980, 1986, None]
+        }, schema_overrides={'IPO Year': pl.Int32})
+        result = find_changed_records(target=target, source=source, id_col='Symbol')
+        self.assertEqual(sorted(result.select('Symbol').to_series()), ['CVX', 'MSFT'])
+
+    def test_change_log(self):
+        """
+        a merge logs the inserted records and the updated records with their changed fields
+        """
+        target = pl.DataFrame({'fiscalDateEnding': ['2024-03-31', '2024-06-30'], 'revenue': [1.0, 2.0],
+                               'ebit': [1.0, 1.0], 'is_current': [True, True],
+                               'update_time': [datetime(2024, 1, 1)] * 2})
+        source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31', '2024-06-30', '2024-09-30'],
+                               'revenue': [1.0, 3.0, 4.0], 'ebit': [1.0, 1.0, 1.0]})
+        update_time = datetime(2024, 8, 1)
+        merged = run_end_to_end(target=target, source=source, update_time=update_time)
+        result = get_change_log(previous=target, merged=merged, update_time=update_time)
+        self.assertEqual(result.rows(), [('2024-06-30', 'update', ['revenue']), ('2024-09-30', 'insert', [])])
+
+    def test_classify_response(self):
+        """
+        throttled answers come with a 200 and a note, they are told apart from invalid and empty answers
+        """
+        self.assertEqual(classify_response({'quarterlyReports': [{'fiscalDateEnding': '2024-03-31'}]}), 'ok')
+        self.assertEqual(classify_response({'annualReports': [{'fiscalDateEnding': '2024-12-31'}]}), 'ok')
+        self.assertEqual(classify_response({'Note': 'Our standard API call frequency is 5 calls per minute'}),
+                         'throttled')
+        self.assertEqual(classify_response({'Information': 'Thank you for using Alpha Vantage! Our standard API '
+                                                           'rate limit is 25 requests per day.'}), 'throttled')
+        self.assertEqual(classify_response({'Error Message': 'Invalid API call'}), 'invalid')
+        # an invalid key or a premium endpoint is not retried
+        self.assertEqual(classify_response({'Information': 'the parameter apikey is invalid or missing.'}), 'invalid')
+        self.assertEqual(classify_response({'Information': 'Thank you for using Alpha Vantage! This is a premium '
+                                                           'endpoint.'}), 'invalid')
+        self.assertEqual(classify_response({}), 'empty')
+        self.assertEqual(classify_response({'symbol': 'X', 'quarterlyReports': []}), 'empty')
+        self.assertEqual(throttle_backoff({'Note': '5 calls per minute'}), 60)
+        self.assertEqual(throttle_backoff({'Information': 'standard API rate limit is 25 requests per day'},
+                                          now=datetime(2024, 1, 1, 23, 0)), 3600)
+
+    def test_key_pool(self):
+        """
+        a throttled key is skipped while another key is available
+        """
+        pool = ApiKeyPool(keys=['key1', 'key2'])
+        self.assertEqual(pool.acquire(preferred='key1'), 'key1')
+        pool.throttled('key1', 60)
+        self.assertEqual(pool.acquire(preferred='key1'), 'key2')
+        pool.throttled('key2', 120)
+        self.assertIsNone(pool.acquire(preferred='key1', max_wait=1))
+        self.assertGreater(pool.wait_time(), 50)
+
+    def test_parse_prices(self):
+        """
+        Test parsing the daily time series into a frame sorted by date
+        """
+        data = {
+            '2024-01-03': {'1. open': '10.0', '2. high': '11.0', '3. low': '9.5', '4. close': '10.5', '5. volume': '1000'},
+            '2024-01-02': {'1. open': '9.0', '2. high': '10.0', '3. low': '8.5', '4. close': '9.5', '5. volume': '2000'},
+        }
+        result = parse_prices(data=data, ticker='AAPL')
+        self.assertEqual(result.schema['date'], pl.Date)
+        self.assertEqual(list(result.select('close').to_series()), [9.5, 10.5])
+        self.assertEqual(list(result.select('volume').to_series()), [2000, 1000])
+
+    def test_quality_checks(self):
+        """
+        the checks run with the parse and the merge flag the suspicious values
+        """
+        data = [{'fiscalDateEnding': '2024-06-30', 'reportedCurrency': 'USD', 'totalRevenue': 'None', 'netIncome': 'None'},
+                {'fiscalDateEnding': '2024-03-31', 'reportedCurrency': 'USD', 'totalRevenue': '-5', 'netIncome': 'n/a'},
+                {'fiscalDateEnding': '2023-12-31', 'reportedCurrency': 'USD', 'totalRevenue': '1e14', 'netIncome': '3'}]
+        df, issues = parse_data(data=data, str_cols=['fiscalDateEnding', 'reportedCurrency'], checks=True)
+        assert_frame_equal(df, parse_data(data=data, str_cols=['fiscalDateEnding', 'reportedCurrency']))
+        self.assertEqual(sorted(issues.select('check', 'field', 'fiscalDateEnding').rows(), key=str),
+                         sorted([('out_of_range', 'totalRevenue', '2023-12-31'),
+                                 ('negative', 'totalRevenue', '2024-03-31'),
+                                 ('unparsed', 'netIncome', '2024-03-31'),
+                                 ('zeroed_quarter', None, '2024-06-30'),
+                                 ('null_rate_jump', None, '2024-06-30')], key=str))
+        # the range is scaled for the currencies with a small unit
+        _, issues = parse_data(data=[{'fiscalDateEnding': '2024-03-31', 'reportedCurrency': 'JPY',
+                                      'totalRevenue': '1e14'}], str_cols=['fiscalDateEnding', 'reportedCurrency'],
+                               checks=True)
+        self.assertEqual(issues.height, 0)
+        target = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [5.0], 'netIncome': [1.0],
+                               'is_current': [True], 'update_time': [datetime(2024, 1, 1)]})
+        source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [5000.0], 'netIncome': [-1.0]})
+        _, issues = update_records(target=target, source=source, checks=True)
+        self.assertEqual(sorted(issues.select('check', 'field').rows()),
+                         [('restatement', 'netIncome'), ('restatement', 'totalRevenue'), ('sign_flip', 'netIncome'),
+                          ('unit_change', 'totalRevenue')])
+
+    def test_adjustments(self):
+        """
+        a split and a dividend adjust the bars before their date, other tickers are not adjusted
+        """
+        prices = pl.DataFrame({'Symbol': ['A'] * 4 + ['B'] * 2,
+                               'date': [date(2024, 1, x) for x in (2, 3, 4, 5)] + [date(2024, 1, 2), date(2024, 1, 3)],
+                               'close': [100.0, 100.0, 50.0, 50.0, 10.0, 10.0], 'volume': [10, 10, 20, 20, 1, 1]})
+        dividends = parse_dividends(data=[{'ex_dividend_date': '2024-01-03', 'amount': '1.0', 'declaration_date': 'None',
+                                           'record_date': '2024-01-04', 'payment_date': 'None'}], ticker='A')
+        splits = parse_splits(data=[{'effective_date': '2024-01-04', 'split_factor': '2.0000'}], ticker='A')
+        factors = get_adjustment_factors(prices=prices, dividends=dividends, splits=splits)
+        self.assertEqual(factors.select('date', 'price_factor', 'split_ratio').rows(),
+                         [(date(2024, 1, 3), 0.495, 2.0), (date(2024, 1, 4), 0.5, 2.0)])
+        result = apply_adjustments(df=prices, factors=factors, share_cols=['volume'])
+        self.assertEqual(result['close'].to_list(), [49.5, 50.0, 50.0, 50.0, 10.0, 10.0])
+        self.assertEqual(result['volume'].to_list(), [20, 20, 20, 20, 1, 1])
+        statements = pl.DataFrame({'Symbol': ['A'], 'fiscalDateEnding': ['2023-12-31'], 'eps': [2.0]})
+        result = apply_adjustments(df=statements, factors=factors, date_col='fiscalDateEnding', per_share_cols=['eps'])
+        self.assertEqual(result['eps'].to_list(), [1.0])
+
+    def test_select_due_tickers(self):
+        """
+        Test selecting the reported, new and overdue tickers using the earnings calendar
+        """
+        queue = pl.DataFrame({
+            'Symbol': ['AAPL', 'NEW', 'MSFT', 'OLD', 'RECENT', 'LAG', 'LAG2'],
+            'Download_time': [datetime(2024, 1, 1), None, datetime(2024, 4, 1), datetime(2024, 1, 1),
+                              datetime(2024, 4, 20), datetime(2024, 4, 28), datetime(2024, 3, 26)]
+        })
+        last_periods = pl.DataFrame({
+            'Symbol': ['AAPL', 'MSFT', 'OLD', 'RECENT', 'LAG', 'LAG2'],
+            'last_period': ['2023-12-31', '2023-12-31', '2023-09-30', '2023-09-30', '2023-12-31', '2024-01-31']
+        })
+        calendar = pl.DataFrame({
+            'Symbol': ['AAPL', 'MSFT', 'LAG', 'LAG2'],
+            'reportDate': ['2024-04-25', '2024-05-10', '2024-04-25', '2024-03-25'],
+            'fiscalDateEnding': ['2024-03-31', '2024-03-31', '2024-03-31', '2024-02-29']
+        })
+        result = select_due_tickers(queue=queue, last_periods=last_periods, calendar=calendar, today=date(2024, 5, 1))
+        # MSFT has not reported yet and RECENT was checked recently. The statements of LAG and LAG2 lag the
+        # calendar, LAG was downloaded after its report and LAG2 is checked again after recheck_days
+        self.assertEqual(result, ['AAPL', 'LAG2', 'NEW', 'OLD'])
+
+
+class TestTTMFunctions(unittest.TestCase):
+    """
+    Unit testing for the trailing twelve month functions in the alpha_utils.py file
+    """
+    def setUp(self):
+        update_time = datetime(2024, 1, 1)
+        self.update_time = update_time
+        self.statement = pl.DataFrame({
+            'fiscalDateEnding': ['2022-03-31', '2022-06-30', '2022-09-30', '2022-12-31', '2023-03-31', '2023-06-30'],
+            'reportedCurrency': ['USD'] * 6,
+            'totalRevenue': [100.0, 200.0, 300.0, 400.0, 150.0, 300.0],
+            'is_current': [True] * 6,
+            'update_time': [update_time] * 6
+        })
+
+    def test_compute_ttm(self):
+        """
+        Test the ttm sums and year over year changes of a quarterly statement
+        """
+        result = compute_ttm(self.statement.drop(['is_current', 'update_time']))
+        final = pl.DataFrame({
+            'fiscalDateEnding': ['2022-03-31', '2022-06-30', '2022-09-30', '2022-12-31', '2023-03-31', '2023-06-30'],
+            'totalRevenue_ttm': [None, None, None, 1000.0, 1050.0, 1150.0],
+            'totalRevenue_yoy': [None, None, None, None, 0.5, 0.5]
+        })
+        self.assertEqual(assert_frame_equal(final, result), None)
+
+    def test_compute_ttm_gap(self):
+        """
+        Test that a window with a missing quarter does not produce a ttm sum
+        """
+        result = compute_ttm(self.statement.drop(['is_current', 'update_time']).filter(
+            pl.col('fiscalDateEnding') != '2022-09-30'))
+        self.assertEqual(result.select('totalRevenue_ttm').to_series().null_count(), result.height)
+
+    def test_update_ttm(self):
+        """
+        Test that the incremental update of a restated quarter equals the full recompute
+        """
+        ttm_target = compute_ttm(self.statement.drop(['is_current', 'update_time']))
+        update_time = datetime(2024, 4, 1)
+        source = self.statement.drop(['is_current', 'update_time']).with_columns(
+            totalRevenue=pl.when(pl.col('fiscalDateEnding') == '2022-06-30')
+            .then(pl.lit(250.0)).otherwise(pl.col('totalRevenue')))
+        statement = run_end_to_end(target=self.statement, source=source, update_time=update_time)
+        result = update_ttm(ttm_target=ttm_target, statement=statement, changed_ids=['2022-06-30'])
+        final = compute_ttm(statement.filter(pl.col('is_current') == True).drop(['is_current', 'update_time']))
+        self.assertEqual(assert_frame_equal(final, result), None)
+
+
+class TestCovariance(StoreTestCase):
+    """
+    Unit testing for the incremental covariance in the covariance.py file
+    """
+    def test_incremental_covariance(self):
+        """
+        adding the bars in two updates gives the covariance of the common days of every pair
+        """
+        import numpy as np
+        from datetime import timedelta
+        rng = np.random.default_rng(0)
+        rows = []
+        for symbol in ['A', 'B', 'C']:
+            close = 100.0
+            for i in range(60):
+                # B starts later and C misses some days
+                if (symbol == 'B' and i < 10) or (symbol == 'C' and i % 7 == 3):
+                    continue
+                close *= 1 + rng.normal(0, 0.01)
+                rows.append((symbol, date(2024, 1, 1) + timedelta(days=i), close))
+        prices = pl.DataFrame(rows, schema=['Symbol', 'date', 'close'], orient='row')
+        engine = ReturnCovariance(root=self.root, min_periods=5)
+        engine.update(prices=prices.filter(pl.col('date') < date(2024, 2, 1)))
+        engine.save()
+        engine = ReturnCovariance(root=self.root, min_periods=5)
+        engine.update(prices=prices)
+        engine.save()
+        returns = get_returns(prices).pivot(on='Symbol', index='date', values='return')
+        common = returns.select('A', 'C').drop_nulls().to_numpy()
+        self.assertAlmostEqual(engine.covariance()[0, 2], np.cov(common.T)[0, 1])
+        symbols, correlation = load_matrix(self.root)
+        self.assertEqual(symbols, ['A', 'B', 'C'])
+        self.assertAlmostEqual(correlation[0, 2], np.corrcoef(common.T)[0, 1])
+
+    def test_interrupted_save(self):
+        """
+        a save that did not finish leaves the previous generation, the next update does not add its days twice
+        """
+        import os
+        prices = pl.DataFrame({'Symbol': ['A'] * 4 + ['B'] * 4,
+                               'date': [date(2024, 1, x) for x in range(1, 5)] * 2,
+                               'close': [1.0, 1.1, 1.0, 1.2, 2.0, 2.2, 2.1, 2.0]})
+        engine = ReturnCovariance(root=self.root, min_periods=1)
+        engine.update(prices=prices.filter(pl.col('date') < date(2024, 1, 3)))
+        engine.save()
+        engine.update(prices=prices)
+        with mock.patch('covariance.os.replace', side_effect=OSError("interrupted")):
+            with self.assertRaises(OSError):
+                engine.save()
+        engine = ReturnCovariance(root=self.root, min_periods=1)
+        self.assertEqual(engine.sums['count'][0, 0], 1)
+        self.assertEqual(engine.update(prices=prices), 2)
+        engine.save()
+        self.assertEqual(engine.sums['count'][0, 0], 3)
+        self.assertEqual(len(os.listdir(self.root)), 4)
+
+
+class TestBacktest(unittest.TestCase):
+    """
+    Unit testing for the point in time backtest in the backtest.py file
+    """
+    def setUp(self):
+        from datetime import timedelta
+        days = [date(2023, 1, 2) + timedelta(days=x) for x in range(360)]
+        rows = []
+        for symbol, growth in [('A', 0.002), ('B', -0.001), ('C', 0.0)]:
+            close = 100.0
+            for day in days:
+                close *= 1 + growth
+                rows.append((symbol, day, close))
+        self.prices = pl.DataFrame(rows, schema=['Symbol', 'date', 'close'], orient='row')
+        # the first download stores the history, the 2023-03-31 quarter of A is revised later
+        self.income = pl.DataFrame({
+            'Symbol': ['A', 'A', 'A', 'B', 'C'],
+            'fiscalDateEnding': ['2022-12-31', '2023-03-31', '2023-03-31', '2022-12-31', '2022-12-31'],
+            'netIncome': [1.0, 2.0, 9.0, 5.0, 3.0],
+            'is_current': [True, False, True, True, True],
+            'update_time': [datetime(2023, 6, 1), datetime(2023, 6, 1), datetime(2023, 8, 15),
+                            datetime(2023, 6, 1), datetime(2023, 6, 1)]})
+
+    def test_point_in_time(self):
+        """
+        the first versions are known at the latest after the report lag, revisions from their update time
+        """
+        dates = pl.Series([date(2023, 3, 1), date(2023, 4, 3), date(2023, 7, 3), date(2023, 9, 1)])
+        panel = point_in_time(history=self.income, symbols=['A'], dates=dates, fields=['netIncome'])
+        self.assertEqual(panel['netIncome'].to_list(), [None, 1.0, 2.0, 9.0])
+
+    def test_backtest(self):
+        """
+        the best ranked ticker is held from the date its quarter is known
+        """
+        backtest = Backtest(prices=self.prices, statements={'income': self.income.lazy()})
+        result = backtest.run(signal=pl.col('netIncome'), top=1)
+        self.assertEqual(result['holdings'].to_list()[:3], [0, 0, 1])
+        # B is held until the revision of A is known in august
+        held = result.filter(pl.col('date') == date(2023, 4, 30))['return'].item()
+        self.assertLess(held, 0)
+        self.assertGreater(result.filter(pl.col('date') == date(2023, 8, 31))['return'].item(), 0)
+        self.assertEqual(get_rebalance_dates(self.prices).len(), 12)
+
+
+class TestRollups(StoreTestCase):
+    """
+    Unit testing for the sector and industry rollups in the rollups.py file
+    """
+    def setUp(self):
+        super().setUp()
+        self.tickers = pl.DataFrame({'Symbol': ['A', 'B', 'C'], 'Sector': ['Tech', 'Tech', 'Energy'],
+                                     'Industry': ['Software', 'Chips', None], 'Market Cap': [300.0, 100.0, 50.0],
+                                     'is_current': [True, True, True]})
+        self.statements = pl.DataFrame({
+            'Symbol': ['A', 'A', 'B', 'B', 'C'],
+            'fiscalDateEnding': ['2024-03-31', '2024-06-30', '2024-03-31', '2024-06-30', '2024-03-31'],
+            'reportedCurrency': ['USD'] * 5,
+            'totalRevenue': [100.0, 110.0, 50.0, 40.0, 80.0],
+            'grossProfit': [60.0, 66.0, 20.0, 10.0, 8.0],
+            'operatingIncome': [30.0, 33.0, 5.0, -5.0, 4.0],
+            'netIncome': [20.0, 22.0, 2.0, -8.0, 2.0]})
+
+    def test_incremental_rollup(self):
+        """
+        subtracting the replaced contributions and adding the new ones gives the rollups of a full recompute
+        """
+        contributions, rollups = update_rollups(contributions=None, rollups={x: None for x in ROLLUP_TABLES},
+                                                new_contributions=get_contributions(self.statements, self.tickers),
+                                                symbols=['A', 'B', 'C'])
+        sector = rollups['sector'].filter(pl.col('Sector') == 'Tech', pl.col('fiscalQuarter') == '2024Q1')
+        self.assertEqual(sector['n_tickers'].item(), 2)
+        self.assertAlmostEqual(sector['netMargin'].item(), 22 / 150)
+        self.assertAlmostEqual(sector['netMargin_median'].item(), (0.2 + 0.04) / 2)
+        self.assertAlmostEqual(sector['netMargin_mcap_weighted'].item(), (300 * 0.2 + 100 * 0.04) / 400)
+        # B restates a quarter and moves industry, C stops reporting in dollars
+        statements = self.statements.with_columns(
+            pl.when(pl.col('Symbol') == 'B').then(pl.col('netIncome') * 2).otherwise(pl.col('netIncome')),
+            pl.when(pl.col('Symbol') == 'C').then(pl.lit('EUR')).otherwise(pl.col('reportedCurrency'))
+            .alias('reportedCurrency'))
+        tickers = self.tickers.with_columns(pl.when(pl.col('Symbol') == 'B').then(pl.lit('Software'))
+                                            .otherwise(pl.col('Industry')).alias('Industry'))
+        changed = statements.filter(pl.col('Symbol').is_in(['B', 'C']))
+        contributions, incremental = update_rollups(contributions=contributions, rollups=rollups,
+                                                    new_contributions=get_contributions(changed, tickers),
+                                                    symbols=['B', 'C'])
+        _, full = update_rollups(contributions=None, rollups={x: None for x in ROLLUP_TABLES},
+                                 new_contributions=get_contributions(statements, tickers), symbols=['A', 'B', 'C'])
+        self.assertEqual(contributions.height, 4)
+        for level in ROLLUP_TABLES:
+            assert_frame_equal(incremental[level], full[level].select(incremental[level].columns),
+                               check_row_order=True, abs_tol=1e-9)
+        self.assertEqual(incremental['industry'].select('Industry').unique().to_series().to_list(), ['Software'])
+
+    def test_sector_rollup_store(self):
+        """
+        the stored rollups are updated from their partial aggregates and rebuilt when they are out of date
+        """
+        self.store.s3_write_parquet(df=self.tickers, file_path='stock_tracker/tickers.parq')
+        categories = CategoryDictionary(s3=self.store)
+        rollup = SectorRollup(s3=self.store, categories=categories)
+        for symbol in ['A', 'B', 'C']:
+            rollup.add(ticker=symbol, statement=self.statements.filter(pl.col('Symbol') == symbol).drop('Symbol'))
+        rollup.save()
+        self.assertEqual(rollup.pending, {})
+        rollup.add(ticker='A', statement=self.statements.filter(pl.col('Symbol') == 'A').drop('Symbol')
+                   .with_columns(pl.col('totalRevenue') * 2))
+        rollup.save()
+        sector = self.store.s3_read_parquet(file_path=ROLLUP_TABLES['sector'])
+        self.assertEqual(sector.filter(pl.col('Sector') == 'Tech')['totalRevenue'].to_list(), [250.0, 260.0])
+        self.assertEqual(self.store.s3_get_metadata(file_path=ROLLUP_TABLES['sector'])['contributions-etag'],
+                         self.store.s3_read_parquet_versioned(file_path='rollups/contributions.parq')[1])
+        categories.save()
+        query = StatementQuery(s3=self.store)
+        result = query.execute("SELECT Sector, sum(n_tickers) AS n FROM industry_rollup "
+                               "WHERE fiscalQuarter = '2024Q1' GROUP BY Sector ORDER BY CAST(Sector AS VARCHAR)")
+        self.assertEqual(result.rows(), [('Energy', 1), ('Tech', 2)])
+
+    def test_reclassified_rollup(self):
+        """
+        the contributions of the tickers whose classification or market cap changed in the ticker table are
+        moved without new statements, a ticker without a sector is removed
+        """
+        self.store.s3_write_parquet(df=self.tickers, file_path='stock_tracker/tickers.parq')
+        rollup = SectorRollup(s3=self.store, categories=CategoryDictionary(s3=self.store))
+        for symbol in ['A', 'B', 'C']:
+            rollup.add(ticker=symbol, statement=self.statements.filter(pl.col('Symbol') == symbol).drop('Symbol'))
+        rollup.save()
+        tickers = self.tickers.with_columns(
+            pl.when(pl.col('Symbol') == 'B').then(pl.lit('Software')).otherwise(pl.col('Industry')).alias('Industry'),
+            pl.when(pl.col('Symbol') == 'A').then(600.0).otherwise(pl.col('Market Cap')).alias('Market Cap'),
+            pl.when(pl.col('Symbol') == 'C').then(None).otherwise(pl.col('Sector')).alias('Sector'))
+        self.store.s3_write_parquet(df=tickers, file_path='stock_tracker/tickers.parq')
+        _, etag = self.store.s3_read_parquet_versioned(file_path='rollups/contributions.parq')
+        rollup.save()
+        self.assertEqual(self.store.s3_read_parquet_versioned(file_path='rollups/contributions.parq')[1], etag)
+        rollup.save(reclassify=True)
+        _, full = update_rollups(contributions=None, rollups={x: None for x in ROLLUP_TABLES},
+                                 new_contributions=get_contributions(self.statements, tickers),
+                                 symbols=['A', 'B', 'C'])
+        for level in ROLLUP_TABLES:
+            stored = self.store.s3_read_parquet(file_path=ROLLUP_TABLES[level]).with_columns(pl.col(pl.Categorical,
+                                                                                             pl.Enum).cast(pl.String))
+            assert_frame_equal(stored, full[level].select(stored.columns), check_row_order=False, abs_tol=1e-9)
+        _, etag = self.store.s3_read_parquet_versioned(file_path='rollups/contributions.parq')
+        rollup.save(reclassify=True)
+        self.assertEqual(self.store.s3_read_parquet_versioned(file_path='rollups/contributions.parq')[1], etag)
+
+
+class TestS3IOFunctions(StoreTestCase):
+    """
+    Unit testing for the reads and the conditional writes of the s3io.py file
+    """
+    def test_stale_lock(self):
+        """
+        a stale lock is broken by renaming it, a lock found fresh after the rename is put back
+        """
+        import os
+        path = os.path.join(self.root, 'AAA.json')
+        lock_path = f"{path}.lock"
+        open(lock_path, 'w').close()
+        LocalIO._break_lock(lock_path)
+        self.assertTrue(os.path.exists(lock_path))
+        os.utime(lock_path, (time.time() - 60, time.time() - 60))
+        with self.store._lock(path):
+            self.assertTrue(os.path.exists(lock_path))
+            self.assertGreater(os.path.getmtime(lock_path), time.time() - 10)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_write_parquet_profile(self):
+        """
+        the profiles apply their compression and statistics, only the dictionary columns are dictionary encoded
+        """
+        import pyarrow.parquet as pq
+        df = pl.DataFrame({'Symbol': ['AAA', 'BBB'] * 50, 'Name': ['x', 'y'] * 50, 'value': [1.0] * 100})
+        expected = {'default': ('ZSTD', True), 'small-hot': ('LZ4', True), 'archive': ('ZSTD', False),
+                    'scan-optimized': ('ZSTD', True)}
+        self.assertEqual(sorted(expected), sorted(WRITE_PROFILES))
+        for write_profile, (compression, statistics) in expected.items():
+            buffer = io.BytesIO()
+            write_parquet_profile(df=df, file=buffer, write_profile=write_profile)
+            buffer.seek(0)
+            assert_frame_equal(pl.read_parquet(buffer), df)
+            buffer.seek(0)
+            row_group = pq.ParquetFile(buffer).metadata.row_group(0)
+            columns = {row_group.column(i).path_in_schema: row_group.column(i) for i in range(row_group.num_columns)}
+            self.assertEqual({x.compression for x in columns.values()}, {compression})
+            self.assertEqual(columns['value'].is_stats_set, statistics)
+            self.assertIn('RLE_DICTIONARY', columns['Symbol'].encodings)
+            if WRITE_PROFILES[write_profile].get('dictionary', False):
+                self.assertNotIn('RLE_DICTIONARY', columns['Name'].encodings)
+        with self.assertRaises(ValueError):
+            write_parquet_profile(df=df, file=io.BytesIO(), write_profile='unknown')
+
+    def test_filters_to_expr(self):
+        """
+        Test converting the (column, op, value) filters to a polars expression
+        """
+        df = pl.DataFrame({
+            'Symbol': ['AAPL', 'MSFT', 'XOM', 'CVX'],
+            'Market Cap': [3.0e12, 2.5e12, 4.0e11, 3.0e11],
+            'is_current': [True, False, True, True]
+        })
+        result = df.filter(filters_to_expr([('is_current', '==', True),
+                                            ('Market Cap', '>=', 3.5e11),
+                                            ('Symbol', 'not in', ['MSFT'])]))
+        self.assertEqual(list(result.select('Symbol').to_series()), ['AAPL', 'XOM'])
+
+    def test_read_parquet_ranges(self):
+        """
+        Test that reading with columns and filters only fetches and returns the needed rows and columns
+        """
+        class Client:
+            def __init__(self, data: bytes):
+                self.data = data
+                self.bytes_read = 0
+
+            def head_object(self, Bucket: str, Key: str):
+                return {'ContentLength': len(self.data)}
+
+            def get_object(self, Bucket: str, Key: str, Range: str):
+                start, end = Range.replace('bytes=', '').split('-')
+                self.bytes_read += int(end) + 1 - int(start)
+                return {'Body': io.BytesIO(self.data[int(start):int(end) + 1])}
+
+        df = pl.DataFrame({'Symbol': [f"T{x:06d}" for x in range(100000)],
+                           'Market Cap': [float(x) for x in range(100000)]})
+        buffer = io.BytesIO()
+        df.write_parquet(buffer, row_group_size=10000)
+        client = Client(buffer.getvalue())
+
+        class TestS3IO(S3IO):
+            s3_client = client
+
+        result = TestS3IO(bucket='bucket').s3_read_parquet(file_path='key', columns=['Symbol'],
+                                                           filters=[('Market Cap', '<', 15000.0)])
+        self.assertEqual(result.shape, (15000, 1))
+        self.assertLess(client.bytes_read, len(buffer.getvalue()))
+
+    def test_conditional_write_and_lease(self):
+        """
+        a stale ETag fails the write and a shard is leased to only one worker
+        """
+        etag = self.store.s3_write_json(data={'n': 1}, file_path='a.json', if_none_match=True)
+        self.store.s3_write_json(data={'n': 2}, file_path='a.json', if_match=etag)
+        with self.assertRaises(ConditionalWriteError):
+            self.store.s3_write_json(data={'n': 3}, file_path='a.json', if_match=etag)
+        self.assertEqual(self.store.s3_read_json(file_path='a.json'), {'n': 2})
+
+        first, second = ShardLease(self.store, 'w1', n_shards=1), ShardLease(self.store, 'w2', n_shards=1)
+        self.assertEqual(first.acquire(), [0])
+        self.assertEqual(second.acquire(), [])
+        first.release()
+        self.assertEqual(second.acquire(), [0])
+
+
+class TestSchemaRegistry(StoreTestCase):
+    """
+    Unit testing for the schema registry in the schema_registry.py file
+    """
+    def test_schema_registry(self):
+        """
+        statements of different tickers conform to one schema that survives a reload
+        """
+        registry = SchemaRegistry(s3=self.store)
+        df1 = registry.conform('income', pl.DataFrame({'fiscalDateEnding': ['2024-03-31'],
+                                                       'revenue': [1.0]}))
+        df2 = registry.conform('income', pl.DataFrame({'fiscalDateEnding': ['2024-03-31'],
+                                                       'ebit': [2.0], 'revenue': [None]}))
+        self.assertEqual(registry.version('income'), 2)
+        self.assertEqual(pl.concat([registry.conform('income', df1), df2]).columns,
+                         ['fiscalDateEnding', 'revenue', 'ebit'])
+        self.assertEqual(df2.schema['revenue'], pl.Float64)
+        registry.save()
+        reloaded = SchemaRegistry(s3=LocalIO(root=self.root))
+        self.assertEqual(reloaded.columns('income'), registry.columns('income'))
+        self.assertEqual(reloaded.get('income')['columns'][2]['version'], 2)
+
+
+class TestCategoryDictionary(StoreTestCase):
+    """
+    Unit testing for the category dictionary in the categories.py file
+    """
+    def test_category_dictionary(self):
+        """
+        frames encoded with the dictionary share one enum, the codes survive a concurrent save and the
+        stored tables keep strings
+        """
+        categories = CategoryDictionary(s3=self.store)
+        tickers, queue = categories.encode(pl.DataFrame({'Symbol': ['AAA', 'BBB'], 'Sector': ['X', None]}),
+                                           pl.DataFrame({'Symbol': ['CCC', 'AAA']}))
+        self.assertEqual(tickers.schema['Symbol'], queue.schema['Symbol'])
+        self.assertEqual(queue.join(tickers, on='Symbol').rows(), [('AAA', 'X')])
+        # another writer saves first, its values keep their codes and the new values are added after them
+        other = CategoryDictionary(s3=self.store)
+        other.register(pl.DataFrame({'Symbol': ['DDD']}))
+        other.save()
+        categories.save()
+        reloaded = CategoryDictionary(s3=self.store)
+        self.assertEqual(reloaded.values['Symbol'], ['DDD', 'AAA', 'BBB', 'CCC'])
+        self.assertEqual(reloaded.values['Sector'], ['X'])
+        # unknown values are not encoded without registering
+        self.assertEqual(reloaded.encode(pl.DataFrame({'Symbol': ['AAA']}), register=False)['Symbol'].to_list(),
+                         ['AAA'])
+        with self.assertRaises(pl.exceptions.InvalidOperationError):
+            reloaded.encode(pl.DataFrame({'Symbol': ['AAA', 'EEE']}), register=False)
+        self.store.s3_write_parquet(df=tickers, file_path='stock_tracker/tickers.parq')
+        self.assertEqual(self.store.s3_read_parquet(file_path='stock_tracker/tickers.parq').schema['Symbol'],
+                         pl.String)
+
+
+class TestStatementQuery(StoreTestCase):
+    """
+    Unit testing for the SQL query layer in the query.py file
+    """
+    def test_statement_query(self):
+        """
+        the statements of all the tickers are queried as one table with the ticker from the path
+        """
+        for ticker, revenue in [('AAA', 1.0), ('BBB', 2.0)]:
+            self.store.s3_write_parquet(df=pl.DataFrame({'fiscalDateEnding': ['2024-03-31', '2024-06-30'],
+                                                         'totalRevenue': [revenue, revenue],
+                                                         'is_current': [False, True],
+                                                         'update_time': [datetime(2024, 1, 1)] * 2}),
+                                        file_path=f"income/{ticker}/income.parq")
+        query = StatementQuery(s3=self.store)
+        result = query.execute("SELECT Symbol, sum(totalRevenue) AS revenue FROM income "
+                               "GROUP BY Symbol ORDER BY Symbol")
+        self.assertEqual(result.rows(), [('AAA', 1.0), ('BBB', 2.0)])
+        self.assertEqual(query.execute("SELECT count(*) AS n FROM income_history").item(), 4)
+
+    def test_query_run_logs(self):
+        """
+        the symbols of the change log and the quality report are registered by the writer and can be queried
+        """
+        alphaio = AlphaIO(tickers=['ZZZ'], s3=self.store)
+        for revenue in [1000.0, 1.0]:
+            source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [revenue]})
+            alphaio.write_data(ticker='ZZZ', target_financials=alphaio.get_target_data(ticker='ZZZ'),
+                               source_financials={'income': source, 'balance': None, 'cash': None})
+        alphaio.persist()
+        query = StatementQuery(s3=self.store)
+        for table in ['changes', 'quality']:
+            result = query.execute(f"SELECT DISTINCT CAST(Symbol AS VARCHAR) AS Symbol FROM {table}")
+            self.assertEqual(result['Symbol'].to_list(), ['ZZZ'])
+
+    def test_query_feeds_engines(self):
+        """
+        the encoded symbols of the query output are joined by the covariance and the backtest engines
+        """
+        import os
+        from datetime import timedelta
+        for ticker, growth in [('AAA', 0.002), ('BBB', -0.001)]:
+            days = [date(2023, 1, 2) + timedelta(days=x) for x in range(120)]
+            self.store.s3_write_parquet(df=pl.DataFrame({'Symbol': ticker, 'date': days,
+                                                         'close': [100.0 * (1 + growth) ** x for x in range(120)]}),
+                                        file_path=f"prices/{ticker}/2023.parq")
+            self.store.s3_write_parquet(df=pl.DataFrame({'fiscalDateEnding': ['2022-12-31'],
+                                                         'netIncome': [1.0 + growth], 'is_current': [True],
+                                                         'update_time': [datetime(2023, 2, 1)]}),
+                                        file_path=f"income/{ticker}/income.parq")
+        query = StatementQuery(s3=self.store)
+        prices = query.execute("SELECT Symbol, date, close FROM prices")
+        self.assertIsInstance(prices.schema['Symbol'], pl.Enum)
+        engine = ReturnCovariance(root=os.path.join(self.root, 'covariance'), min_periods=5)
+        self.assertEqual(engine.update(prices=prices), 119)
+        self.assertEqual(engine.update(prices=prices), 0)
+        backtest = Backtest(prices=prices,
+                            statements={'income': query.execute("SELECT * FROM income_history", eager=False)})
+        result = backtest.run(signal=pl.col('netIncome'), top=1)
+        self.assertGreater(result['holdings'].max(), 0)
+
+
+class TestArrowMirror(StoreTestCase):
+    """
+    Unit testing for the Arrow IPC mirror in the mirror.py file
+    """
+    def setUp(self):
+        super().setUp()
+        self.mirror_dir = tempfile.TemporaryDirectory()
+        self.mirror_root = self.mirror_dir.name
+
+    def tearDown(self):
+        self.mirror_dir.cleanup()
+        super().tearDown()
+
+    def test_arrow_mirror(self):
+        """
+        the mirror only downloads the changed objects and replaces the rows of their tickers
+        """
+        def write(ticker: str, revenue: float):
+            self.store.s3_write_parquet(df=pl.DataFrame({'fiscalDateEnding': ['2024-03-31'],
+                                                         'totalRevenue': [revenue], 'is_current': [True],
+                                                         'update_time': [datetime(2024, 1, 1)]}),
+                                        file_path=f"income/{ticker}/income.parq")
+        write('AAA', 1.0)
+        write('BBB', 2.0)
+        mirror = ArrowMirror(root=self.mirror_root, s3=self.store)
+        self.assertEqual(mirror.sync(tables=['income']), {'income': 2})
+        write('BBB', 3.0)
+        self.assertEqual(mirror.sync(tables=['income']), {'income': 1})
+        result = mirror.read('income').sort('Symbol').select('Symbol', 'totalRevenue')
+        self.assertEqual(result.rows(), [('AAA', 1.0), ('BBB', 3.0)])
+
+
+class TestAlphaIO(StoreTestCase):
+    """
+    Unit testing for the statement writes of the alphaio.py file
+    """
+    def test_initial_tables(self):
+        """
+        a ticker without stored history gets its statements and ttm tables without a merge, a throttled
+        statement leaves the ticker for a later run
+        """
+        alphaio = AlphaIO(tickers=['AAA'], s3=self.store)
+        income = pl.DataFrame({'fiscalDateEnding': ['2024-03-31', '2024-06-30'], 'totalRevenue': [1.0, 2.0]})
+        tables = alphaio.initial_tables(ticker='AAA', source_financials={'income': income, 'balance': None},
+                                        update_time=datetime(2024, 8, 1))
+        self.assertEqual(sorted(tables), ['income/AAA/income.parq', 'income/AAA/income_ttm.parq'])
+        self.assertTrue(tables['income/AAA/income.parq']['is_current'].all())
+        self.assertEqual(alphaio.changes[0]['change_type'].to_list(), ['insert', 'insert'])
+        self.assertTrue(alphaio.ticker_tracking_dict['AAA'])
+        alphaio.response_status['AAA'] = {'balance': 'throttled'}
+        alphaio.initial_tables(ticker='AAA', source_financials={'income': income, 'balance': None},
+                               update_time=datetime(2024, 8, 1))
+        self.assertIsNone(alphaio.ticker_tracking_dict['AAA'])
+
+    def test_write_data_keeps_history(self):
+        """
+        an update of a stored statement keeps the superseded versions of the records
+        """
+        alphaio = AlphaIO(tickers=['AAA'], s3=self.store)
+        for revenue in [1.0, 2.0, 3.0]:
+            source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [revenue]})
+            alphaio.write_data(ticker='AAA', target_financials=alphaio.get_target_data(ticker='AAA'),
+                               source_financials={'income': source, 'balance': None, 'cash': None})
+        df = self.store.s3_read_parquet(file_path='income/AAA/income.parq')
+        self.assertEqual(df['totalRevenue'].to_list(), [1.0, 2.0, 3.0])
+        self.assertEqual(df['is_current'].to_list(), [False, False, True])
+
+    def test_write_data_unlisted_history(self):
+        """
+        a statement written through a store without the manifest is read and merged, not initialized again
+        """
+        self.store.s3_save_manifest()
+        history = pl.DataFrame({'fiscalDateEnding': ['2024-03-31', '2024-03-31'], 'totalRevenue': [1.0, 2.0],
+                                'is_current': [False, True],
+                                'update_time': [datetime(2024, 1, 1), datetime(2024, 2, 1)]})
+        LocalIO(root=self.root).s3_write_parquet(df=history, file_path='income/BBB/income.parq')
+        alphaio = AlphaIO(tickers=['BBB'], s3=self.store)
+        source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [3.0]})
+        alphaio.write_data(ticker='BBB', target_financials=alphaio.get_target_data(ticker='BBB'),
+                           source_financials={'income': source, 'balance': None, 'cash': None})
+        df = self.store.s3_read_parquet(file_path='income/BBB/income.parq')
+        self.assertEqual(df['totalRevenue'].to_list(), [1.0, 2.0, 3.0])
+        self.assertTrue(self.store.manifest.exists('income/BBB/income.parq'))
+        # the initialization does not replace a statement created in the meantime
+        alphaio.write_data(ticker='BBB', target_financials={'income': None},
+                           source_financials={'income': source})
+        self.assertIsNone(alphaio.ticker_tracking_dict['BBB'])
+        self.assertEqual(self.store.s3_read_parquet(file_path='income/BBB/income.parq').height, 3)
+
+    def test_quarantine(self):
+        """
+        a restatement changing the unit is quarantined and the stored statement is left as it is
+        """
+        alphaio = AlphaIO(tickers=['AAA'], s3=self.store)
+        for revenue in [1000.0, 1.0]:
+            source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [revenue]})
+            alphaio.write_data(ticker='AAA', target_financials=alphaio.get_target_data(ticker='AAA'),
+                               source_financials={'income': source, 'balance': None, 'cash': None})
+        self.assertEqual(self.store.s3_read_parquet(file_path='income/AAA/income.parq')['totalRevenue'].to_list(),
+                         [1000.0])
+        self.assertTrue(self.store.s3_exists(file_path=f"quarantine/income/AAA/run_id={alphaio.run_id}.parq"))
+        # the quarantine holds the ticker instead of failing it
+        self.assertIsNone(alphaio.ticker_tracking_dict['AAA'])
+        alphaio.persist()
+        report = self.store.s3_read_parquet(file_path=f"quality/run_id={alphaio.run_id}/report.parq")
+        self.assertTrue(report['quarantined'].all())
+        self.assertIn('unit_change', report['check'].to_list())
+        # the reviewed statement is released into the stored statement
+        self.assertTrue(alphaio.release_quarantine(ticker='AAA', statement='income'))
+        self.assertEqual(self.store.s3_read_parquet(file_path='income/AAA/income.parq')['totalRevenue'].to_list(),
+                         [1000.0, 1.0])
+        self.assertFalse(self.store.s3_exists(file_path=f"quarantine/income/AAA/run_id={alphaio.run_id}.parq"))
+        self.assertFalse(alphaio.release_quarantine(ticker='AAA', statement='income'))
+
+    def test_quarantine_core_fields(self):
+        """
+        a unit change of a line item outside the quarantine fields is reported and the statement is stored
+        """
+        alphaio = AlphaIO(tickers=['AAA'], s3=self.store)
+        for interest in [1000.0, 1.0]:
+            source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [50.0],
+                                   'interestIncome': [interest]})
+            alphaio.write_data(ticker='AAA', target_financials=alphaio.get_target_data(ticker='AAA'),
+                               source_financials={'income': source, 'balance': None, 'cash': None})
+        self.assertEqual(self.store.s3_read_parquet(file_path='income/AAA/income.parq')['interestIncome'].to_list(),
+                         [1000.0, 1.0])
+        self.assertEqual(alphaio.quality[0]['check'].to_list(), ['unit_change', 'restatement'])
+        self.assertFalse(alphaio.quality[0]['quarantined'].any())
+
+    def test_resume_retries_transient(self):
+        """
+        a resumed batch skips the completed tickers and retries the tickers throttled by the previous run
+        """
+        alphaio = AlphaIO(tickers=['AAA', 'BBB', 'CCC'], completed={'AAA': True, 'BBB': None, 'CCC': False},
+                          s3=self.store)
+        income = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [1.0]})
+        with (mock.patch.dict('os.environ', {'ALPHA_VANTAGE_API': 'key1', 'ALPHA_VANTAGE_API2': 'key2'}),
+              mock.patch.object(AlphaIO, 'get_statement',
+                                return_value={'income': income, 'balance': None, 'cash': None}) as get_statement):
+            alphaio.run()
+        self.assertEqual([x.kwargs['ticker'] for x in get_statement.call_args_list], ['BBB'])
+        self.assertEqual(alphaio.ticker_tracking_dict, {'AAA': True, 'BBB': True, 'CCC': False})
+
+    def test_last_price_date(self):
+        """
+        the last stored bar is found with and without the manifest
+        """
+        for year, day in [(2023, date(2023, 12, 29)), (2024, date(2024, 1, 3))]:
+            self.store.s3_write_parquet(df=pl.DataFrame({'Symbol': ['AAA'], 'date': [day], 'close': [1.0]}),
+                                        file_path=f"prices/AAA/{year}.parq")
+        for store in [self.store, LocalIO(root=self.root)]:
+            alphaio = AlphaIO(tickers=['AAA'], s3=store)
+            self.assertEqual(alphaio.get_last_price_date(ticker='AAA'), date(2024, 1, 3))
+            self.assertIsNone(alphaio.get_last_price_date(ticker='BBB'))
+
+    def test_write_corporate_actions(self):
+        """
+        the events are only written when an event is new or was revised
+        """
+        alphaio = AlphaIO(tickers=['AAA'], s3=self.store)
+        splits = parse_splits(data=[{'effective_date': '2020-08-31', 'split_factor': '4.0'}], ticker='AAA')
+        self.assertTrue(alphaio.write_corporate_actions(ticker='AAA', action='splits', df_events=splits))
+        self.assertFalse(alphaio.write_corporate_actions(ticker='AAA', action='splits', df_events=splits))
+        splits = parse_splits(data=[{'effective_date': '2020-08-31', 'split_factor': '4.0'},
+                                    {'effective_date': '2024-06-10', 'split_factor': '10.0'}], ticker='AAA')
+        self.assertTrue(alphaio.write_corporate_actions(ticker='AAA', action='splits', df_events=splits))
+        self.assertEqual(self.store.s3_read_parquet(file_path='splits/AAA/splits.parq')['split_factor'].to_list(),
+                         [4.0, 10.0])
+
+
+
+class TestStockTracker(StoreTestCase):
+    """
+    Unit testing for the ticker queue in the stock_tracker.py file
+    """
+    def setUp(self):
+        super().setUp()
+        self.env = mock.patch.dict('os.environ', {'LOCAL_STORE_DIR': self.root, 'ALPHA_VANTAGE_API': 'key1',
+                                                  'ALPHA_VANTAGE_API2': 'key2'})
+        self.env.start()
+        queue = pl.DataFrame({'Symbol': ['AAPL', 'MSFT'],
+                              'Download_time': [datetime(2024, 1, 1), datetime(2024, 1, 1)],
+                              'Downloaded': [False, False],
+                              'Download_Failed': [False, False]})
+        self.store.s3_write_parquet(df=queue, file_path="stock_tracker/tickers_queue.parq")
+        self.tracker = StockTracker()
+        self.tracker._get_ticker_queue()
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_due_tickers_new_calendar_symbols(self):
+        """
+        the symbols of the calendar missing from the dictionary are registered without breaking the joins
+        with the queue encoded before
+        """
+        calendars = [pl.DataFrame({'Symbol': ['AAPL', 'NEWCO'], 'reportDate': ['2024-04-25', '2024-04-25'],
+                                   'fiscalDateEnding': ['2024-03-31', '2024-03-31']}),
+                     pl.DataFrame({'Symbol': ['OTHER'], 'reportDate': ['2024-04-25'],
+                                   'fiscalDateEnding': ['2024-03-31']})]
+        for calendar in calendars:
+            with mock.patch.object(AlphaIO, 'get_earnings_calendar', return_value=calendar):
+                self.assertEqual(sorted(self.tracker.get_due_tickers()), ['AAPL', 'MSFT'])
+        # the stored calendar keeps the symbols of both pulls
+        stored = self.store.s3_read_parquet(file_path="stock_tracker/earnings_calendar.parq")
+        self.assertEqual(sorted(stored['Symbol'].cast(pl.String)), ['AAPL', 'NEWCO', 'OTHER'])
+
+    def test_release_quarantine(self):
+        """
+        a ticker held by a quarantined statement is marked downloaded when the statement is released
+        """
+        alphaio = AlphaIO(tickers=['AAPL'], s3=self.tracker.s3)
+        for revenue in [1000.0, 1.0]:
+            source = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [revenue]})
+            alphaio.write_data(ticker='AAPL', target_financials=alphaio.get_target_data(ticker='AAPL'),
+                               source_financials={'income': source, 'balance': None, 'cash': None})
+        alphaio.persist()
+        self.tracker.write_ticker_queue(download_dict={'AAPL': alphaio.ticker_tracking_dict['AAPL']})
+        # a failure recorded before the ticker was quarantined
+        self.tracker.write_ticker_queue(download_dict={'AAPL': False})
+        self.assertTrue(self.tracker.release_quarantine(ticker='AAPL', statement='income'))
+        queue = self.store.s3_read_parquet(file_path=self.tracker.ticker_queue_table).filter(pl.col('Symbol') == 'AAPL')
+        self.assertEqual(queue.select('Downloaded', 'Download_Failed').row(0), (True, False))
+        self.assertEqual(self.store.s3_read_parquet(file_path='income/AAPL/income.parq')['totalRevenue'].to_list(),
+                         [1000.0, 1.0])
+
+    def test_resume_batch(self):
+        """
+        a batch interrupted after a ticker is resumed from its checkpoint without fetching the completed ticker,
+        the checkpoint is deleted when the batch is finished
+        """
+        self.tracker.use_earnings_calendar = False
+        income = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [1.0]})
+        fetched = []
+
+        def get_statement(ticker, api_key, statement):
+            fetched.append(ticker)
+            if ticker == 'MSFT' and fetched.count('MSFT') == 1:
+                raise RuntimeError("interrupted")
+            return {'income': income, 'balance': None, 'cash': None}
+
+        with mock.patch.object(AlphaIO, 'get_statement', side_effect=get_statement):
+            with self.assertRaises(RuntimeError):
+                self.tracker._run_batch()
+            checkpoint = self.store.s3_read_json(file_path=self.tracker.checkpoint_table)
+            self.assertEqual(checkpoint['tickers'], ['AAPL', 'MSFT'])
+            self.assertEqual(checkpoint['completed'], {'AAPL': True})
+            self.tracker._run_batch()
+        self.assertEqual(fetched, ['AAPL', 'MSFT', 'MSFT'])
+        self.assertFalse(self.store.s3_exists(file_path=self.tracker.checkpoint_table))
+        # the changes of both runs are in the partition of the batch
+        changes = self.store.s3_read_parquet(file_path=f"changes/run_id={checkpoint['run_id']}/changes.parq")
+        self.assertEqual(sorted(changes['Symbol'].unique()), ['AAPL', 'MSFT'])
+        queue = self.store.s3_read_parquet(file_path=self.tracker.ticker_queue_table)
+        self.assertTrue(queue['Downloaded'].all())
+
+
+class TestBackfill(StoreTestCase):
+    """
+    Unit testing for the bulk backfill in the backfill.py file
+    """
+    def setUp(self):
+        super().setUp()
+        self.env = mock.patch.dict('os.environ', {'LOCAL_STORE_DIR': self.root, 'ALPHA_VANTAGE_API': 'key1',
+                                                  'ALPHA_VANTAGE_API2': 'key2'})
+        self.env.start()
+        queue = pl.DataFrame({'Symbol': ['AAA', 'BBB', 'CCC'],
+                              'Download_time': [None, None, None],
+                              'Downloaded': [False, False, False],
+                              'Download_Failed': [False, False, False]},
+                             schema_overrides={'Download_time': pl.Datetime})
+        self.store.s3_write_parquet(df=queue, file_path="stock_tracker/tickers_queue.parq")
+        self.income = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [1.0]})
+        tracker = StockTracker()
+        tracker._get_ticker_queue()
+        tracker.s3.s3_write_parquet(df=self.income.with_columns(pl.lit(True).alias('is_current'),
+                                                                pl.lit(datetime(2024, 1, 1)).alias('update_time')),
+                                    file_path="income/BBB/income.parq")
+        self.backfill = Backfill(tracker=tracker)
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_run_batch(self):
+        """
+        only the tickers without history are backfilled, a table stored by another worker is not overwritten
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        other = pl.DataFrame({'fiscalDateEnding': ['2024-03-31'], 'totalRevenue': [9.0]})
+
+        def get_statement(ticker, api_key, statement):
+            if ticker == 'CCC':
+                # another worker stores the ticker while it is retrieved
+                LocalIO(root=self.root).s3_write_parquet(df=other, file_path="income/CCC/income.parq")
+            return {'income': self.income, 'balance': None, 'cash': None}
+
+        tickers = self.backfill.get_new_tickers()
+        self.assertEqual(tickers, ['AAA', 'CCC'])
+        self.backfill.alphaio = AlphaIO(tickers=tickers, s3=self.backfill.tracker.s3,
+                                        key_pool=self.backfill.key_pool)
+        with (mock.patch.object(AlphaIO, 'get_statement', side_effect=get_statement),
+              ThreadPoolExecutor(max_workers=2) as executor):
+            self.backfill.run_batch(tickers=tickers, executor=executor)
+        self.assertEqual(self.store.s3_read_parquet(file_path="income/AAA/income.parq")['totalRevenue'].to_list(),
+                         [1.0])
+        self.assertTrue(self.backfill.tracker.s3.s3_exists(file_path="income/AAA/income_ttm.parq"))
+        self.assertEqual(self.store.s3_read_parquet(file_path="income/CCC/income.parq")['totalRevenue'].to_list(),
+                         [9.0])
+        self.assertEqual(self.backfill.alphaio.ticker_tracking_dict, {'AAA': True, 'CCC': True})
+        self.assertNotIn('AAA', self.backfill.get_new_tickers())
+
+
+class TestTrackerDaemon(StoreTestCase):
+    """
+    Unit testing for the daemon loop in the daemon.py file
+    """
+    def setUp(self):
+        super().setUp()
+        self.env = mock.patch.dict('os.environ', {'LOCAL_STORE_DIR': self.root, 'ALPHA_VANTAGE_API': 'key1',
+                                                  'ALPHA_VANTAGE_API2': 'key2'})
+        self.env.start()
+        tracker = StockTracker(n_shards=2, worker_id='w1')
+        tracker.lease = ShardLease(tracker.s3, 'w1', n_shards=2, ttl_seconds=0.2)
+        self.daemon = TrackerDaemon(tracker=tracker, idle_seconds=3600, port=None)
+        self.lease = tracker.lease
+        self.shard = self.lease.acquire()[0]
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def _take_over(self):
+        # another worker claims the shard after the lease expired
+        self.store.s3_write_json(data={'worker_id': 'w2', 'expires_at': '2100-01-01T00:00:00'},
+                                 file_path=self.lease._lease_path(self.shard))
+
+    def test_sleep_renews_lease(self):
+        """
+        a sleep longer than the lease wakes up to renew it and stops when the lease was lost
+        """
+        etag = self.lease.shards[self.shard]
+        self.assertTrue(self.daemon._sleep(0.3))
+        self.assertNotEqual(self.lease.shards[self.shard], etag)
+        self._take_over()
+        start = time.monotonic()
+        self.assertFalse(self.daemon._sleep(3600))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.lease.shards, {})
+
+    def test_quarantined_ticker_held(self):
+        """
+        a quarantined ticker is not rescheduled like a throttled ticker
+        """
+        def process_ticker(ticker, source_data):
+            self.daemon.alphaio.response_status[ticker] = {'income': 'quarantined'}
+            self.daemon.alphaio.ticker_tracking_dict[ticker] = None
+
+        with (mock.patch.object(AlphaIO, 'get_statement', return_value={}),
+              mock.patch.object(AlphaIO, 'process_ticker', side_effect=process_ticker)):
+            self.daemon._new_alphaio()
+            self.daemon.process('AAA')
+        self.assertEqual(self.daemon.pending, [])
+        self.assertEqual((self.daemon.stats['quarantined'], self.daemon.stats['throttled']), (1, 0))
+
+    def test_rollups_saved_on_persist(self):
+        """
+        the rollups are updated with the statements of all the processed tickers on the persist interval
+        """
+        with (mock.patch.object(AlphaIO, 'get_statement', return_value={}),
+              mock.patch.object(AlphaIO, 'process_ticker'),
+              mock.patch.object(SectorRollup, 'save') as save,
+              mock.patch.object(self.daemon.tracker, 'write_ticker_queue') as write_queue):
+            self.daemon._new_alphaio()
+            for ticker in ['AAA', 'BBB']:
+                self.daemon.process(ticker)
+            save.assert_not_called()
+            self.daemon.persist()
+            save.assert_called_once()
+            write_queue.assert_called_once()
+
+    def test_lost_lease_refreshes(self):
+        """
+        the pending tickers of a lost shard are not processed, the due tickers are refreshed first
+        """
+        processed, refreshed = [], []
+
+        def refresh():
+            refreshed.append(True)
+            self.daemon.pending = []
+            self.daemon.stop_event.set()
+        self.daemon.refresh = refresh
+        self.daemon.process = processed.append
+        self.daemon.last_refresh = time.monotonic()
+        self.daemon.pending = ['AAA']
+        self._take_over()
+        self.daemon.run()
+        self.assertEqual(processed, [])
+        self.assertEqual(refreshed, [True])
+
 if __name__ == '__main__':
     # test_new_field()
     # test_removed_field()